@@ -1,16 +1,31 @@
 from django.contrib import admin
 
 # Register your models here.
-from .models import UploadedFile, ScanningSession
+from .models import UploadedFile, ScanningSession, FileAttribute, WorkItem
 
 
 class ScanningSessionAdmin(admin.ModelAdmin):
-    list_display = ('pk', 'created_at', 'last_modified_at', 'status', 'session_error')
+    list_display = ('pk', 'created_at', 'last_modified_at', 'status', 'session_error',
+                    'videos_count', 'uploaded_count', 'ready_count', 'error_count')
 
 
 class UploadedFileAdmin(admin.ModelAdmin):
-    list_display = ('pk', 'created_at', 'original_path', 'file_id', 'status', 'name', 'session',)
+    list_display = ('pk', 'created_at', 'original_path', 'file_id', 'account_id', 'status', 'name', 'session',)
+
+
+class FileAttributeAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'file', 'name', 'value')
+    list_filter = ('name',)
+    search_fields = ('value',)
+
+
+class WorkItemAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'path', 'status', 'worker', 'lease_expires_at', 'attempts', 'updated_at')
+    list_filter = ('status',)
+    search_fields = ('path',)
 
 
 admin.site.register(ScanningSession, ScanningSessionAdmin)
 admin.site.register(UploadedFile, UploadedFileAdmin)
+admin.site.register(FileAttribute, FileAttributeAdmin)
+admin.site.register(WorkItem, WorkItemAdmin)
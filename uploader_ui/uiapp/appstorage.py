@@ -1,5 +1,61 @@
-from uploader_app.storage import StorageBase
-from .models import ScanningSession, UploadedFile
+import logging
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from django.db import connection, transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from uploader_app.chunked import UploadSession
+from uploader_app.storage import StorageBase, VideoIndexStorageBase, UploadSessionStorageBase, ListingCursorStorageBase, \
+    ContentHashStorageBase, AdDuplicationStorageBase
+from uploader_app.source import DropBoxFile
+from uploader_app.uploader import UploadedVideo, VIDEO_TERMINAL_STATUSES, VIDEO_STATUS_READY, VIDEO_STATUS_ERROR
+from uploader_app.workqueue import WorkQueueBase
+from .models import ScanningSession, UploadedFile, IndexedVideo, IndexSync, VideoUploadSession, ListingCursor, \
+    ContentHashLink, FileAttribute, WorkItem, DuplicatedJob, DuplicatedVideo
+
+
+def _count_created(deltas: Dict[int, Dict[str, int]], videos: List[UploadedFile]):
+    for v in videos:
+        d = deltas.setdefault(v.session_id, {})
+        d['videos_count'] = d.get('videos_count', 0) + 1
+        d['uploaded_count'] = d.get('uploaded_count', 0) + (v.file_id != '')
+        d['ready_count'] = d.get('ready_count', 0) + (v.status == VIDEO_STATUS_READY)
+        d['error_count'] = d.get('error_count', 0) + (v.status == VIDEO_STATUS_ERROR)
+        d['duplicates_count'] = d.get('duplicates_count', 0) + (v.duplicate_of is not None)
+
+
+def _count_status_change(deltas: Dict[int, Dict[str, int]], video_ids: List[str], new_status: str):
+    """
+    Must be called before the status is changed
+    """
+    changed = UploadedFile.objects.filter(file_id__in=video_ids).exclude(status=new_status) \
+        .values_list('session_id', 'status').annotate(n=Count('id')).order_by()
+    for session_id, status, n in changed:
+        d = deltas.setdefault(session_id, {})
+        d['ready_count'] = d.get('ready_count', 0) + n * ((new_status == VIDEO_STATUS_READY) - (status == VIDEO_STATUS_READY))
+        d['error_count'] = d.get('error_count', 0) + n * ((new_status == VIDEO_STATUS_ERROR) - (status == VIDEO_STATUS_ERROR))
+
+
+def _new_attributes(file_id: int, attributes: Optional[dict]) -> List[FileAttribute]:
+    return [FileAttribute(file_id=file_id, name=name, value=str(value)[:255],
+                          number=value if isinstance(value, int) else None)
+            for name, value in (attributes or {}).items()]
+
+
+def _update_counters(deltas: Dict[int, Dict[str, int]]):
+    """
+    Adds deltas to ScanningSession counters, last_modified_at is updated so cached sessions list is refreshed
+    """
+    now = timezone.now()
+    for session_id, d in deltas.items():
+        changes = {name: F(name) + n for name, n in d.items() if n != 0}
+        if len(changes) > 0:
+            ScanningSession.objects.filter(pk=session_id).update(last_modified_at=now, **changes)
 
 
 class DjangoStorage(StorageBase):
@@ -20,22 +76,390 @@ class DjangoStorage(StorageBase):
         sess.session_error = err
         sess.save()
 
-    def create_video(self, session_id: int, video_id: str, name: str, original_path: str, status=None):
-        sess = ScanningSession.objects.get(pk=session_id)
+    def create_video(self, session_id: int, video_id: str, name: str, original_path: str, status=None,
+                     duplicate_of: str = None, attributes: dict = None, account_id: str = None):
+        f = self._new_video(session_id, video_id, name, original_path, status, duplicate_of, account_id)
+        deltas = {}
+        _count_created(deltas, [f])
+        with transaction.atomic():
+            f.save()
+            FileAttribute.objects.bulk_create(_new_attributes(f.pk, attributes))
+            _update_counters(deltas)
+
+    def _new_video(self, session_id: int, video_id: str, name: str, original_path: str, status=None,
+                   duplicate_of: str = None, account_id: str = None) -> UploadedFile:
         f = UploadedFile()
         f.name = name
         f.file_id = video_id
         f.original_path = original_path
-        f.session = sess
+        f.session_id = session_id
         f.status = status
-        f.save()
+        f.duplicate_of = duplicate_of
+        f.account_id = account_id or ''
+        return f
 
     def update_video_status(self, video_id: str, new_status: str):
+        # several files are linked to the same video when they have the same content
+        deltas = {}
+        with transaction.atomic():
+            _count_status_change(deltas, [video_id], new_status)
+            UploadedFile.objects.filter(file_id=video_id).update(status=new_status)
+            _update_counters(deltas)
+
+    def get_pending_videos(self) -> List[Tuple[str, Optional[str]]]:
+        return list(UploadedFile.objects.exclude(status__in=VIDEO_TERMINAL_STATUSES).exclude(file_id='')
+                    .values_list('file_id', 'status').distinct())
+
+
+class BufferedDjangoStorage(DjangoStorage):
+    """
+    Queues created videos and status changes and writes them with bulk queries in one transaction,
+    every flush_interval seconds or once batch_size records are queued.
+    Sessions are completed only after their videos are written, close() must be called on shutdown
+    """
+    def __init__(self, batch_size: int = None, flush_interval: float = None):
+        self._batch_size = batch_size or int(os.getenv('STORAGE_BATCH_SIZE', '100'))
+        self._flush_interval = flush_interval or float(os.getenv('STORAGE_FLUSH_INTERVAL', '2'))
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._videos = []  # type: List[UploadedFile]
+        self._statuses = {}  # type: Dict[str, str]
+        self._attributes = {}  # type: Dict[Tuple[int, str], dict]  by session and path of queued videos
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='storage-flush', daemon=True)
+        self._thread.start()
+
+    def _size(self) -> int:
+        return len(self._videos) + len(self._statuses)
+
+    def create_video(self, session_id: int, video_id: str, name: str, original_path: str, status=None,
+                     duplicate_of: str = None, attributes: dict = None, account_id: str = None):
+        with self._lock:
+            self._videos.append(self._new_video(session_id, video_id, name, original_path, status, duplicate_of,
+                                                account_id))
+            if attributes:
+                self._attributes[(session_id, original_path)] = attributes
+            full = self._size() >= self._batch_size
+        if full:
+            self.flush()
+
+    def update_video_status(self, video_id: str, new_status: str):
+        with self._lock:
+            self._statuses[video_id] = new_status
+            full = self._size() >= self._batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes queued records, they are queued again if writing fails
+        """
+        with self._flush_lock:
+            with self._lock:
+                videos, self._videos = self._videos, []
+                statuses, self._statuses = self._statuses, {}
+                attributes, self._attributes = self._attributes, {}
+            if len(videos) == 0 and len(statuses) == 0:
+                return
+            by_status = {}
+            for video_id, status in statuses.items():
+                by_status.setdefault(status, []).append(video_id)
+            deltas = {}
+            try:
+                with transaction.atomic():
+                    created = self._not_stored(videos)
+                    _count_created(deltas, created)
+                    # conflicts are only left to a concurrent writer of the same file
+                    UploadedFile.objects.bulk_create(created, batch_size=self._batch_size, ignore_conflicts=True)
+                    self._create_attributes(attributes)
+                    for status, ids in by_status.items():
+                        for i in range(0, len(ids), self._batch_size):
+                            _count_status_change(deltas, ids[i:i + self._batch_size], status)
+                            UploadedFile.objects.filter(file_id__in=ids[i:i + self._batch_size]).update(status=status)
+                    _update_counters(deltas)
+            except Exception:
+                with self._lock:
+                    self._videos = videos + self._videos
+                    self._statuses = {**statuses, **self._statuses}
+                    self._attributes = {**attributes, **self._attributes}
+                raise
+            logging.debug(f'Stored {len(videos)} videos and {len(statuses)} status changes')
+
+    def _not_stored(self, videos: List[UploadedFile]) -> List[UploadedFile]:
+        """
+        A file recorded twice in a session and account is stored once, so it is counted once
+        :return: videos which (session, path, account) is not stored yet, the first one of repeated videos
+        """
+        new = {}
+        for v in videos:
+            new.setdefault((v.session_id, v.original_path, v.account_id), v)
+        by_session = {}
+        for session_id, path, _ in new:
+            by_session.setdefault(session_id, set()).add(path)
+        for session_id, paths in by_session.items():
+            paths = list(paths)
+            for i in range(0, len(paths), self._batch_size):
+                stored = UploadedFile.objects.filter(session_id=session_id, original_path__in=paths[i:i + self._batch_size])
+                for path, account_id in stored.values_list('original_path', 'account_id'):
+                    new.pop((session_id, path, account_id), None)
+        return list(new.values())
+
+    def _create_attributes(self, attributes: Dict[Tuple[int, str], dict]):
+        """
+        bulk_create does not return primary keys on every database, files are found by unique session and path
+        """
+        by_session = {}
+        for session_id, path in attributes:
+            by_session.setdefault(session_id, []).append(path)
+        rows = []
+        for session_id, paths in by_session.items():
+            for i in range(0, len(paths), self._batch_size):
+                files = UploadedFile.objects.filter(session_id=session_id, original_path__in=paths[i:i + self._batch_size])
+                for path, pk in files.values_list('original_path', 'pk'):
+                    rows.extend(_new_attributes(pk, attributes[(session_id, path)]))
+        FileAttribute.objects.bulk_create(rows, batch_size=self._batch_size, ignore_conflicts=True)
+
+    def _run(self):
         try:
-            v = UploadedFile.objects.get(file_id=video_id)
-            v.status = new_status
-            v.save()
-        except:
-            pass
+            while not self._closed.wait(self._flush_interval):
+                try:
+                    self.flush()
+                except Exception as e:
+                    logging.exception(f'Storage flush failed: {e}')
+        finally:
+            connection.close()
+
+    def session_completed(self, session_id: int):
+        self.flush()
+        super().session_completed(session_id)
+
+    def session_completed_error(self, session_id: int, err: str):
+        self.flush()
+        super().session_completed_error(session_id, err)
+
+    def get_pending_videos(self) -> List[Tuple[str, Optional[str]]]:
+        self.flush()
+        return super().get_pending_videos()
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self.flush()
+
+
+class DjangoVideoIndexStorage(VideoIndexStorageBase):
+    def load_videos(self, account_id: str) -> List[UploadedVideo]:
+        rows = IndexedVideo.objects.filter(account_id=account_id).values_list('video_id', 'name', 'status', 'created_time')
+        return [UploadedVideo(*row) for row in rows.iterator()]
+
+    def save_videos(self, account_id: str, videos: List[UploadedVideo]):
+        with transaction.atomic():
+            existing = set(IndexedVideo.objects.filter(account_id=account_id, video_id__in=[v.id for v in videos])
+                           .values_list('video_id', flat=True))
+            for v in videos:
+                if v.id in existing:
+                    IndexedVideo.objects.filter(account_id=account_id, video_id=v.id)\
+                        .update(name=v.name, status=v.status, created_time=v.created_time)
+            IndexedVideo.objects.bulk_create([
+                IndexedVideo(account_id=account_id, video_id=v.id, name=v.name, status=v.status, created_time=v.created_time)
+                for v in videos if v.id not in existing
+            ], batch_size=500)
+
+    def delete_video(self, account_id: str, video_id: str):
+        IndexedVideo.objects.filter(account_id=account_id, video_id=video_id).delete()
+
+    def clear(self, account_id: str):
+        with transaction.atomic():
+            IndexedVideo.objects.filter(account_id=account_id).delete()
+            IndexSync.objects.filter(account_id=account_id).delete()
+
+    def get_last_created_time(self, account_id: str) -> Optional[datetime]:
+        sync = IndexSync.objects.filter(account_id=account_id).first()
+        return sync.last_created_time if sync is not None else None
+
+    def set_last_created_time(self, account_id: str, created_time: datetime):
+        IndexSync.objects.update_or_create(account_id=account_id, defaults={'last_created_time': created_time})
+
+
+class DjangoUploadSessionStorage(UploadSessionStorageBase):
+    def get_upload_session(self, key: str) -> Optional[UploadSession]:
+        s = VideoUploadSession.objects.filter(key=key).first()
+        if s is None:
+            return None
+        return UploadSession(s.key, s.account_id, s.upload_session_id, s.video_id, s.file_size, s.start_offset, s.end_offset)
+
+    def save_upload_session(self, session: UploadSession):
+        VideoUploadSession.objects.update_or_create(key=session.key, defaults={
+            'account_id': session.account_id,
+            'upload_session_id': session.upload_session_id,
+            'video_id': session.video_id,
+            'file_size': session.file_size,
+            'start_offset': session.start_offset,
+            'end_offset': session.end_offset,
+        })
+
+    def delete_upload_session(self, key: str):
+        VideoUploadSession.objects.filter(key=key).delete()
+
+
+class DjangoListingCursorStorage(ListingCursorStorageBase):
+    def get_cursors(self, root: str) -> Dict[str, str]:
+        return dict(ListingCursor.objects.filter(root=root).values_list('path', 'cursor'))
+
+    def save_cursor(self, root: str, path: str, cursor: str):
+        ListingCursor.objects.update_or_create(root=root, path=path, defaults={'cursor': cursor})
+
+    def clear_cursors(self, root: str):
+        ListingCursor.objects.filter(root=root).delete()
+
+
+class DjangoContentHashStorage(ContentHashStorageBase):
+    def get_links(self, account_id: str, content_hash: str) -> List[Tuple[str, str]]:
+        return list(ContentHashLink.objects.filter(account_id=account_id, content_hash=content_hash)
+                    .order_by('pk').values_list('video_id', 'path'))
+
+    def add_link(self, account_id: str, content_hash: str, video_id: str, path: str):
+        ContentHashLink.objects.update_or_create(account_id=account_id, content_hash=content_hash, path=path,
+                                                 defaults={'video_id': video_id})
+
+    def delete_links(self, account_id: str, content_hash: str):
+        ContentHashLink.objects.filter(account_id=account_id, content_hash=content_hash).delete()
+
+
+class DjangoAdDuplicationStorage(AdDuplicationStorageBase):
+    def get_job_adset(self, template_id: str, job: str) -> Optional[str]:
+        return DuplicatedJob.objects.filter(template_id=template_id, job=job)\
+            .values_list('adset_id', flat=True).first()
+
+    def save_job_adset(self, template_id: str, job: str, campaign_id: str, adset_id: str):
+        DuplicatedJob.objects.update_or_create(template_id=template_id, job=job,
+                                               defaults={'campaign_id': campaign_id, 'adset_id': adset_id})
+
+    def get_video_ad(self, template_id: str, video_id: str) -> Tuple[Optional[str], Optional[str]]:
+        row = DuplicatedVideo.objects.filter(template_id=template_id, video_id=video_id)\
+            .values_list('adset_id', 'ad_id').first()
+        return row if row is not None else (None, None)
+
+    def save_video_ad(self, template_id: str, video_id: str, name: str, adset_id: str, ad_id: str = None):
+        DuplicatedVideo.objects.update_or_create(template_id=template_id, video_id=video_id, defaults={
+            'name': name,
+            'adset_id': adset_id,
+            'ad_id': ad_id,
+            'error': None,
+        })
+
+    def video_failed(self, template_id: str, video_id: str, name: str, error: str):
+        with transaction.atomic():
+            updated = DuplicatedVideo.objects.filter(template_id=template_id, video_id=video_id)\
+                .update(error=error, attempts=F('attempts') + 1)
+            if updated == 0:
+                DuplicatedVideo.objects.create(template_id=template_id, video_id=video_id, name=name, error=error,
+                                               attempts=1)
+
+    def get_failed(self, template_id: str, max_attempts: int) -> List[Tuple[str, str]]:
+        return list(DuplicatedVideo.objects.filter(template_id=template_id, ad_id=None, attempts__lt=max_attempts)
+                    .order_by('pk').values_list('video_id', 'name'))
+
+
+class DjangoWorkQueue(WorkQueueBase):
+    """
+    Queue of WorkItem rows. Leasing selects candidate rows and takes them with an update repeating the select
+    condition, so concurrent workers get disjoint files without row locks, the same way on SQLite and server databases
+    """
+    batch_size = 500  # rows per IN (...) query, below SQLite variables limit
+
+    def __init__(self, max_attempts: int = None):
+        """
+        :param max_attempts: leases of a file before it is failed, counting leases expired by crashed workers
+        """
+        self._max_attempts = max_attempts or int(os.getenv('GA_LEASE_MAX_ATTEMPTS', '3'))
+
+    def _leasable(self, now: datetime):
+        return WorkItem.objects.filter(Q(status=WorkItem.STATUS_PENDING) |
+                                       Q(status=WorkItem.STATUS_LEASED, lease_expires_at__lt=now),
+                                       attempts__lt=self._max_attempts)
+
+    def enqueue(self, files: List[DropBoxFile]) -> int:
+        files = list({f.path: f for f in files}.values())
+        queued = 0
+        now = timezone.now()
+        for i in range(0, len(files), self.batch_size):
+            batch = files[i:i + self.batch_size]
+            with transaction.atomic():
+                existing = {w.path: w for w in WorkItem.objects.filter(path__in=[f.path for f in batch])
+                            .only('path', 'content_hash', 'status')}
+                new = [WorkItem(path=f.path, name=f.name, size=getattr(f, 'size', None),
+                                content_hash=getattr(f, 'content_hash', None))
+                       for f in batch if f.path not in existing]
+                WorkItem.objects.bulk_create(new, ignore_conflicts=True)
+                queued += len(new)
+                for f in batch:
+                    item = existing.get(f.path)
+                    # leased files are left to their worker
+                    if item is None or item.status == WorkItem.STATUS_LEASED:
+                        continue
+                    content_hash = getattr(f, 'content_hash', None)
+                    if item.status == WorkItem.STATUS_PENDING or \
+                            (item.status == WorkItem.STATUS_DONE and content_hash is not None and
+                             content_hash == item.content_hash):
+                        continue
+                    queued += WorkItem.objects.filter(pk=item.pk, status=item.status).update(
+                        status=WorkItem.STATUS_PENDING, name=f.name, size=getattr(f, 'size', None),
+                        content_hash=content_hash, attempts=0, worker='', lease_token='', lease_expires_at=None,
+                        updated_at=now)
+        return queued
+
+    def lease(self, worker: str, count: int, lease_seconds: float) -> List[DropBoxFile]:
+        while True:
+            now = timezone.now()
+            # files which lease expired on every attempt, e.g. crashing their workers, are given up
+            WorkItem.objects.filter(status=WorkItem.STATUS_LEASED, lease_expires_at__lt=now,
+                                    attempts__gte=self._max_attempts)\
+                .update(status=WorkItem.STATUS_FAILED, lease_token='', lease_expires_at=None, updated_at=now)
+            ids = list(self._leasable(now).order_by('id').values_list('id', flat=True)[:count])
+            if len(ids) == 0:
+                return []
+            token = uuid.uuid4().hex
+            # rows taken by another worker since the select do not match the condition anymore
+            taken = self._leasable(now).filter(id__in=ids).update(
+                status=WorkItem.STATUS_LEASED, worker=worker, lease_token=token,
+                lease_expires_at=now + timedelta(seconds=lease_seconds), attempts=F('attempts') + 1, updated_at=now)
+            if taken > 0:
+                rows = WorkItem.objects.filter(lease_token=token).order_by('id')\
+                    .values_list('name', 'path', 'size', 'content_hash')
+                return [DropBoxFile(*row) for row in rows]
+
+    def _held(self, worker: str, paths: List[str]):
+        for i in range(0, len(paths), self.batch_size):
+            yield WorkItem.objects.filter(path__in=paths[i:i + self.batch_size], worker=worker,
+                                          status=WorkItem.STATUS_LEASED)
+
+    def renew(self, worker: str, paths: List[str], lease_seconds: float) -> List[str]:
+        now = timezone.now()
+        renewed = []
+        for held in self._held(worker, paths):
+            held.update(lease_expires_at=now + timedelta(seconds=lease_seconds), updated_at=now)
+            renewed.extend(held.values_list('path', flat=True))
+        return renewed
+
+    def complete(self, worker: str, path: str, failed: bool):
+        now = timezone.now()
+        held = WorkItem.objects.filter(path=path, worker=worker, status=WorkItem.STATUS_LEASED)
+        if not failed:
+            held.update(status=WorkItem.STATUS_DONE, lease_token='', lease_expires_at=None, updated_at=now)
+            return
+        held.filter(attempts__gte=self._max_attempts)\
+            .update(status=WorkItem.STATUS_FAILED, lease_token='', lease_expires_at=None, updated_at=now)
+        held.update(status=WorkItem.STATUS_PENDING, worker='', lease_token='', lease_expires_at=None, updated_at=now)
+
+    def release(self, worker: str, paths: List[str]):
+        now = timezone.now()
+        for held in self._held(worker, paths):
+            held.update(status=WorkItem.STATUS_PENDING, worker='', lease_token='', lease_expires_at=None,
+                        attempts=F('attempts') - 1, updated_at=now)
 
+    def has_work(self) -> bool:
+        return self._leasable(timezone.now()).exists()
 
+    def thread_finished(self):
+        connection.close()
@@ -0,0 +1,88 @@
+import os
+import random
+import tempfile
+import time
+
+from django.core.management import BaseCommand, call_command
+from django.db import connections
+from django.db.migrations.executor import MigrationExecutor
+
+BENCH_DB = 'bench'
+BEFORE_INDEXES = '0008_content_hash_links'
+WITH_INDEXES = '0009_uploadedfile_indexes'
+
+
+class Command(BaseCommand):
+    help = 'Measures video status update throughput on a large temporary database before and after uploadedfile indexes'
+
+    def _print(self, s):
+        self.stdout.write(f"{s}\n")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000, help='Number of seeded uploaded files')
+        parser.add_argument('--sessions', type=int, default=100, help='Number of seeded sessions')
+        parser.add_argument('--updates', type=int, default=500, help='Number of measured status updates')
+
+    def _models(self, migration: str):
+        """
+        Historical ScanningSession and UploadedFile models, current ones have columns added by later migrations
+        """
+        apps = MigrationExecutor(connections[BENCH_DB]).loader.project_state(('uiapp', migration)).apps
+        return apps.get_model('uiapp', 'ScanningSession'), apps.get_model('uiapp', 'UploadedFile')
+
+    def _seed(self, rows: int, sessions: int):
+        ScanningSession, UploadedFile = self._models(BEFORE_INDEXES)
+        ids = []
+        for _ in range(sessions):
+            s = ScanningSession(status=1)
+            s.save(using=BENCH_DB)
+            ids.append(s.pk)
+        batch = []
+        for i in range(rows):
+            batch.append(UploadedFile(session_id=ids[i % sessions], file_id=str(10 ** 15 + i), name=f'video{i}.mp4',
+                                      original_path=f'/J{i % 500}_/video{i}.mp4', status='processing'))
+            if len(batch) == 1000:
+                UploadedFile.objects.using(BENCH_DB).bulk_create(batch)
+                batch = []
+        UploadedFile.objects.using(BENCH_DB).bulk_create(batch)
+
+    def _get_and_save(self, UploadedFile, video_id: str):
+        """
+        update_video_status before the indexes were added
+        """
+        try:
+            v = UploadedFile.objects.using(BENCH_DB).get(file_id=video_id)
+            v.status = 'ready'
+            v.save(using=BENCH_DB)
+        except Exception:
+            pass
+
+    def _update(self, UploadedFile, video_id: str):
+        UploadedFile.objects.using(BENCH_DB).filter(file_id=video_id).update(status='ready')
+
+    def _measure(self, name: str, update, migration: str, ids):
+        _, UploadedFile = self._models(migration)
+        started = time.monotonic()
+        for video_id in ids:
+            update(UploadedFile, video_id)
+        elapsed = time.monotonic() - started
+        self._print(f"{name:40} {len(ids) / elapsed:10.0f} updates/s")
+
+    def handle(self, *args, **options):
+        fd, path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        connections.databases[BENCH_DB] = {**connections.databases['default'], 'NAME': path}
+        try:
+            call_command('migrate', 'uiapp', BEFORE_INDEXES, database=BENCH_DB, verbosity=0)
+            self._print(f"Seeding {options['rows']} files in {options['sessions']} sessions")
+            self._seed(options['rows'], options['sessions'])
+            ids = [str(10 ** 15 + random.randrange(options['rows'])) for _ in range(options['updates'])]
+
+            self._measure('without indexes, get and save', self._get_and_save, BEFORE_INDEXES, ids)
+            self._measure('without indexes, filtered update', self._update, BEFORE_INDEXES, ids)
+            call_command('migrate', 'uiapp', WITH_INDEXES, database=BENCH_DB, verbosity=0)
+            self._measure('with indexes, get and save', self._get_and_save, WITH_INDEXES, ids)
+            self._measure('with indexes, filtered update', self._update, WITH_INDEXES, ids)
+        finally:
+            connections[BENCH_DB].close()
+            os.remove(path)
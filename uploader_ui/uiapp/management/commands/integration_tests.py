@@ -1,9 +1,10 @@
 import json
 import os
 from django.core.management import BaseCommand
-from facebook_business import FacebookSession, FacebookAdsApi
+from facebook_business import FacebookSession
 
 from uploader_app.app import Uploader
+from uploader_app.ratelimit import GovernedFacebookAdsApi
 from uploader_app.source import DropBoxSource
 from uploader_app.uploader import FacebookUploaderNoWait
 from ...appstorage import DjangoStorage
@@ -23,7 +24,7 @@ class Command(BaseCommand):
         act_id = os.environ['FB_ACT_ID']
         tmp_dir = os.path.abspath(os.environ['GA_TEMP_DIR'])
 
-        uploader = FacebookUploaderNoWait(FacebookAdsApi(session), act_id)
+        uploader = FacebookUploaderNoWait(GovernedFacebookAdsApi(session), act_id)
         storage = DjangoStorage()
         source = DropBoxSource(os.environ['DROPBOX_TOKEN'],
                                os.environ['GA_ROOT'])
@@ -1,12 +1,24 @@
+import asyncio
 import json
+import logging
 import os
-from django.core.management import BaseCommand
-from facebook_business import FacebookSession, FacebookAdsApi
+import time
+from django.core.management import BaseCommand, CommandError
+from facebook_business import FacebookSession
 
+from uploader_app.aioapp import AsyncUploader
+from uploader_app.aiosource import AsyncDropBoxSource
+from uploader_app.aiouploader import AsyncGraphApi, AsyncFacebookUploader
 from uploader_app.app import Uploader
+from uploader_app.duplicator import AdDuplicator
+from uploader_app.ratelimit import GovernedFacebookAdsApi
+from uploader_app.routing import AccountRouter, get_routes
 from uploader_app.source import DropBoxSource
 from uploader_app.uploader import FacebookUploaderNoWait
-from ...appstorage import DjangoStorage
+from uploader_app.workqueue import LeasedSource, enqueue_listed, clean_worker_dirs, worker_temp_dir
+from ...appstorage import BufferedDjangoStorage, DjangoVideoIndexStorage, DjangoUploadSessionStorage, \
+    DjangoListingCursorStorage, DjangoContentHashStorage, DjangoWorkQueue, DjangoAdDuplicationStorage
+from ...progress import CacheProgressPublisher
 
 class Command(BaseCommand):
     help = 'Loads'
@@ -14,19 +26,132 @@ class Command(BaseCommand):
     def _print(self, s):
         self.stdout.write(f"{s}\n")
 
+    def add_arguments(self, parser):
+        parser.add_argument('--full-index', action='store_true',
+                            help='Rebuild stored index of ad account videos instead of fetching only new ones')
+        parser.add_argument('--full-listing', action='store_true',
+                            help='List all job folders from scratch instead of only changes since the previous run')
+        parser.add_argument('--watch', action='store_true',
+                            help='Keep running and start a new run as soon as mp4 files are added to dropbox')
+        mode = parser.add_mutually_exclusive_group()
+        mode.add_argument('--enqueue', action='store_true',
+                          help='Only list dropbox and queue matching files for --worker processes')
+        mode.add_argument('--worker', action='store_true',
+                          help='Upload files leased from the queue filled by --enqueue, any number of workers '
+                               'can run at once')
+
+    def _run_async(self, session: FacebookSession, api: GovernedFacebookAdsApi, routes: dict, tmp_dir: str,
+                   storage, cursor_storage, duplicator, full_index: bool, wait_for_encoding: bool):
+        async def run():
+            graph = AsyncGraphApi(session, governor=api.governor)
+            router = AccountRouter({act_id: AsyncFacebookUploader(graph, act_id, DjangoVideoIndexStorage(),
+                                                                  DjangoUploadSessionStorage(),
+                                                                  DjangoContentHashStorage())
+                                    for act_id in routes}, routes)
+            source = AsyncDropBoxSource(os.environ['DROPBOX_TOKEN'], os.environ['GA_ROOT'],
+                                        cursor_storage=cursor_storage)
+            try:
+                await AsyncUploader(storage, source, router, tmp_dir, progress_publisher=CacheProgressPublisher(),
+                                    duplicator=duplicator).run(full_index, wait_for_encoding)
+            finally:
+                await source.close()
+                await graph.close()
+
+        asyncio.run(run())
+
+    def _enqueue(self, watch: bool, full_listing: bool):
+        cursor_storage = DjangoListingCursorStorage()
+        if full_listing:
+            cursor_storage.clear_cursors(os.environ['GA_ROOT'])
+        source = DropBoxSource(os.environ['DROPBOX_TOKEN'], os.environ['GA_ROOT'], cursor_storage=cursor_storage)
+        queue = DjangoWorkQueue()
+        if watch:
+            source.start_watching()
+        self._print(f"Queued {enqueue_listed(source, queue)} files")
+        while watch:
+            try:
+                changed = source.wait_for_changes()
+            except Exception as e:
+                logging.exception(f"Waiting for dropbox changes failed: {e}")
+                time.sleep(60)
+                continue
+            if changed:
+                self._print(f"Queued {enqueue_listed(source, queue)} files")
+
     def handle(self, *args, **options):
+        asyncio_engine = os.getenv('GA_ENGINE', 'threads') == 'asyncio'
+        if asyncio_engine and options['watch']:
+            raise CommandError('--watch is only supported by GA_ENGINE=threads')
+        if asyncio_engine and options['worker']:
+            raise CommandError('--worker is only supported by GA_ENGINE=threads')
+        if options['enqueue']:
+            self._enqueue(options['watch'], options['full_listing'])
+            return
         session = FacebookSession(
             os.environ['FB_GA_APPID'],
             os.environ['FB_GA_APPKEY'],
             os.environ['FB_GA_TOKEN'],
         )
-        act_id = os.environ['FB_ACT_ID']
+        routes = get_routes()
+        template_campaign_id = os.getenv('FB_TEMPLATE_CAMPAIGN_ID')
+        if template_campaign_id and len(routes) > 1:
+            raise CommandError('FB_TEMPLATE_CAMPAIGN_ID is only supported with a single ad account')
         tmp_dir = os.path.abspath(os.environ['GA_TEMP_DIR'])
 
-        uploader = FacebookUploaderNoWait(FacebookAdsApi(session), act_id)
-        storage = DjangoStorage()
-        source = DropBoxSource(os.environ['DROPBOX_TOKEN'],
-                               os.environ['GA_ROOT'])
+        api = GovernedFacebookAdsApi(session)
+        storage = BufferedDjangoStorage()
+        cursor_storage = DjangoListingCursorStorage()
+        if options['full_listing']:
+            cursor_storage.clear_cursors(os.environ['GA_ROOT'])
+        duplicator = AdDuplicator(api, next(iter(routes)), template_campaign_id,
+                                  duplication_storage=DjangoAdDuplicationStorage()) if template_campaign_id else None
+        wait_for_encoding = os.getenv('GA_WAIT_ENCODING', '0') == '1'
+        if asyncio_engine:
+            try:
+                self._run_async(session, api, routes, tmp_dir, storage, cursor_storage, duplicator,
+                                options['full_index'], wait_for_encoding)
+                self._print(f"Graph api usage: {api.governor.metrics()}")
+            finally:
+                if duplicator is not None:
+                    duplicator.close()
+                storage.close()
+            return
+
+        router = AccountRouter({act_id: FacebookUploaderNoWait(api, act_id, DjangoVideoIndexStorage(),
+                                                               DjangoUploadSessionStorage(), DjangoContentHashStorage())
+                                for act_id in routes}, routes)
+        if options['worker']:
+            # files are listed by --enqueue, dropbox is only used to download them
+            source = LeasedSource(DjangoWorkQueue(), DropBoxSource(os.environ['DROPBOX_TOKEN'], os.environ['GA_ROOT']))
+            logging.info(f"Leasing files as {source.worker}")
+            clean_worker_dirs(tmp_dir)
+            tmp_dir = worker_temp_dir(tmp_dir, source.worker)
+        else:
+            source = DropBoxSource(os.environ['DROPBOX_TOKEN'],
+                                   os.environ['GA_ROOT'],
+                                   cursor_storage=cursor_storage)
+            if options['watch']:
+                source.start_watching()
 
-        uploader = Uploader(storage, source, uploader, tmp_dir)
-        uploader.run()
+        uploader = Uploader(storage, source, router, tmp_dir, progress_publisher=CacheProgressPublisher(),
+                            duplicator=duplicator)
+        try:
+            uploader.run(options['full_index'], wait_for_encoding)
+            self._print(f"Graph api usage: {api.governor.metrics()}")
+            while options['watch']:
+                try:
+                    changed = source.wait_for_changes()
+                except Exception as e:
+                    logging.exception(f"Waiting for dropbox changes failed: {e}")
+                    time.sleep(60)
+                    continue
+                if changed:
+                    logging.info("New files in dropbox, starting a new run")
+                    uploader.run(False, wait_for_encoding)
+                    self._print(f"Graph api usage: {api.governor.metrics()}")
+        finally:
+            if options['worker']:
+                source.close()
+            if duplicator is not None:
+                duplicator.close()
+            storage.close()
@@ -0,0 +1,53 @@
+import os
+from django.core.management import BaseCommand, CommandError
+from facebook_business import FacebookSession
+
+from uploader_app.aioloop import EventLoopThread
+from uploader_app.aiouploader import AsyncGraphApi, AsyncFacebookUploader, SyncUploader
+from uploader_app.app import StatusPoller
+from uploader_app.duplicator import AdDuplicator
+from uploader_app.ratelimit import GovernedFacebookAdsApi
+from uploader_app.routing import get_routes
+from uploader_app.uploader import FacebookUploaderNoWait
+from ...appstorage import BufferedDjangoStorage, DjangoAdDuplicationStorage
+
+class Command(BaseCommand):
+    help = 'Polls encoding status of uploaded videos until they are ready or failed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Poll pending videos once and exit')
+        parser.add_argument('--interval', type=float, default=float(os.getenv('GA_STATUS_POLL_INTERVAL', '30')),
+                            help='Seconds between polls')
+
+    def handle(self, *args, **options):
+        session = FacebookSession(
+            os.environ['FB_GA_APPID'],
+            os.environ['FB_GA_APPKEY'],
+            os.environ['FB_GA_TOKEN'],
+        )
+        routes = get_routes()
+        template_campaign_id = os.getenv('FB_TEMPLATE_CAMPAIGN_ID')
+        if template_campaign_id and len(routes) > 1:
+            raise CommandError('FB_TEMPLATE_CAMPAIGN_ID is only supported with a single ad account')
+        # videos are reloaded by id, so one account uploader polls videos of every account
+        act_id = next(iter(routes))
+
+        api = GovernedFacebookAdsApi(session)
+        loop = None
+        if os.getenv('GA_ENGINE', 'threads') == 'asyncio':
+            loop = EventLoopThread()
+            uploader = SyncUploader(AsyncFacebookUploader(AsyncGraphApi(session, governor=api.governor), act_id), loop)
+        else:
+            uploader = FacebookUploaderNoWait(api, act_id)
+        storage = BufferedDjangoStorage()
+        duplicator = AdDuplicator(api, act_id, template_campaign_id, duplication_storage=DjangoAdDuplicationStorage()) \
+            if template_campaign_id else None
+        try:
+            StatusPoller(storage, uploader, duplicator).run(options['interval'], options['once'])
+        finally:
+            if duplicator is not None:
+                duplicator.close()
+            storage.close()
+            if loop is not None:
+                uploader.close()
+                loop.close()
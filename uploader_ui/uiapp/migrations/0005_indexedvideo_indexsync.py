@@ -0,0 +1,36 @@
+# Generated by Django 3.0 on 2026-10-18 01:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uiapp', '0004_uploadedfile_created_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndexSync',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account_id', models.CharField(max_length=255, unique=True)),
+                ('last_created_time', models.DateTimeField()),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='IndexedVideo',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account_id', models.CharField(max_length=255)),
+                ('video_id', models.CharField(max_length=255)),
+                ('name', models.CharField(blank=True, default=None, max_length=500, null=True)),
+                ('status', models.CharField(blank=True, default=None, max_length=255, null=True)),
+                ('created_time', models.DateTimeField(blank=True, default=None, null=True)),
+            ],
+            options={
+                'unique_together': {('account_id', 'video_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.0 on 2026-10-18 01:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uiapp', '0005_indexedvideo_indexsync'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VideoUploadSession',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=1000, unique=True)),
+                ('account_id', models.CharField(max_length=255)),
+                ('upload_session_id', models.CharField(max_length=255)),
+                ('video_id', models.CharField(max_length=255)),
+                ('file_size', models.BigIntegerField()),
+                ('start_offset', models.BigIntegerField()),
+                ('end_offset', models.BigIntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.0 on 2026-10-18 01:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uiapp', '0006_videouploadsession'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ListingCursor',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('root', models.CharField(max_length=1000)),
+                ('path', models.CharField(max_length=1000)),
+                ('cursor', models.TextField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('root', 'path')},
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.0 on 2026-10-18 01:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uiapp', '0007_listingcursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='duplicate_of',
+            field=models.CharField(blank=True, default=None, max_length=1000, null=True),
+        ),
+        migrations.CreateModel(
+            name='ContentHashLink',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account_id', models.CharField(max_length=255)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('video_id', models.CharField(max_length=255)),
+                ('path', models.CharField(max_length=1000)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('account_id', 'content_hash', 'path')},
+            },
+        ),
+    ]
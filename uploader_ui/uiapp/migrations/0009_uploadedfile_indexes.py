@@ -0,0 +1,49 @@
+# Generated by Django 3.0 on 2026-10-18 01:27
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def delete_duplicate_files(apps, schema_editor):
+    """
+    Keeps the latest record of a file recorded several times in one session.
+    Deleted records are not restored when the migration is reversed
+    """
+    UploadedFile = apps.get_model('uiapp', 'UploadedFile')
+    db_alias = schema_editor.connection.alias
+    duplicates = UploadedFile.objects.using(db_alias).values('session_id', 'original_path') \
+        .annotate(count=Count('id'), last_id=Max('id')).filter(count__gt=1)
+    for d in duplicates:
+        UploadedFile.objects.using(db_alias).filter(session_id=d['session_id'], original_path=d['original_path']) \
+            .exclude(id=d['last_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uiapp', '0008_content_hash_links'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['file_id'], name='uploadedfile_file_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['session', '-id'], name='uploadedfile_session_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['name'], name='uploadedfile_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['status'], name='uploadedfile_status_idx'),
+        ),
+        migrations.RunPython(delete_duplicate_files, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='uploadedfile',
+            constraint=models.UniqueConstraint(fields=('session', 'original_path'), name='uploadedfile_session_path_uniq'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 3.0 on 2026-10-18 01:29
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def count_files(apps, schema_editor):
+    ScanningSession = apps.get_model('uiapp', 'ScanningSession')
+    UploadedFile = apps.get_model('uiapp', 'UploadedFile')
+    db_alias = schema_editor.connection.alias
+    counters = UploadedFile.objects.using(db_alias).values('session_id').annotate(
+        videos_count=Count('id'),
+        uploaded_count=Count('id', filter=~Q(file_id='')),
+        ready_count=Count('id', filter=Q(status='ready')),
+        error_count=Count('id', filter=Q(status='error')),
+    ).order_by()
+    for c in counters:
+        session_id = c.pop('session_id')
+        ScanningSession.objects.using(db_alias).filter(pk=session_id).update(**c)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uiapp', '0009_uploadedfile_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scanningsession',
+            name='error_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='scanningsession',
+            name='ready_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='scanningsession',
+            name='uploaded_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='scanningsession',
+            name='videos_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='scanningsession',
+            name='last_modified_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.RunPython(count_files, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 3.0 on 2026-10-18 01:33
+
+import re
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# copy of uploader_app.pattern at the time of this migration, so later parser changes do not change the backfill
+PATTERN = re.compile(r"^([^=]+?=[^=]+?_){3,}.*\.mp4$", re.IGNORECASE)
+NUMBER = re.compile(r"[0-9]+")
+
+
+def is_file_match(filename):
+    return filename[-4:].lower() == '.mp4' and '=' in filename and PATTERN.match(filename) is not None
+
+
+def parse_attributes(filename):
+    if filename[-4:].lower() == '.mp4':
+        filename = filename[:-4]
+    attributes = {}
+    key = None
+    for part in filename.split('_'):
+        if '=' in part:
+            key, value = part.split('=', 1)
+            attributes[key] = value
+        elif key is not None:
+            attributes[key] += '_' + part
+    return {k: int(v) if NUMBER.fullmatch(v) and int(v) < 2 ** 63 else v for k, v in attributes.items() if k != ''}
+
+
+def parse_file_names(apps, schema_editor):
+    UploadedFile = apps.get_model('uiapp', 'UploadedFile')
+    FileAttribute = apps.get_model('uiapp', 'FileAttribute')
+    db_alias = schema_editor.connection.alias
+    rows = []
+    for pk, name in UploadedFile.objects.using(db_alias).values_list('pk', 'name').iterator():
+        if not is_file_match(name):
+            continue
+        for key, value in parse_attributes(name).items():
+            rows.append(FileAttribute(file_id=pk, name=key, value=str(value)[:255],
+                                      number=value if isinstance(value, int) else None))
+        if len(rows) >= 1000:
+            FileAttribute.objects.using(db_alias).bulk_create(rows)
+            rows = []
+    FileAttribute.objects.using(db_alias).bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uiapp', '0010_session_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileAttribute',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('value', models.CharField(max_length=255)),
+                ('number', models.BigIntegerField(blank=True, default=None, null=True)),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attributes', to='uiapp.UploadedFile')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='fileattribute',
+            index=models.Index(fields=['name', 'value'], name='fileattribute_value_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fileattribute',
+            index=models.Index(fields=['name', 'number'], name='fileattribute_number_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='fileattribute',
+            constraint=models.UniqueConstraint(fields=('file', 'name'), name='fileattribute_file_name_uniq'),
+        ),
+        migrations.RunPython(parse_file_names, migrations.RunPython.noop),
+    ]
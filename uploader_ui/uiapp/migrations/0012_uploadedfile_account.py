@@ -0,0 +1,26 @@
+# Generated by Django 3.0 on 2026-10-18 02:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uiapp', '0011_file_attributes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='account_id',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.RemoveConstraint(
+            model_name='uploadedfile',
+            name='uploadedfile_session_path_uniq',
+        ),
+        migrations.AddConstraint(
+            model_name='uploadedfile',
+            constraint=models.UniqueConstraint(fields=('session', 'original_path', 'account_id'), name='uploadedfile_session_path_account_uniq'),
+        ),
+    ]
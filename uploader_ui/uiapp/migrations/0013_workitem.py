@@ -0,0 +1,38 @@
+# Generated by Django 3.0 on 2026-10-18 02:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uiapp', '0012_uploadedfile_account'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=1000, unique=True)),
+                ('name', models.CharField(max_length=500)),
+                ('size', models.BigIntegerField(blank=True, default=None, null=True)),
+                ('content_hash', models.CharField(blank=True, default=None, max_length=64, null=True)),
+                ('status', models.IntegerField(choices=[(0, 'pending'), (1, 'leased'), (2, 'done'), (3, 'failed')], default=0)),
+                ('worker', models.CharField(blank=True, default='', max_length=255)),
+                ('lease_token', models.CharField(blank=True, default='', max_length=32)),
+                ('lease_expires_at', models.DateTimeField(blank=True, default=None, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='workitem',
+            index=models.Index(fields=['status', 'id'], name='workitem_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='workitem',
+            index=models.Index(fields=['lease_token'], name='workitem_lease_token_idx'),
+        ),
+    ]
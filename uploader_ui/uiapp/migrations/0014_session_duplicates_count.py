@@ -0,0 +1,30 @@
+# Generated by Django 3.0 on 2026-10-18 03:10
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_duplicates(apps, schema_editor):
+    ScanningSession = apps.get_model('uiapp', 'ScanningSession')
+    UploadedFile = apps.get_model('uiapp', 'UploadedFile')
+    db_alias = schema_editor.connection.alias
+    counters = UploadedFile.objects.using(db_alias).filter(duplicate_of__isnull=False).values('session_id') \
+        .annotate(duplicates_count=Count('id')).order_by()
+    for c in counters:
+        ScanningSession.objects.using(db_alias).filter(pk=c['session_id']).update(duplicates_count=c['duplicates_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uiapp', '0013_workitem'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scanningsession',
+            name='duplicates_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_duplicates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.0 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uiapp', '0014_session_duplicates_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DuplicatedJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('template_id', models.CharField(max_length=255)),
+                ('job', models.CharField(max_length=255)),
+                ('campaign_id', models.CharField(max_length=255)),
+                ('adset_id', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('template_id', 'job')},
+            },
+        ),
+        migrations.CreateModel(
+            name='DuplicatedVideo',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('template_id', models.CharField(max_length=255)),
+                ('video_id', models.CharField(max_length=255)),
+                ('name', models.CharField(max_length=500)),
+                ('adset_id', models.CharField(blank=True, default=None, max_length=255, null=True)),
+                ('ad_id', models.CharField(blank=True, default=None, max_length=255, null=True)),
+                ('error', models.TextField(blank=True, default=None, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('template_id', 'video_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.0 on 2026-10-18 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uiapp', '0015_duplicatedjob_duplicatedvideo'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['session', 'status'], name='uploadedfile_sess_status_idx'),
+        ),
+    ]
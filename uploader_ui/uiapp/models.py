@@ -9,14 +9,32 @@ class ScanningSession(models.Model):
     ]
 
     created_at = models.DateTimeField(auto_now_add=True)
-    last_modified_at = models.DateTimeField(auto_now=True)
+    last_modified_at = models.DateTimeField(auto_now=True, db_index=True)
     status = models.IntegerField(choices=statuses)
     session_error = models.CharField(max_length=255, null=True, default=None, blank=True)
+    # kept up to date by storage as files are recorded, so sessions list does not count files
+    videos_count = models.IntegerField(default=0)
+    uploaded_count = models.IntegerField(default=0)
+    ready_count = models.IntegerField(default=0)
+    error_count = models.IntegerField(default=0)
+    duplicates_count = models.IntegerField(default=0)
 
     def __str__(self):
         return f"session #{self.pk }at {self.created_at}"
 
 
+class UploadedFileQuerySet(models.QuerySet):
+    def with_attributes(self, **attributes) -> 'UploadedFileQuerySet':
+        """
+        Files having all given name attributes, e.g. with_attributes(Job=320, **{'Geo-Targeting': 'US'}).
+        Every attribute is looked up by (name, value) index
+        """
+        qs = self
+        for name, value in attributes.items():
+            qs = qs.filter(pk__in=FileAttribute.objects.filter(name=name, value=str(value)).values('file_id'))
+        return qs
+
+
 class UploadedFile(models.Model):
     original_path = models.CharField(max_length=1000)
     file_id = models.CharField(max_length=255)
@@ -24,9 +42,187 @@ class UploadedFile(models.Model):
     status = models.CharField(max_length=255, default=None, null=True, blank=True)
     name = models.CharField(max_length=500)
     session = models.ForeignKey(ScanningSession, on_delete=models.PROTECT)
+    duplicate_of = models.CharField(max_length=1000, default=None, null=True, blank=True)
+    # ad account of the video, empty for files recorded before uploading to several accounts
+    account_id = models.CharField(max_length=255, default='', blank=True)
+
+    objects = UploadedFileQuerySet.as_manager()
+
+    class Meta:
+        # every listed file is recorded once per session and account: uploaded, linked or failed
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'original_path', 'account_id'],
+                                    name='uploadedfile_session_path_account_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['file_id'], name='uploadedfile_file_id_idx'),
+            models.Index(fields=['session', '-id'], name='uploadedfile_session_id_idx'),
+            models.Index(fields=['name'], name='uploadedfile_name_idx'),
+            models.Index(fields=['status'], name='uploadedfile_status_idx'),
+            models.Index(fields=['session', 'status'], name='uploadedfile_sess_status_idx'),
+        ]
 
     def __str__(self):
         return f"file #{self.file_id} created {self.created_at}"
 
 
+class IndexedVideo(models.Model):
+    account_id = models.CharField(max_length=255)
+    video_id = models.CharField(max_length=255)
+    name = models.CharField(max_length=500, default=None, null=True, blank=True)
+    status = models.CharField(max_length=255, default=None, null=True, blank=True)
+    created_time = models.DateTimeField(default=None, null=True, blank=True)
+
+    class Meta:
+        unique_together = [('account_id', 'video_id')]
+
+    def __str__(self):
+        return f"video #{self.video_id} of {self.account_id}"
+
+
+class VideoUploadSession(models.Model):
+    key = models.CharField(max_length=1000, unique=True)
+    account_id = models.CharField(max_length=255)
+    upload_session_id = models.CharField(max_length=255)
+    video_id = models.CharField(max_length=255)
+    file_size = models.BigIntegerField()
+    start_offset = models.BigIntegerField()
+    end_offset = models.BigIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"upload session #{self.upload_session_id} at {self.start_offset} of {self.file_size}"
+
+
+class IndexSync(models.Model):
+    account_id = models.CharField(max_length=255, unique=True)
+    last_created_time = models.DateTimeField()
+    synced_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.account_id} synced at {self.synced_at}"
+
+
+class ListingCursor(models.Model):
+    root = models.CharField(max_length=1000)
+    path = models.CharField(max_length=1000)
+    cursor = models.TextField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [('root', 'path')]
+
+    def __str__(self):
+        return f"cursor of {self.path} saved at {self.updated_at}"
+
+
+class ContentHashLink(models.Model):
+    account_id = models.CharField(max_length=255)
+    content_hash = models.CharField(max_length=64)
+    video_id = models.CharField(max_length=255)
+    path = models.CharField(max_length=1000)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = [('account_id', 'content_hash', 'path')]
+
+    def __str__(self):
+        return f"{self.path} linked to video #{self.video_id}"
 
+
+class FileAttribute(models.Model):
+    """
+    Key=Value attribute of uploaded file name, number is set for numeric values
+    """
+    file = models.ForeignKey(UploadedFile, on_delete=models.CASCADE, related_name='attributes')
+    name = models.CharField(max_length=255)
+    value = models.CharField(max_length=255)
+    number = models.BigIntegerField(default=None, null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['file', 'name'], name='fileattribute_file_name_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['name', 'value'], name='fileattribute_value_idx'),
+            models.Index(fields=['name', 'number'], name='fileattribute_number_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name}={self.value} of file #{self.file_id}"
+
+
+class WorkItem(models.Model):
+    """
+    File queued by `load --enqueue` and leased by `load --worker` processes,
+    a lease which is not renewed until lease_expires_at lets other workers take the file
+    """
+    STATUS_PENDING = 0
+    STATUS_LEASED = 1
+    STATUS_DONE = 2
+    STATUS_FAILED = 3
+    statuses = [
+        (STATUS_PENDING, 'pending'),
+        (STATUS_LEASED, 'leased'),
+        (STATUS_DONE, 'done'),
+        (STATUS_FAILED, 'failed'),
+    ]
+
+    path = models.CharField(max_length=1000, unique=True)
+    name = models.CharField(max_length=500)
+    size = models.BigIntegerField(default=None, null=True, blank=True)
+    content_hash = models.CharField(max_length=64, default=None, null=True, blank=True)
+    status = models.IntegerField(choices=statuses, default=STATUS_PENDING)
+    worker = models.CharField(max_length=255, default='', blank=True)
+    # identifies files taken by one lease query
+    lease_token = models.CharField(max_length=32, default='', blank=True)
+    lease_expires_at = models.DateTimeField(default=None, null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id'], name='workitem_status_idx'),
+            models.Index(fields=['lease_token'], name='workitem_lease_token_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.path} {self.get_status_display()}"
+
+
+class DuplicatedJob(models.Model):
+    """
+    Campaign copied from the template campaign for a Job, its first ad set is copied for every video of the job
+    """
+    template_id = models.CharField(max_length=255)
+    job = models.CharField(max_length=255)
+    campaign_id = models.CharField(max_length=255)
+    adset_id = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = [('template_id', 'job')]
+
+    def __str__(self):
+        return f"campaign {self.campaign_id} of job {self.job}"
+
+
+class DuplicatedVideo(models.Model):
+    """
+    Ad set copied for a ready video, ad_id is set once its ad is created
+    """
+    template_id = models.CharField(max_length=255)
+    video_id = models.CharField(max_length=255)
+    name = models.CharField(max_length=500)
+    adset_id = models.CharField(max_length=255, default=None, null=True, blank=True)
+    ad_id = models.CharField(max_length=255, default=None, null=True, blank=True)
+    error = models.TextField(default=None, null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [('template_id', 'video_id')]
+
+    def __str__(self):
+        return f"ad {self.ad_id} of video #{self.video_id}"
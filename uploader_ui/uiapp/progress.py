@@ -0,0 +1,23 @@
+import os
+from typing import Optional
+
+from django.core.cache import caches
+
+from uploader_app.progress import ProgressPublisherBase
+
+
+def _key(session_id: int) -> str:
+    return f"progress:{session_id}"
+
+
+class CacheProgressPublisher(ProgressPublisherBase):
+    """
+    Keeps the latest progress snapshot of every running session in the shared progress cache
+    """
+    def publish(self, session_id: int, progress: dict):
+        caches['progress'].set(_key(session_id), {'session': session_id, **progress},
+                               int(os.getenv('PROGRESS_TTL', '3600')))
+
+
+def get_progress(session_id: int) -> Optional[dict]:
+    return caches['progress'].get(_key(session_id))
@@ -1,3 +1,327 @@
-from django.test import TestCase
+from datetime import datetime, timezone
 
-# Create your tests here.
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from uploader_app.pattern import parse_attributes
+from uploader_app.source import DropBoxFile
+from uploader_app.uploader import UploadedVideo
+from .appstorage import BufferedDjangoStorage, DjangoStorage, DjangoVideoIndexStorage, DjangoListingCursorStorage, \
+    DjangoContentHashStorage, DjangoWorkQueue, DjangoAdDuplicationStorage
+from .models import ScanningSession, UploadedFile, FileAttribute, WorkItem
+from .progress import CacheProgressPublisher
+from .views import SESSION_PAGE_SIZE
+
+
+class DjangoVideoIndexStorageTest(TestCase):
+    def test_save_and_load(self):
+        storage = DjangoVideoIndexStorage()
+        t = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        storage.save_videos("act_1", [UploadedVideo("1", "a.mp4", "processing", t), UploadedVideo("2", "b.mp4")])
+        storage.save_videos("act_1", [UploadedVideo("1", "a.mp4", "ready", t)])
+        storage.save_videos("act_2", [UploadedVideo("3", "c.mp4")])
+        storage.delete_video("act_1", "2")
+
+        videos = storage.load_videos("act_1")
+        self.assertEqual([(v.id, v.name, v.status, v.created_time) for v in videos], [("1", "a.mp4", "ready", t)])
+
+        self.assertIsNone(storage.get_last_created_time("act_1"))
+        storage.set_last_created_time("act_1", t)
+        self.assertEqual(storage.get_last_created_time("act_1"), t)
+        storage.clear("act_1")
+        self.assertIsNone(storage.get_last_created_time("act_1"))
+        self.assertEqual(storage.load_videos("act_1"), [])
+        self.assertEqual(len(storage.load_videos("act_2")), 1)
+
+
+class DjangoStorageTest(TestCase):
+    def test_pending_videos(self):
+        storage = DjangoStorage()
+        session_id = storage.create_session_id()
+        storage.create_video(session_id, "1", "a.mp4", "/J1_/a.mp4")
+        storage.create_video(session_id, "2", "b.mp4", "/J1_/b.mp4", "processing")
+        storage.create_video(session_id, "3", "c.mp4", "/J1_/c.mp4", "ready")
+        storage.create_video(session_id, "", "d.mp4", "/J1_/d.mp4", "error")
+        self.assertEqual(sorted(storage.get_pending_videos()), [("1", None), ("2", "processing")])
+        storage.update_video_status("1", "ready")
+        self.assertEqual(storage.get_pending_videos(), [("2", "processing")])
+
+    def test_duplicates_share_status(self):
+        storage = DjangoStorage()
+        session_id = storage.create_session_id()
+        storage.create_video(session_id, "1", "a.mp4", "/J1_/a.mp4")
+        storage.create_video(session_id, "1", "b.mp4", "/J2_/b.mp4", duplicate_of="/J1_/a.mp4")
+        self.assertEqual(storage.get_pending_videos(), [("1", None)])
+        storage.update_video_status("1", "ready")
+        self.assertEqual(storage.get_pending_videos(), [])
+
+    def test_session_counters(self):
+        storage = DjangoStorage()
+        session_id = storage.create_session_id()
+        storage.create_video(session_id, "1", "a.mp4", "/J1_/a.mp4")
+        storage.create_video(session_id, "1", "b.mp4", "/J2_/b.mp4", duplicate_of="/J1_/a.mp4")
+        storage.create_video(session_id, "2", "c.mp4", "/J1_/c.mp4", "processing")
+        storage.create_video(session_id, "", "d.mp4", "/J1_/d.mp4", "error")
+        storage.update_video_status("1", "ready")
+        storage.update_video_status("1", "ready")
+        storage.update_video_status("2", "error")
+        s = ScanningSession.objects.get(pk=session_id)
+        self.assertEqual((s.videos_count, s.uploaded_count, s.ready_count, s.error_count), (4, 3, 2, 2))
+        storage.update_video_status("1", "processing")
+        s = ScanningSession.objects.get(pk=session_id)
+        self.assertEqual((s.ready_count, s.error_count), (0, 2))
+
+    def test_attributes(self):
+        storage = DjangoStorage()
+        session_id = storage.create_session_id()
+        storage.create_video(session_id, "1", "a.mp4", "/J1_/a.mp4", attributes={"Job": 320, "Geo-Targeting": "US"})
+        storage.create_video(session_id, "2", "b.mp4", "/J1_/b.mp4", attributes={"Job": 320, "Geo-Targeting": "CA"})
+        storage.create_video(session_id, "3", "c.mp4", "/J1_/c.mp4", attributes={"Job": 321, "Geo-Targeting": "US"})
+        files = UploadedFile.objects.with_attributes(Job=320, **{"Geo-Targeting": "US"})
+        self.assertEqual(list(files.values_list("file_id", flat=True)), ["1"])
+        self.assertEqual(FileAttribute.objects.filter(name="Job", number__gte=321).count(), 1)
+
+
+class DjangoListingCursorStorageTest(TestCase):
+    def test_save_and_clear(self):
+        storage = DjangoListingCursorStorage()
+        storage.save_cursor("/Jobs", "/jobs/j1_", "c1")
+        storage.save_cursor("/Jobs", "/jobs/j1_", "c2")
+        storage.save_cursor("/Other", "/other/j1_", "c3")
+        self.assertEqual(storage.get_cursors("/Jobs"), {"/jobs/j1_": "c2"})
+        storage.clear_cursors("/Jobs")
+        self.assertEqual(storage.get_cursors("/Jobs"), {})
+        self.assertEqual(storage.get_cursors("/Other"), {"/other/j1_": "c3"})
+
+
+class DjangoContentHashStorageTest(TestCase):
+    def test_links(self):
+        storage = DjangoContentHashStorage()
+        storage.add_link("act_1", "h1", "10", "/J1_/a.mp4")
+        storage.add_link("act_1", "h1", "10", "/J2_/b.mp4")
+        storage.add_link("act_1", "h1", "10", "/J1_/a.mp4")
+        storage.add_link("act_2", "h1", "20", "/J1_/a.mp4")
+        self.assertEqual(storage.get_links("act_1", "h1"), [("10", "/J1_/a.mp4"), ("10", "/J2_/b.mp4")])
+        storage.delete_links("act_1", "h1")
+        self.assertEqual(storage.get_links("act_1", "h1"), [])
+        self.assertEqual(storage.get_links("act_2", "h1"), [("20", "/J1_/a.mp4")])
+
+
+class DjangoAdDuplicationStorageTest(TestCase):
+    def test_jobs(self):
+        storage = DjangoAdDuplicationStorage()
+        self.assertIsNone(storage.get_job_adset("tpl", "320"))
+        storage.save_job_adset("tpl", "320", "c1", "s1")
+        storage.save_job_adset("other", "320", "c2", "s2")
+        self.assertEqual(storage.get_job_adset("tpl", "320"), "s1")
+
+    def test_video_ads(self):
+        storage = DjangoAdDuplicationStorage()
+        self.assertEqual(storage.get_video_ad("tpl", "v1"), (None, None))
+        storage.video_failed("tpl", "v1", "a.mp4", "no ad set")
+        storage.save_video_ad("tpl", "v2", "b.mp4", "s2")
+        storage.video_failed("tpl", "v2", "b.mp4", "creative failed")
+        storage.save_video_ad("tpl", "v3", "c.mp4", "s3", "ad3")
+        self.assertEqual(storage.get_video_ad("tpl", "v2"), ("s2", None))
+        self.assertEqual(storage.get_video_ad("tpl", "v3"), ("s3", "ad3"))
+        self.assertEqual(storage.get_failed("tpl", 3), [("v1", "a.mp4"), ("v2", "b.mp4")])
+        storage.video_failed("tpl", "v1", "a.mp4", "no ad set")
+        self.assertEqual(storage.get_failed("tpl", 2), [("v2", "b.mp4")])
+        self.assertEqual(storage.get_failed("other", 3), [])
+
+
+def work_files(*names, content_hash="h1"):
+    return [DropBoxFile(n, f"/J1_/{n}", 10, content_hash) for n in names]
+
+
+def work_statuses():
+    return dict(WorkItem.objects.values_list('name', 'status'))
+
+
+class DjangoWorkQueueTest(TestCase):
+    def test_lease(self):
+        queue = DjangoWorkQueue()
+        self.assertEqual(queue.enqueue(work_files("a.mp4", "b.mp4", "c.mp4")), 3)
+        self.assertEqual([f.name for f in queue.lease("w1", 2, 60)], ["a.mp4", "b.mp4"])
+        leased = queue.lease("w2", 5, 60)
+        self.assertEqual([(f.name, f.path, f.size, f.content_hash) for f in leased], [("c.mp4", "/J1_/c.mp4", 10, "h1")])
+        self.assertEqual(queue.lease("w3", 5, 60), [])
+        self.assertFalse(queue.has_work())
+
+        self.assertEqual(sorted(queue.renew("w1", ["/J1_/a.mp4", "/J1_/b.mp4", "/J1_/c.mp4"], 60)),
+                         ["/J1_/a.mp4", "/J1_/b.mp4"])
+        queue.complete("w1", "/J1_/a.mp4", False)
+        queue.complete("w2", "/J1_/c.mp4", True)
+        queue.release("w1", ["/J1_/b.mp4"])
+        self.assertEqual(work_statuses(), {"a.mp4": WorkItem.STATUS_DONE, "b.mp4": WorkItem.STATUS_PENDING,
+                                           "c.mp4": WorkItem.STATUS_PENDING})
+        self.assertEqual(dict(WorkItem.objects.values_list('name', 'attempts')), {"a.mp4": 1, "b.mp4": 0, "c.mp4": 1})
+        self.assertTrue(queue.has_work())
+
+    def test_expired_lease(self):
+        queue = DjangoWorkQueue(max_attempts=2)
+        queue.enqueue(work_files("a.mp4"))
+        queue.lease("w1", 1, -1)
+        self.assertTrue(queue.has_work())
+        self.assertEqual(len(queue.lease("w2", 1, -1)), 1)
+        # the file is taken over by w2, w1 does not hold it anymore
+        self.assertEqual(queue.renew("w1", ["/J1_/a.mp4"], 60), [])
+        queue.complete("w1", "/J1_/a.mp4", False)
+        self.assertEqual(work_statuses(), {"a.mp4": WorkItem.STATUS_LEASED})
+        # both attempts expired
+        self.assertEqual(queue.lease("w3", 1, 60), [])
+        self.assertEqual(work_statuses(), {"a.mp4": WorkItem.STATUS_FAILED})
+
+    def test_failed_after_attempts(self):
+        queue = DjangoWorkQueue(max_attempts=1)
+        queue.enqueue(work_files("a.mp4"))
+        queue.lease("w1", 1, 60)
+        queue.complete("w1", "/J1_/a.mp4", True)
+        self.assertEqual(work_statuses(), {"a.mp4": WorkItem.STATUS_FAILED})
+        self.assertFalse(queue.has_work())
+
+    def test_enqueue_again(self):
+        queue = DjangoWorkQueue(max_attempts=1)
+        queue.enqueue(work_files("a.mp4", "b.mp4", "c.mp4", "d.mp4"))
+        queue.lease("w1", 4, 60)
+        for path, failed in [("/J1_/a.mp4", False), ("/J1_/b.mp4", False), ("/J1_/c.mp4", True)]:
+            queue.complete("w1", path, failed)
+
+        # done file with the same content and leased file are not queued again
+        self.assertEqual(queue.enqueue(work_files("a.mp4", "d.mp4") + work_files("b.mp4", "c.mp4", content_hash="h2")
+                                       + work_files("e.mp4")), 3)
+        self.assertEqual(work_statuses(), {"a.mp4": WorkItem.STATUS_DONE, "b.mp4": WorkItem.STATUS_PENDING,
+                                           "c.mp4": WorkItem.STATUS_PENDING, "d.mp4": WorkItem.STATUS_LEASED,
+                                           "e.mp4": WorkItem.STATUS_PENDING})
+        self.assertEqual(sorted(f.name for f in queue.lease("w2", 5, 60)), ["b.mp4", "c.mp4", "e.mp4"])
+
+
+class BufferedDjangoStorageTest(TestCase):
+    def test_writes_are_batched(self):
+        storage = BufferedDjangoStorage(batch_size=3, flush_interval=3600)
+        session_id = storage.create_session_id()
+        storage.create_video(session_id, "1", "a.mp4", "/J1_/a.mp4")
+        storage.create_video(session_id, "2", "b.mp4", "/J1_/b.mp4")
+        self.assertEqual(UploadedFile.objects.count(), 0)
+        storage.update_video_status("1", "processing")
+        self.assertEqual(sorted(UploadedFile.objects.values_list("file_id", "status")),
+                         [("1", "processing"), ("2", None)])
+
+        storage.update_video_status("1", "ready")
+        storage.create_video(session_id, "3", "c.mp4", "/J1_/c.mp4")
+        self.assertEqual(sorted(storage.get_pending_videos()), [("2", None), ("3", None)])
+        storage.update_video_status("2", "ready")
+        storage.close()
+        self.assertEqual(storage.get_pending_videos(), [("3", None)])
+        s = ScanningSession.objects.get(pk=session_id)
+        self.assertEqual((s.videos_count, s.uploaded_count, s.ready_count, s.error_count), (3, 3, 2, 0))
+
+    def test_attributes(self):
+        storage = BufferedDjangoStorage(batch_size=10, flush_interval=3600)
+        session_id = storage.create_session_id()
+        storage.create_video(session_id, "1", "a.mp4", "/J1_/a.mp4", attributes={"Job": 1, "Geo-Targeting": "US"})
+        storage.create_video(session_id, "2", "b.mp4", "/J1_/b.mp4")
+        storage.create_video(session_id, "3", "c.mp4", "/J1_/c.mp4", attributes={"Job": 1})
+        storage.close()
+        self.assertEqual(sorted(UploadedFile.objects.with_attributes(Job=1).values_list("file_id", flat=True)),
+                         ["1", "3"])
+        self.assertEqual(FileAttribute.objects.count(), 3)
+
+    def test_attributes_out_of_number_range(self):
+        storage = BufferedDjangoStorage(batch_size=10, flush_interval=3600)
+        session_id = storage.create_session_id()
+        name = "Job=\u00b2_Copy=99999999999999999999_Length=27.mp4"
+        storage.create_video(session_id, "1", name, "/J1_/" + name, attributes=parse_attributes(name))
+        storage.close()
+        self.assertEqual(sorted(FileAttribute.objects.values_list("name", "value", "number")),
+                         [("Copy", "99999999999999999999", None), ("Job", "\u00b2", None), ("Length", "27", 27)])
+
+    def test_file_of_several_accounts(self):
+        storage = BufferedDjangoStorage(batch_size=10, flush_interval=3600)
+        session_id = storage.create_session_id()
+        storage.create_video(session_id, "1", "a.mp4", "/J1_/a.mp4", attributes={"Job": 1}, account_id="act_1")
+        storage.create_video(session_id, "2", "a.mp4", "/J1_/a.mp4", attributes={"Job": 1}, account_id="act_2")
+        storage.create_video(session_id, "2", "a.mp4", "/J1_/a.mp4", account_id="act_2")
+        storage.flush()
+        # already stored file is not counted again
+        storage.create_video(session_id, "2", "a.mp4", "/J1_/a.mp4", "error", account_id="act_2")
+        storage.close()
+        self.assertEqual(sorted(UploadedFile.objects.with_attributes(Job=1).values_list("account_id", "file_id")),
+                         [("act_1", "1"), ("act_2", "2")])
+        s = ScanningSession.objects.get(pk=session_id)
+        self.assertEqual((s.videos_count, s.uploaded_count, s.error_count), (2, 2, 0))
+
+
+class ViewSessionTest(TestCase):
+    def test_pages(self):
+        storage = DjangoStorage()
+        session_id = storage.create_session_id()
+        total = SESSION_PAGE_SIZE * 2 + 5
+        for i in range(total):
+            storage.create_video(session_id, str(i), f"{i}.mp4", f"/J1_/{i}.mp4", "ready" if i % 5 else None,
+                                 duplicate_of="/J1_/0.mp4" if i == 7 else None)
+
+        seen = []
+        before = ""
+        while True:
+            r = self.client.get(f"/session/{session_id}{before}")
+            self.assertEqual(r.context["videos_len"], total)
+            self.assertEqual(r.context["duplicates_len"], 1)
+            self.assertEqual([(s["status"], s["count"]) for s in r.context["statuses"]], [(None, 41), ("ready", 164)])
+            seen.extend(v.file_id for v in r.context["videos"])
+            if r.context["next_before"] is None:
+                break
+            before = f"?before={r.context['next_before']}"
+        self.assertEqual(seen, [str(i) for i in reversed(range(total))])
+
+    def test_query_count_does_not_depend_on_size(self):
+        storage = DjangoStorage()
+        session_id = storage.create_session_id()
+        for i in range(SESSION_PAGE_SIZE * 3):
+            storage.create_video(session_id, str(i), f"{i}.mp4", f"/J1_/{i}.mp4")
+        # the session with its counters, files by status and one page of files
+        with self.assertNumQueries(3):
+            self.client.get(f"/session/{session_id}")
+
+
+class SessionsListTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_cached_until_session_changes(self):
+        storage = DjangoStorage()
+        session_id = storage.create_session_id()
+        storage.create_video(session_id, "1", "a.mp4", "/J1_/a.mp4", "ready")
+        self.assertContains(self.client.get("/"), "<td>1</td>")
+        with self.assertNumQueries(1):
+            self.client.get("/")
+        storage.create_video(session_id, "2", "b.mp4", "/J1_/b.mp4", "ready")
+        self.assertContains(self.client.get("/"), "<td>2</td>", count=3)
+
+    def test_pages(self):
+        storage = DjangoStorage()
+        ids = [storage.create_session_id() for _ in range(60)]
+        first = self.client.get("/")
+        self.assertEqual([s.pk for s in first.context["sessions"]], list(reversed(ids))[:50])
+        second = self.client.get(f"/?before={first.context['next_before']}")
+        self.assertEqual([s.pk for s in second.context["sessions"]], list(reversed(ids))[50:])
+        self.assertIsNone(second.context["next_before"])
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'progress': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'progress-test'},
+})
+class SessionProgressTest(TestCase):
+    def test_progress(self):
+        self.assertEqual(self.client.get("/session/123456/progress").status_code, 404)
+        publisher = CacheProgressPublisher()
+        publisher.publish(123456, {"uploaded": 1, "done": False})
+        self.assertEqual(self.client.get("/session/123456/progress").json(),
+                         {"session": 123456, "uploaded": 1, "done": False})
+
+        publisher.publish(123456, {"uploaded": 2, "done": True})
+        r = self.client.get("/session/123456/progress/stream")
+        self.assertEqual(r["Content-Type"], "text/event-stream")
+        self.assertEqual(b"".join(r.streaming_content).decode(),
+                         'data: {"session": 123456, "uploaded": 2, "done": true}\n\nevent: end\ndata: null\n\n')
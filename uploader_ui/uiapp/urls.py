@@ -3,5 +3,7 @@ from . import views
 
 urlpatterns = [
     path('', views.sessions_list, name='sessions_list'),
-    path('session/<int:id>', views.view_session, name='view_session')
+    path('session/<int:id>', views.view_session, name='view_session'),
+    path('session/<int:id>/progress', views.session_progress, name='session_progress'),
+    path('session/<int:id>/progress/stream', views.session_progress_stream, name='session_progress_stream'),
 ]
\ No newline at end of file
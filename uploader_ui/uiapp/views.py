@@ -1,17 +1,111 @@
-from django.db.models import Count
+import json
+import os
+import time
+
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.template.loader import render_to_string
 
 from .models import ScanningSession, UploadedFile
+from .progress import get_progress
+
+SESSION_PAGE_SIZE = 100
+SESSIONS_LIST_PAGE_SIZE = 50
+
+
+def _get_before(request):
+    before = request.GET.get('before')
+    return int(before) if before is not None and before.isdigit() else None
 
 
 def sessions_list(request):
-    sessions = ScanningSession.objects.all().annotate(videos_count=Count("uploadedfile")).order_by('-pk')
-    return render(request, 'sessions_list.html', {"sessions":sessions})
+    """
+    Rendered pages are cached for SESSIONS_CACHE_TTL seconds. Cache key contains the latest session modification time,
+    which storage bumps with every counter change, so a changed session is shown without waiting for the ttl
+    """
+    before = _get_before(request)
+    state = ScanningSession.objects.aggregate(last_modified_at=Max('last_modified_at'), count=Count('id'))
+    modified = state['last_modified_at'].timestamp() if state['last_modified_at'] is not None else 0
+    key = f"sessions_list:{before}:{modified}:{state['count']}"
+    html = cache.get(key)
+    if html is None:
+        sessions = ScanningSession.objects.order_by('-pk')
+        if before is not None:
+            sessions = sessions.filter(pk__lt=before)
+        sessions = list(sessions[:SESSIONS_LIST_PAGE_SIZE + 1])
+        next_before = sessions[SESSIONS_LIST_PAGE_SIZE - 1].pk if len(sessions) > SESSIONS_LIST_PAGE_SIZE else None
+        html = render_to_string('sessions_list.html', {"sessions": sessions[:SESSIONS_LIST_PAGE_SIZE],
+                                                       "next_before": next_before,
+                                                       "is_first_page": before is None}, request)
+        cache.set(key, html, int(os.getenv('SESSIONS_CACHE_TTL', '10')))
+    return HttpResponse(html)
 
 def view_session(request, id):
+    """
+    Shows SESSION_PAGE_SIZE newest files of the session with pk below ?before= parameter,
+    so a page is read by the (session, -id) index whatever the size of the session is
+    """
     try:
         session = ScanningSession.objects.get(pk=id)
-        videos = UploadedFile.objects.filter(session=session).order_by('-pk')
-        return render(request, 'view_session.html', {"session":session,"videos":videos,"videos_len":len(videos)})
     except ScanningSession.DoesNotExist:
         return render(request, 'not_found.html')
+    # totals are read from the session counters kept by storage, statuses are grouped by the (session, status) index
+    files = UploadedFile.objects.filter(session=session)
+    statuses = files.values('status').annotate(count=Count('id')).order_by('status')
+    page = files.order_by('-pk').only('pk', 'created_at', 'original_path', 'file_id', 'account_id', 'status', 'name',
+                                      'duplicate_of')
+    before = _get_before(request)
+    if before is not None:
+        page = page.filter(pk__lt=before)
+    videos = list(page[:SESSION_PAGE_SIZE + 1])
+    next_before = videos[SESSION_PAGE_SIZE - 1].pk if len(videos) > SESSION_PAGE_SIZE else None
+    return render(request, 'view_session.html', {"session": session, "videos": videos[:SESSION_PAGE_SIZE],
+                                                 "statuses": statuses, "next_before": next_before,
+                                                 "is_first_page": before is None,
+                                                 "videos_len": session.videos_count,
+                                                 "duplicates_len": session.duplicates_count})
+
+
+def session_progress(request, id):
+    """
+    The latest progress published by the uploader running the session
+    """
+    progress = get_progress(id)
+    if progress is None:
+        return JsonResponse({'session': id, 'error': 'no progress published for the session'}, status=404)
+    return JsonResponse(progress)
+
+
+def session_progress_stream(request, id):
+    """
+    Server-Sent Events with every new progress of the session, the stream ends with 'end' event
+    once the session is finished or if it has no published progress
+    """
+    interval = float(os.getenv('PROGRESS_STREAM_INTERVAL', '1'))
+    keepalive = 15
+
+    def events():
+        last = None
+        idle = 0.0
+        while True:
+            progress = get_progress(id)
+            if progress is None or progress.get('done'):
+                if progress is not None and progress != last:
+                    yield f"data: {json.dumps(progress)}\n\n"
+                yield "event: end\ndata: null\n\n"
+                return
+            if progress != last:
+                yield f"data: {json.dumps(progress)}\n\n"
+                last = progress
+                idle = 0.0
+            elif idle >= keepalive:
+                yield ": keepalive\n\n"
+                idle = 0.0
+            time.sleep(interval)
+            idle += interval
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
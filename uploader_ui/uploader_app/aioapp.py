@@ -0,0 +1,383 @@
+import asyncio
+import logging
+import os
+from typing import AsyncIterator, List, Optional, Tuple, Union
+
+from .aioloop import in_thread
+from .aiosource import AsyncSourceBase
+from .aiouploader import AsyncUploaderBase
+from .app import upload_key
+from .bookkeeping import FileTask, RunBook, account_label, route_file, record_uploaded, record_duplicate, \
+    record_failed
+from .duplicator import DuplicatorBase
+from .pattern import match_file
+from .progress import Progress, ProgressPublisherBase, ProgressTracker
+from .retry import RetryPolicy, classify_error, ERROR_PERMANENT
+from .routing import AccountRouter, DEFAULT_ACCOUNT
+from .source import FileInfoBase
+from .storage import StorageBase
+from .tempspace import TempSpace
+from .uploader import UploadedVideo, VIDEO_STATUS_READY, VIDEO_STATUS_ERROR
+
+
+class AsyncUploader:
+    """
+    Uploader driven by a single event loop: listing, transfers, retry delays and encoding polls are coroutines.
+    Transfers are limited by DOWNLOAD_PARALLELISM and UPLOAD_PARALLELISM semaphores instead of thread pools,
+    blocking storage calls run in the default executor
+    """
+    def __init__(self,
+                 storage: StorageBase,
+                 source: AsyncSourceBase,
+                 uploader: Union[AsyncUploaderBase, AccountRouter],
+                 tmp_dir: str,
+                 retry_policy: RetryPolicy = None,
+                 progress_publisher: ProgressPublisherBase = None,
+                 duplicator: DuplicatorBase = None
+                 ):
+        """
+        :param uploader: uploader of a single account or router of files to async uploaders of several accounts
+        :param progress_publisher: receives progress of running session every PROGRESS_PUBLISH_INTERVAL seconds
+        :param duplicator: creates ads of videos which encoding is finished while waiting for encoding
+        """
+        self._storage = storage
+        self._source = source
+        self._router = uploader if isinstance(uploader, AccountRouter) else AccountRouter({DEFAULT_ACCOUNT: uploader})
+        self._temp = TempSpace(tmp_dir)
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._progress_publisher = progress_publisher
+        self._progress = Progress()
+        self._duplicator = duplicator
+        self._link_mode = False
+        self._book = RunBook()
+        self._download_slots = None  # type: Optional[asyncio.Semaphore]
+        self._upload_slots = None  # type: Optional[asyncio.Semaphore]
+        self._space = None  # type: Optional[asyncio.Condition]  notified when temporary space is released
+
+    async def _filter_file(self, session_id: int, file: FileInfoBase) -> Optional[FileTask]:
+        self._progress.add('listed')
+        if not match_file(file):
+            # most of listed entries, not formatted unless debug logging is on
+            logging.debug("Skip not matching: %s", file.name)
+            await self._source.file_done(file, False)
+            return None
+        content_hash = getattr(file, 'content_hash', None)
+        self._book.hold(file)
+        targets = [a for a in route_file(self._router, file)
+                   if content_hash is None or not await self._link_duplicate(session_id, a, file, content_hash)]
+        if len(targets) == 0:
+            await self._file_done(file)
+            return None
+        task = FileTask(file, targets)
+        self._book.add_task(task)
+        self._progress.add('queued')
+        return task
+
+    async def _link_duplicate(self, session_id: int, account: str, file: FileInfoBase, content_hash: str) -> bool:
+        """
+        Links file to a video of the account with the same content uploaded by this or previous runs
+        :return: True if file does not have to be uploaded to the account
+        """
+        original = self._book.find_original(account, file, content_hash)
+        if original is not None:
+            video_id, path = original
+            if video_id is not None:
+                await self._save_duplicate(session_id, account, file, content_hash, video_id, path)
+            return True
+        found = await self._router.get(account).get_by_content_hash(content_hash)
+        if found is None:
+            return False
+        video, paths = found
+        if file.path in paths:
+            logging.info(f"Skip: {file.name} is already linked to video {video.id}")
+            return True
+        await self._save_duplicate(session_id, account, file, content_hash, video.id, paths[0])
+        return True
+
+    async def _save_duplicate(self, session_id: int, account: str, file: FileInfoBase, content_hash: str,
+                              video_id: str, duplicate_of: str):
+        await self._router.get(account).link_content(content_hash, video_id, file.path)
+        await in_thread(record_duplicate, self._storage, session_id, account, file, video_id, duplicate_of)
+        self._book.add_duplicate()
+        self._progress.add('linked')
+
+    async def _file_done(self, file: FileInfoBase, failed: bool = False):
+        """
+        Releases a hold of the file, the source is told the file is done once its last hold is released
+        """
+        any_failed = self._book.release(file, failed)
+        if any_failed is not None:
+            await self._source.file_done(file, any_failed)
+
+    async def _reserve(self, file: FileInfoBase) -> str:
+        async with self._space:
+            while True:
+                path = self._temp.try_reserve(file.name, getattr(file, 'size', None))
+                if path is not None:
+                    return path
+                await self._space.wait()
+
+    async def _release(self, task: FileTask):
+        if task.local_path is not None:
+            self._temp.release(task.local_path)
+            task.local_path = None
+            async with self._space:
+                self._space.notify_all()
+
+    async def _download(self, task: FileTask):
+        file = task.file
+        task.local_path = await self._reserve(file)
+        logging.info(f"Downloading: {file.name}")
+        await self._source.download_file(file, task.local_path)
+        logging.info(f"Successful download: {file.name}")
+        self._progress.add('downloaded')
+        self._progress.add('bytes_downloaded', os.path.getsize(task.local_path))
+
+    async def _upload_url(self, session_id: int, task: FileTask, account: str, url: str) -> Optional[Exception]:
+        """
+        :return: rate limit or transient error to retry, None if the video is uploaded or the link is rejected
+        """
+        file = task.file
+        try:
+            logging.info(f"Uploading by link: {file.name}{account_label(account)}")
+            video = await self._router.get(account).upload_url(url, file.name)
+        except Exception as e:
+            if classify_error(e) != ERROR_PERMANENT:
+                return e
+            logging.warning(f"Upload by link failed: {file.name}{account_label(account)} ({e}), downloading it instead")
+            return None
+        if video is None:
+            return None
+        self._progress.add('uploaded_by_link')
+        await self._save_uploaded(session_id, task, account, video)
+        return None
+
+    async def _transfer_by_link(self, session_id: int, task: FileTask) -> bool:
+        """
+        :return: False if the file has to be downloaded and uploaded to some accounts instead
+        :raise rate limit or transient error of the link or of every account left, the transfer by link is retried
+        """
+        try:
+            url = await self._source.get_link(task.file)
+        except Exception as e:
+            if classify_error(e) != ERROR_PERMANENT:
+                raise
+            logging.warning(f"Upload by link failed: {task.file.name} ({e}), downloading it instead")
+            return False
+        if url is None:
+            return False
+        errors = dict(zip(task.targets, await asyncio.gather(*(self._upload_url(session_id, task, a, url)
+                                                                for a in task.targets))))
+        task.targets = [a for a in task.targets if a not in task.videos]
+        if len(task.targets) == 0:
+            return True
+        if any(errors[a] is None for a in task.targets):
+            return False
+        raise errors[task.targets[0]]
+
+    async def _give_up(self, session_id: int, task: FileTask):
+        """
+        Records failed uploads of the file and its duplicates, the file itself is released by the caller
+        """
+        await self._release(task)
+        failed = self._book.give_up(task)
+        self._progress.add('failed', len(failed))
+        for account, f in failed:
+            await in_thread(record_failed, self._storage, session_id, account, f)
+            if f is not task.file:
+                await self._file_done(f, True)
+
+    async def _upload_to(self, session_id: int, task: FileTask, account: str) -> Optional[Exception]:
+        """
+        :return: error of a failed upload
+        """
+        file = task.file
+        try:
+            async with self._upload_slots:
+                logging.info(f"Uploading: {file.name}{account_label(account)}")
+                video = await self._router.get(account).upload(task.local_path, upload_key(file))
+        except Exception as e:
+            return e
+        self._progress.add('bytes_uploaded', os.path.getsize(task.local_path))
+        await self._save_uploaded(session_id, task, account, video)
+        return None
+
+    async def _transfer(self, session_id: int, task: FileTask) -> bool:
+        """
+        Downloads the file once and uploads it to its accounts concurrently, in link mode the file is downloaded only
+        if its link is rejected. Failed transfer or failed accounts are retried after the retry policy delay
+        :return: False if the file was given up
+        """
+        file = task.file
+        while True:
+            stage = 'download'
+            try:
+                if self._link_mode and not task.link_failed:
+                    stage = 'upload by link'
+                    async with self._download_slots:
+                        if await self._transfer_by_link(session_id, task):
+                            return True
+                    task.link_failed = True
+                    stage = 'download'
+                if task.local_path is None:
+                    async with self._download_slots:
+                        await self._download(task)
+                stage = 'upload'
+                errors = await asyncio.gather(*(self._upload_to(session_id, task, a) for a in task.targets))
+                failed = [(a, e) for a, e in zip(task.targets, errors) if e is not None]
+                task.targets = [a for a, _ in failed]
+                if len(failed) == 0:
+                    break
+                raise failed[0][1]
+            except Exception as e:
+                if stage == 'download':
+                    # partial download is deleted, the space is reserved again by the next attempt
+                    await self._release(task)
+                task.attempts += 1
+                error_class = classify_error(e)
+                if not self._retry_policy.should_retry(task.attempts, error_class):
+                    logging.error(f"{stage} failed: {file.name} ({error_class}: {e}). "
+                                  f"Giving up after {task.attempts} attempts")
+                    await self._give_up(session_id, task)
+                    return False
+                delay = self._retry_policy.delay(task.attempts, error_class)
+                logging.warning(f"{stage} failed: {file.name} ({error_class}: {e}). "
+                                f"Attempt {task.attempts} of {self._retry_policy.max_attempts}, retry in {delay:.1f}s")
+                await asyncio.sleep(delay)
+        await self._release(task)
+        return True
+
+    async def _save_uploaded(self, session_id: int, task: FileTask, account: str, video: UploadedVideo):
+        file = task.file
+        duplicates = self._book.add_uploaded(task, account, video)
+        await in_thread(record_uploaded, self._storage, session_id, account, file, video)
+        self._progress.add('uploaded')
+        content_hash = getattr(file, 'content_hash', None)
+        if content_hash is not None:
+            await self._router.get(account).link_content(content_hash, video.id, file.path)
+            for d in duplicates:
+                await self._save_duplicate(session_id, account, d, content_hash, video.id, file.path)
+                await self._file_done(d)
+
+    async def _run_transfer(self, session_id: int, task: FileTask, slots: asyncio.Semaphore):
+        failed = True
+        try:
+            failed = not await self._transfer(session_id, task)
+        except Exception as e:
+            # the upload is not recorded, the file is listed again and accounts which got it skip it by name
+            logging.exception(f"Transfer failed: {task.file.name}: {e}")
+            self._book.add_failed(task.file)
+            await self._release(task)
+        finally:
+            slots.release()
+            await self._file_done(task.file, failed)
+
+    async def _run_pipeline(self, session_id: int) -> Tuple[List[Tuple[str, UploadedVideo]], List[FileInfoBase]]:
+        """
+        Listed files are filtered one by one and every accepted file is transferred by its own coroutine.
+        At most PIPELINE_QUEUE_SIZE files wait for a download or upload slot, then listing waits
+        """
+        parallelism = int(os.getenv('PARALLELISM', '5'))
+        download_parallelism = int(os.getenv('DOWNLOAD_PARALLELISM', str(parallelism)))
+        upload_parallelism = int(os.getenv('UPLOAD_PARALLELISM', str(parallelism)))
+        queue_size = int(os.getenv('PIPELINE_QUEUE_SIZE', '100'))
+        self._link_mode = os.getenv('TRANSFER_MODE', 'download') == 'link'
+        logging.info(f'Using {download_parallelism} download and {upload_parallelism} upload slots, '
+                     f'transfer mode {"link" if self._link_mode else "download"}, '
+                     f'{len(self._router.accounts)} accounts')
+
+        self._book = RunBook()
+        self._download_slots = asyncio.Semaphore(max(download_parallelism, 1))
+        self._upload_slots = asyncio.Semaphore(max(upload_parallelism, 1))
+        self._space = asyncio.Condition()
+        in_flight = asyncio.Semaphore(max(queue_size, 1) + download_parallelism + upload_parallelism)
+        transfers = set()
+        listed = 0
+        try:
+            async for file in self._source.get_files():
+                listed += 1
+                task = await self._filter_file(session_id, file)
+                if task is None:
+                    continue
+                await in_flight.acquire()
+                transfer = asyncio.ensure_future(self._run_transfer(session_id, task, in_flight))
+                transfers.add(transfer)
+                transfer.add_done_callback(transfers.discard)
+        finally:
+            if len(transfers) > 0:
+                await asyncio.gather(*transfers, return_exceptions=True)
+        book = self._book
+        logging.info(f'Processed {listed} files, uploaded {len(book.uploaded)}, failed {len(book.failed)}, '
+                     f'linked {book.duplicates} duplicates')
+        return book.uploaded, book.failed
+
+    async def _wait_all(self, uploaded: List[Tuple[str, UploadedVideo]]) -> AsyncIterator[Tuple[str, str]]:
+        """
+        Polls encoding of videos of every account concurrently
+        :return: video id and final status, in the order statuses of all accounts arrive
+        """
+        results = asyncio.Queue()
+
+        async def poll(account: str):
+            try:
+                uploader = self._router.get(account)
+                uploader.set_uploaded_videos([v for a, v in uploaded if a == account])
+                async for result in uploader.wait_all():
+                    await results.put(result)
+            finally:
+                await results.put(None)
+
+        polls = [asyncio.ensure_future(poll(account)) for account in self._router.accounts]
+        left = len(polls)
+        while left > 0:
+            result = await results.get()
+            if result is None:
+                left -= 1
+                continue
+            yield result
+        await asyncio.gather(*polls)
+
+    async def run(self, full_index: bool = False, wait_for_encoding: bool = False):
+        """
+        :param wait_for_encoding: poll uploaded videos until encoding is finished before completing the session.
+            Otherwise statuses are left to StatusPoller
+        """
+        logging.info("Indexing uploader...")
+        await asyncio.gather(*(self._router.get(a).index(full_index) for a in self._router.accounts))
+        logging.info("Indexing done. Started scanning source")
+        await in_thread(self._temp.clean)
+        session_id = await in_thread(self._storage.create_session_id)
+        self._progress = Progress()
+        tracker = None
+        if self._progress_publisher is not None:
+            tracker = ProgressTracker(session_id, self._progress, self._progress_publisher)
+            tracker.start()
+
+        try:
+            total_uploaded, not_uploaded_files = await self._run_pipeline(session_id)
+            if len(not_uploaded_files) > 0:
+                logging.warning(f"Not uploaded files: {len(not_uploaded_files)}")
+
+            logging.info(f"{len(total_uploaded)} files uploaded")
+            await self._source.commit(not_uploaded_files)
+            if wait_for_encoding:
+                logging.info("Waiting for processing completion")
+                names = {v.id: v.name for _, v in total_uploaded}
+                async for id, status in self._wait_all(total_uploaded):
+                    await in_thread(self._storage.update_video_status, id, status)
+                    if status == VIDEO_STATUS_READY:
+                        self._progress.add('ready')
+                        if self._duplicator is not None:
+                            self._duplicator.on_ready(id, names.get(id))
+                    elif status == VIDEO_STATUS_ERROR:
+                        self._progress.add('encoding_failed')
+                if self._duplicator is not None:
+                    await in_thread(self._duplicator.retry_failed)
+            logging.info(f"Done")
+            await in_thread(self._storage.session_completed, session_id)
+        except Exception as e:
+            logging.exception(str(e))
+            await in_thread(self._storage.session_completed_error, session_id, str(e))
+        finally:
+            if tracker is not None:
+                await in_thread(tracker.stop)
@@ -0,0 +1,57 @@
+import asyncio
+import functools
+import threading
+from typing import AsyncIterator, Awaitable, Callable, Iterator, TypeVar
+
+T = TypeVar('T')
+
+
+async def in_thread(fn: Callable[..., T], *args) -> T:
+    """
+    Runs blocking call, e.g. database storage or local disk, in the default executor
+    """
+    return await asyncio.get_event_loop().run_in_executor(None, functools.partial(fn, *args))
+
+
+def iterate_on(loop: asyncio.AbstractEventLoop, items: AsyncIterator[T]) -> Iterator[T]:
+    """
+    Blocking iterator over an async iterator running on the loop of another thread
+    """
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(items.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        # also reached when the consumer closes the iterator early
+        if hasattr(items, 'aclose'):
+            asyncio.run_coroutine_threadsafe(items.aclose(), loop).result()
+
+
+class EventLoopThread:
+    """
+    Event loop running in a background thread, so blocking code can call async implementations
+    """
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='asyncio', daemon=True)
+        self._thread.start()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self._loop
+
+    def run(self, coro: Awaitable[T]) -> T:
+        """
+        Blocks until the coroutine is finished on the loop
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def iterate(self, items: AsyncIterator[T]) -> Iterator[T]:
+        return iterate_on(self._loop, items)
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
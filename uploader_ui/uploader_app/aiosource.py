@@ -0,0 +1,280 @@
+import asyncio
+import json
+import logging
+import os
+from abc import ABCMeta
+from collections import deque
+from typing import AsyncIterator, Dict, List, Optional
+
+import aiohttp
+from dropbox import exceptions as dropbox_exceptions
+
+from .aioloop import EventLoopThread, in_thread
+from .source import SourceBase, FileInfoBase, DropBoxFile, DropboxContentHasher, ContentHashMismatchError, \
+    filter_job_folders, save_cursors
+from .storage import ListingCursorStorageBase
+
+DROPBOX_API_URL = 'https://api.dropboxapi.com/2'
+DROPBOX_CONTENT_URL = 'https://content.dropboxapi.com/2'
+
+_LISTING_DONE = object()
+
+
+class DropboxRouteError(Exception):
+    """
+    Endpoint error (HTTP 409), error_summary tells the reason, e.g. reset/... or path/not_found/...
+    """
+    def __init__(self, route: str, summary: str):
+        super().__init__(f'Dropbox error: {route} {summary}')
+        self.summary = summary
+
+
+class AsyncSourceBase(metaclass=ABCMeta):
+    def get_files(self) -> AsyncIterator[FileInfoBase]:
+        raise NotImplementedError
+
+    async def download_file(self, file: FileInfoBase, destination_name: str):
+        raise NotImplementedError
+
+    async def get_link(self, file: FileInfoBase) -> Optional[str]:
+        """
+        :return: temporary url of the file content, None if the source can not share files by url
+        """
+        return None
+
+    async def file_done(self, file: FileInfoBase, failed: bool):
+        """
+        Called once the file is uploaded to all its accounts, linked, skipped or given up
+        """
+        pass
+
+    async def commit(self, failed_files: List[FileInfoBase]):
+        """
+        Called after a successful run, so the next run can skip files seen by this one
+        :param failed_files: files which were not uploaded and have to be listed again
+        """
+        pass
+
+    async def close(self):
+        """
+        Releases http connections, called on shutdown
+        """
+        pass
+
+
+def entry_to_file(entry: dict) -> DropBoxFile:
+    return DropBoxFile(entry['name'], entry['path_display'], entry.get('size'), entry.get('content_hash'),
+                       entry['.tag'] == 'folder')
+
+
+def _write_chunk(f, hasher: DropboxContentHasher, chunk: bytes):
+    f.write(chunk)
+    hasher.update(chunk)
+
+
+class AsyncDropBoxSource(AsyncSourceBase):
+    """
+    DropBoxSource on aiohttp calling dropbox http api directly, job folders are listed by list_parallelism
+    coroutines instead of threads
+    """
+    def __init__(self, access_token: str, start_folder: str, chunk_size: int = None, list_parallelism: int = None,
+                 cursor_storage: ListingCursorStorageBase = None, session: aiohttp.ClientSession = None,
+                 api_url: str = DROPBOX_API_URL, content_url: str = DROPBOX_CONTENT_URL):
+        """
+        :param cursor_storage: if set, job folders listed by a previous run only return changes since that run
+        :param session: http session, created on the running loop if None
+        """
+        self._start_folder = start_folder
+        self._chunk_size = chunk_size or int(os.getenv('DROPBOX_CHUNK_SIZE', str(1024 * 1024)))
+        self._list_parallelism = list_parallelism or int(os.getenv('DROPBOX_LIST_PARALLELISM', '8'))
+        self._cursor_storage = cursor_storage
+        self._session = session
+        self._own_session = session is None
+        self._api_url = api_url
+        self._content_url = content_url
+        self._headers = {'Authorization': f'Bearer {access_token}'}
+        self._path_root = None  # type: Optional[str]
+        self._path_root_lock = None  # type: Optional[asyncio.Lock]
+        self._saved_cursors = {}  # type: Dict[str, str]
+        self._cursors = {}  # type: Dict[str, str]
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        if self._path_root is None:
+            if self._path_root_lock is None:
+                self._path_root_lock = asyncio.Lock()
+            async with self._path_root_lock:
+                if self._path_root is None:
+                    # files of team spaces are only visible from the root namespace
+                    account = await self._post('users/get_current_account', None, self._headers)
+                    self._path_root = json.dumps(
+                        {'.tag': 'namespace_id', 'namespace_id': account['root_info']['root_namespace_id']})
+        return self._session
+
+    def _auth_headers(self) -> dict:
+        return {**self._headers, 'Dropbox-API-Path-Root': self._path_root}
+
+    def _raise(self, route: str, status: int, headers, body: str):
+        request_id = headers.get('X-Dropbox-Request-Id')
+        if status == 409:
+            try:
+                summary = json.loads(body).get('error_summary', '')
+            except ValueError:
+                summary = body
+            raise DropboxRouteError(route, summary)
+        if status == 401:
+            raise dropbox_exceptions.AuthError(request_id, body)
+        if status == 429:
+            raise dropbox_exceptions.RateLimitError(request_id, backoff=int(headers.get('Retry-After', '0')) or None)
+        raise dropbox_exceptions.HttpError(request_id, status, body)
+
+    async def _post(self, route: str, arg: Optional[dict], headers: dict) -> dict:
+        headers = {**headers, 'Content-Type': 'application/json'}
+        async with self._session.post(f'{self._api_url}/{route}', data=json.dumps(arg), headers=headers) as r:
+            body = await r.text()
+            if r.status != 200:
+                self._raise(route, r.status, r.headers, body)
+            return json.loads(body)
+
+    async def _rpc(self, route: str, arg: Optional[dict]) -> dict:
+        await self._get_session()
+        return await self._post(route, arg, self._auth_headers())
+
+    async def _continue_listing(self, path: str, cursor: str) -> Optional[dict]:
+        try:
+            return await self._rpc('files/list_folder/continue', {'cursor': cursor})
+        except DropboxRouteError as e:
+            if e.summary.startswith('reset'):
+                logging.info(f'Saved cursor of {path} was reset, listing it from scratch')
+                return None
+            raise
+
+    async def _list_job_folder(self, path: str, results: asyncio.Queue):
+        cursor = self._saved_cursors.get(path.lower())
+        r = await self._continue_listing(path, cursor) if cursor is not None else None
+        if r is None:
+            logging.debug(f'Enumerating files in {path}')
+            r = await self._rpc('files/list_folder', {'path': path, 'recursive': True})
+        else:
+            logging.debug(f'Enumerating changes in {path}')
+        await results.put([entry_to_file(e) for e in r['entries'] if e['.tag'] != 'deleted'])
+        while r['has_more']:
+            r = await self._rpc('files/list_folder/continue', {'cursor': r['cursor']})
+            await results.put([entry_to_file(e) for e in r['entries'] if e['.tag'] != 'deleted'])
+        self._cursors[path.lower()] = r['cursor']
+
+    async def get_job_folders(self) -> List[DropBoxFile]:
+        r = await self._rpc('files/list_folder', {'path': self._start_folder, 'recursive': False,
+                                                  'include_deleted': False, 'include_mounted_folders': False})
+        entries = r['entries']
+        while r['has_more']:
+            r = await self._rpc('files/list_folder/continue', {'cursor': r['cursor']})
+            entries.extend(r['entries'])
+        return filter_job_folders([entry_to_file(e) for e in entries])
+
+    async def get_files(self) -> AsyncIterator[FileInfoBase]:
+        """
+        Pages are yielded as soon as any folder returns them, so files of different folders are interleaved.
+        The first listing error stops remaining folders and is raised to the consumer
+        """
+        folders = await self.get_job_folders()
+        self._cursors = {}
+        if self._cursor_storage is not None:
+            saved = await in_thread(self._cursor_storage.get_cursors, self._start_folder)
+            self._saved_cursors = {k.lower(): v for k, v in saved.items()}
+            logging.info(f'{len(self._saved_cursors)} job folders have saved cursors, only their changes are listed')
+        pending = deque(f.path for f in folders)
+        results = asyncio.Queue(max(self._list_parallelism, 1) * 4)
+
+        async def work():
+            try:
+                while len(pending) > 0:
+                    await self._list_job_folder(pending.popleft(), results)
+            except Exception as e:
+                await results.put(e)
+            await results.put(_LISTING_DONE)
+
+        workers = [asyncio.ensure_future(work()) for _ in range(min(max(self._list_parallelism, 1), len(folders)))]
+        try:
+            running = len(workers)
+            while running > 0:
+                item = await results.get()
+                if item is _LISTING_DONE:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    for f in item:
+                        yield f
+        finally:
+            # also reached when the consumer closes the generator early
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def commit(self, failed_files: List[FileInfoBase]):
+        """
+        Saves cursors of job folders listed by the last get_files
+        """
+        if self._cursor_storage is not None:
+            await in_thread(save_cursors, self._cursor_storage, self._start_folder, dict(self._cursors), failed_files)
+
+    async def get_link(self, file: DropBoxFile) -> Optional[str]:
+        """
+        Dropbox temporary links expire in four hours
+        """
+        return (await self._rpc('files/get_temporary_link', {'path': file.path}))['link']
+
+    async def download_file(self, file_to_download: DropBoxFile, destination_name: str):
+        """
+        Streams file to destination_name by chunk_size pieces, disk writes and hashing are done in the executor
+        :raise ContentHashMismatchError if downloaded bytes do not match dropbox content_hash
+        """
+        session = await self._get_session()
+        headers = {**self._auth_headers(), 'Dropbox-API-Arg': json.dumps({'path': file_to_download.path})}
+        hasher = DropboxContentHasher()
+        async with session.post(f'{self._content_url}/files/download', headers=headers) as r:
+            if r.status != 200:
+                self._raise('files/download', r.status, r.headers, await r.text())
+            metadata = json.loads(r.headers.get('Dropbox-API-Result', '{}'))
+            with open(destination_name, 'wb') as f:
+                async for chunk in r.content.iter_chunked(self._chunk_size):
+                    await in_thread(_write_chunk, f, hasher, chunk)
+        expected = metadata.get('content_hash') or file_to_download.content_hash
+        if expected is not None and hasher.hexdigest() != expected:
+            os.remove(destination_name)
+            raise ContentHashMismatchError(f"Downloaded {file_to_download.path} does not match content_hash {expected}")
+
+    async def close(self):
+        if self._own_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class SyncSource(SourceBase):
+    """
+    SourceBase calling AsyncSourceBase on the loop thread, so the threaded Uploader can use async sources
+    """
+    def __init__(self, source: AsyncSourceBase, loop: EventLoopThread):
+        self._source = source
+        self._loop = loop
+        self._start_folder = getattr(source, '_start_folder', None)
+
+    def get_files(self):
+        return self._loop.iterate(self._source.get_files())
+
+    def download_file(self, file: FileInfoBase, destination_name: str):
+        self._loop.run(self._source.download_file(file, destination_name))
+
+    def get_link(self, file: FileInfoBase) -> Optional[str]:
+        return self._loop.run(self._source.get_link(file))
+
+    def file_done(self, file: FileInfoBase, failed: bool):
+        self._loop.run(self._source.file_done(file, failed))
+
+    def commit(self, failed_files: List[FileInfoBase]):
+        self._loop.run(self._source.commit(failed_files))
+
+    def close(self):
+        self._loop.run(self._source.close())
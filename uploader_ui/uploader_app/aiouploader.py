@@ -0,0 +1,439 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+import aiohttp
+from facebook_business import FacebookAdsApi, FacebookSession
+from facebook_business.exceptions import FacebookRequestError
+
+from .aioloop import EventLoopThread, in_thread, iterate_on
+from .chunked import VIDEO_GRAPH_URL, ERROR_SUBCODE_WRONG_OFFSET, UploadSession
+from .ratelimit import RateGovernor, THROTTLING_ERROR_CODES
+from .uploader import UploaderBase, UploadedVideo, FacebookUploaderNoWait, BATCH_SIZE, VIDEO_TERMINAL_STATUSES
+
+GRAPH_URL = 'https://graph.facebook.com'
+
+
+def encode_params(params: dict) -> Dict[str, str]:
+    """
+    Graph api expects nested values, lists and booleans as json
+    """
+    return {k: v if isinstance(v, str) else json.dumps(v, sort_keys=True, separators=(',', ':'))
+            for k, v in params.items()}
+
+
+class AsyncGraphApi:
+    """
+    Graph api client on aiohttp. Every call, batches included, goes through RateGovernor,
+    which can be shared with GovernedFacebookAdsApi of the same process
+    """
+    def __init__(self, session: FacebookSession, governor: RateGovernor = None, api_version: str = None,
+                 http: aiohttp.ClientSession = None, graph_url: str = GRAPH_URL, video_graph_url: str = VIDEO_GRAPH_URL):
+        """
+        :param session: credentials, access_token and appsecret_proof are sent with every call
+        :param http: http session, created on the running loop if None
+        """
+        self._auth = dict(session.requests.params)
+        self.governor = governor or RateGovernor()
+        self._version = api_version or FacebookAdsApi.API_VERSION
+        self._http = http
+        self._own_http = http is None
+        self._graph_url = graph_url
+        self.video_graph_url = video_graph_url
+
+    def _url(self, path: tuple, url_override: str = None) -> str:
+        url = f'{url_override or self._graph_url}/{self._version}'
+        return f'{url}/{"/".join(map(str, path))}' if len(path) > 0 else url
+
+    async def call(self, method: str, path: tuple, params: dict = None, files: dict = None,
+                   url_override: str = None) -> dict:
+        """
+        :param files: field name to (file name, content) of multipart uploads
+        :raise FacebookRequestError if the call failed
+        """
+        if self._http is None:
+            self._http = aiohttp.ClientSession()
+        await self.governor.acquire_async()
+        url = self._url(path, url_override)
+        params = encode_params(params or {})
+        if method == 'GET':
+            kwargs = {'params': {**params, **self._auth}}
+        elif files:
+            form = aiohttp.FormData()
+            for k, v in {**params, **self._auth}.items():
+                form.add_field(k, v)
+            for field, (filename, content) in files.items():
+                form.add_field(field, content, filename=filename, content_type='application/octet-stream')
+            kwargs = {'data': form}
+        else:
+            kwargs = {'data': {**params, **self._auth}}
+        async with self._http.request(method, url, **kwargs) as r:
+            body = await r.text()
+            headers = dict(r.headers)
+            status = r.status
+        if status >= 400:
+            e = FacebookRequestError('Call was not successful', {'method': method, 'path': url, 'params': params},
+                                     status, headers, body)
+            self.governor.observe_error(e)
+            raise e
+        self.governor.observe_headers(headers)
+        return json.loads(body)
+
+    async def batch(self, calls: List[Tuple[str, str, Optional[dict]]]) -> List[Optional[Tuple[int, dict]]]:
+        """
+        :param calls: method, relative url and params of at most BATCH_SIZE calls
+        :return: http status and body of every call, None for calls facebook did not process
+        """
+        items = []
+        for method, relative_url, params in calls:
+            item = {'method': method, 'relative_url': relative_url}
+            if params:
+                query = urlencode(encode_params(params))
+                if method == 'GET':
+                    item['relative_url'] += '?' + query
+                else:
+                    item['body'] = query
+            items.append(item)
+        responses = await self.call('POST', (), {'batch': items, 'include_headers': False})
+        return [(r['code'], json.loads(r.get('body') or 'null')) if r is not None else None for r in responses]
+
+    async def close(self):
+        if self._own_http and self._http is not None:
+            await self._http.close()
+            self._http = None
+
+
+class AsyncUploaderBase:
+    async def index(self, full: bool = False):
+        """
+        Loads existing videos
+        :param full: rebuild persisted index from scratch instead of fetching only new videos
+        """
+        raise NotImplementedError
+
+    def should_be_uploaded(self, video_name: str) -> bool:
+        raise NotImplementedError
+
+    def get_by_id(self, video_id: str) -> Optional[UploadedVideo]:
+        raise NotImplementedError
+
+    def get_by_name(self, video_name: str) -> Optional[UploadedVideo]:
+        raise NotImplementedError
+
+    async def upload(self, path: str, key: str = None) -> Optional[UploadedVideo]:
+        """
+        :param key: identifies file content between runs to resume interrupted uploads
+        :raise Exception if upload failed
+        """
+        raise NotImplementedError
+
+    async def upload_url(self, url: str, name: str) -> Optional[UploadedVideo]:
+        """
+        :return: None if uploading from url is not supported
+        """
+        return None
+
+    async def get_by_content_hash(self, content_hash: str) -> Optional[Tuple[UploadedVideo, List[str]]]:
+        return None
+
+    async def link_content(self, content_hash: str, video_id: str, path: str):
+        pass
+
+    def set_uploaded_videos(self, files: List[UploadedVideo]):
+        raise NotImplementedError
+
+    def wait_all(self) -> AsyncIterator[Tuple[str, str]]:
+        """
+        Yields file ids with new statuses
+        """
+        raise NotImplementedError
+
+    async def reload_many(self, videos: List[UploadedVideo]) -> Dict[str, Optional[UploadedVideo]]:
+        """
+        :return: reloaded videos by id, None for deleted videos. Videos failed to reload are omitted
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        """
+        Releases http connections, called on shutdown
+        """
+        pass
+
+
+class _VideoIndex(FacebookUploaderNoWait):
+    """
+    Index of FacebookUploaderNoWait with pages fetched by a coroutine, so persisted index and content links
+    are still handled by its blocking code in a worker thread
+    """
+    def __init__(self, act_id: str, index_storage, content_storage):
+        super().__init__(None, act_id, index_storage, None, content_storage)
+        self.fetch = None
+
+    def _fetch_videos(self, since=None):
+        return self.fetch(since)
+
+
+def _read_chunk(path: str, start: int, end: int) -> bytes:
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return f.read(end - start)
+
+
+class AsyncFacebookUploader(AsyncUploaderBase):
+    """
+    FacebookUploaderNoWait on AsyncGraphApi. Videos are uploaded with upload_phase=start/transfer/finish protocol,
+    status polls of all pending videos are sent as concurrent batches
+    """
+    def __init__(self, api: AsyncGraphApi, act_id: str, index_storage=None, session_storage=None,
+                 content_storage=None):
+        """
+        :param index_storage: VideoIndexStorageBase keeping index between runs, account is paged fully on every run if None
+        :param session_storage: UploadSessionStorageBase to make uploads resumable
+        :param content_storage: ContentHashStorageBase to link files with already uploaded content instead of uploading
+        """
+        self._api = api
+        self._act_id = act_id
+        self._index = _VideoIndex(act_id, index_storage, content_storage)
+        self._session_storage = session_storage
+
+    async def _fetch_videos(self, since=None) -> AsyncIterator[UploadedVideo]:
+        """
+        Pages account videos, newest first
+        """
+        params = {'fields': 'title,status,created_time', 'limit': int(os.getenv('FB_AD_PAGE_SIZE', '100'))}
+        if since is not None:
+            params['since'] = int(since.timestamp())
+        r = await self._api.call('GET', (self._act_id, 'advideos'), params)
+        while True:
+            for v in r.get('data', []):
+                yield self._index._resp_to_video(v)
+            paging = r.get('paging', {})
+            if 'next' not in paging:
+                return
+            r = await self._api.call('GET', (self._act_id, 'advideos'), {**params, 'after': paging['cursors']['after']})
+
+    async def index(self, full: bool = False):
+        loop = asyncio.get_event_loop()
+        self._index.fetch = lambda since: iterate_on(loop, self._fetch_videos(since))
+        await in_thread(self._index.index, full)
+
+    def should_be_uploaded(self, video_name: str) -> bool:
+        return self._index.should_be_uploaded(video_name)
+
+    def get_by_id(self, video_id: str) -> Optional[UploadedVideo]:
+        return self._index.get_by_id(video_id)
+
+    def get_by_name(self, video_name: str) -> Optional[UploadedVideo]:
+        return self._index.get_by_name(video_name)
+
+    async def get_by_content_hash(self, content_hash: str) -> Optional[Tuple[UploadedVideo, List[str]]]:
+        return await in_thread(self._index.get_by_content_hash, content_hash)
+
+    async def link_content(self, content_hash: str, video_id: str, path: str):
+        await in_thread(self._index.link_content, content_hash, video_id, path)
+
+    async def _video_call(self, params: dict, files: dict = None) -> dict:
+        return await self._api.call('POST', (self._act_id, 'advideos'), params, files, self._api.video_graph_url)
+
+    async def _transfer(self, path: str, session: UploadSession, save):
+        name = os.path.basename(path)
+        while session.start_offset < session.end_offset:
+            chunk = await in_thread(_read_chunk, path, session.start_offset, session.end_offset)
+            try:
+                r = await self._video_call({
+                    'upload_phase': 'transfer',
+                    'upload_session_id': session.upload_session_id,
+                    'start_offset': str(session.start_offset),
+                }, {'video_file_chunk': (name, chunk)})
+            except FacebookRequestError as e:
+                error_data = (e.body() or {}).get('error', {}).get('error_data', {})
+                if e.api_error_subcode() != ERROR_SUBCODE_WRONG_OFFSET or 'start_offset' not in error_data:
+                    raise
+                # facebook expects other offsets, e.g. chunk was received but response was lost
+                r = error_data
+            session.start_offset = int(r['start_offset'])
+            session.end_offset = int(r['end_offset'])
+            await save(session)
+
+    async def upload(self, path: str, key: str = None) -> Optional[UploadedVideo]:
+        """
+        Upload session is saved after every chunk if session_storage and key are set,
+        so an interrupted upload continues from the last acknowledged chunk
+        """
+        name = os.path.basename(path)
+        file_size = os.path.getsize(path)
+        storage = self._session_storage if key is not None else None
+        key = f'{self._act_id}/{key}'
+
+        async def save(s: UploadSession):
+            if storage is not None:
+                await in_thread(storage.save_upload_session, s)
+
+        session = await in_thread(storage.get_upload_session, key) if storage is not None else None
+        if session is not None and session.file_size != file_size:
+            await in_thread(storage.delete_upload_session, key)
+            session = None
+        resumed = session is not None
+        if resumed:
+            logging.info(f'Resuming upload of {path} from offset {session.start_offset} of {file_size}')
+        else:
+            r = await self._video_call({'upload_phase': 'start', 'file_size': str(file_size)})
+            session = UploadSession(key, self._act_id, r['upload_session_id'], r['video_id'], file_size,
+                                    int(r['start_offset']), int(r['end_offset']))
+            await save(session)
+        try:
+            await self._transfer(path, session, save)
+            await self._video_call({'upload_phase': 'finish', 'upload_session_id': session.upload_session_id,
+                                    'title': name})
+        except FacebookRequestError as e:
+            if resumed and not e.api_transient_error() and e.api_error_code() not in THROTTLING_ERROR_CODES:
+                # session has probably expired, next attempt starts over
+                await in_thread(storage.delete_upload_session, key)
+            raise
+        if storage is not None:
+            await in_thread(storage.delete_upload_session, key)
+        logging.info(f'Video created: id={session.video_id}')
+        upl = UploadedVideo(session.video_id, name)
+        self._index._uploaded_videos[upl.id] = upl
+        return upl
+
+    async def upload_url(self, url: str, name: str) -> Optional[UploadedVideo]:
+        res = await self._api.call('POST', (self._act_id, 'advideos'), {'file_url': url, 'title': name})
+        if 'id' not in res:
+            raise Exception(f'unable to upload video from url: {res}')
+        logging.info(f'Video created from url: id={res["id"]}')
+        upl = UploadedVideo(res['id'], name)
+        self._index._uploaded_videos[upl.id] = upl
+        return upl
+
+    def set_uploaded_videos(self, files: List[UploadedVideo]):
+        self._index.set_uploaded_videos(files)
+
+    def _is_not_found(self, status: int, body) -> bool:
+        error = body.get('error', {}) if isinstance(body, dict) else {}
+        return status == 404 or (error.get('code') == 100 and error.get('error_subcode') == 33)
+
+    async def _reload_batch(self, videos: List[UploadedVideo], result: Dict[str, Optional[UploadedVideo]]):
+        retries = 3
+        while len(videos) > 0 and retries > 0:
+            retries -= 1
+            responses = await self._api.batch([('GET', v.id, {'fields': 'status,title'}) for v in videos])
+            missing = []
+            for video, response in zip(videos, responses):
+                if response is None:
+                    missing.append(video)
+                    continue
+                status, body = response
+                if status == 200:
+                    v = self._index._resp_to_video(body)
+                    self._index._index_videos([v])
+                    result[video.id] = v
+                elif self._is_not_found(status, body):
+                    await in_thread(self._index._delete_from_index, video)
+                    result[video.id] = None
+                else:
+                    logging.warning(f'Failed to reload video {video.id}: {body}')
+            videos = missing
+
+    async def reload_many(self, videos: List[UploadedVideo]) -> Dict[str, Optional[UploadedVideo]]:
+        """
+        All batches are sent concurrently, RateGovernor paces them
+        """
+        result = {}
+        await asyncio.gather(*(self._reload_batch(videos[i:i + BATCH_SIZE], result)
+                               for i in range(0, len(videos), BATCH_SIZE)))
+        return result
+
+    async def wait_all(self) -> AsyncIterator[Tuple[str, str]]:
+        """
+        Polls uploaded videos until they are ready or failed.
+        Every video starts with FB_POLL_INTERVAL_MIN interval which is doubled after each poll up to FB_POLL_INTERVAL_MAX
+        """
+        min_interval = float(os.getenv('FB_POLL_INTERVAL_MIN', '5'))
+        max_interval = float(os.getenv('FB_POLL_INTERVAL_MAX', '60'))
+        deadline = time.monotonic() + float(os.getenv('FB_POLL_TIMEOUT', '300'))
+        uploaded = self._index._uploaded_videos
+        polls = {id: [time.monotonic(), min_interval, None] for id in uploaded}  # next poll, interval, last status
+        while len(polls) > 0 and time.monotonic() < deadline:
+            now = time.monotonic()
+            due = [uploaded[id] for id, p in polls.items() if p[0] <= now]
+            reloaded = await self.reload_many(due)
+            for video in due:
+                p = polls[video.id]
+                if video.id not in reloaded:
+                    p[0] = now + p[1]
+                    continue
+                g = reloaded[video.id]
+                if g is None:
+                    logging.warning(f'Video {video.id} was deleted')
+                    del polls[video.id]
+                    del uploaded[video.id]
+                    continue
+                if g.status != p[2]:
+                    p[2] = g.status
+                    yield video.id, g.status
+                if g.status in VIDEO_TERMINAL_STATUSES:
+                    del polls[video.id]
+                    del uploaded[video.id]
+                else:
+                    p[1] = min(max_interval, p[1] * 2)
+                    p[0] = now + p[1]
+            if len(polls) > 0:
+                wait = min(min(p[0] for p in polls.values()), deadline) - time.monotonic()
+                logging.info(f'The are {len(polls)} videos with not ready status. Next poll in {max(wait, 0):.0f} seconds')
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+    async def close(self):
+        await self._api.close()
+
+
+class SyncUploader(UploaderBase):
+    """
+    UploaderBase calling AsyncUploaderBase on the loop thread, e.g. to let StatusPoller reload
+    thousands of pending videos with concurrent batches
+    """
+    def __init__(self, uploader: AsyncUploaderBase, loop: EventLoopThread):
+        self._uploader = uploader
+        self._loop = loop
+
+    def index(self, full: bool = False):
+        self._loop.run(self._uploader.index(full))
+
+    def should_be_uploaded(self, video_name: str) -> bool:
+        return self._uploader.should_be_uploaded(video_name)
+
+    def get_by_id(self, video_id: str) -> Optional[UploadedVideo]:
+        return self._uploader.get_by_id(video_id)
+
+    def get_by_name(self, video_name: str) -> Optional[UploadedVideo]:
+        return self._uploader.get_by_name(video_name)
+
+    def upload(self, path: str, key: str = None) -> Optional[UploadedVideo]:
+        return self._loop.run(self._uploader.upload(path, key))
+
+    def upload_url(self, url: str, name: str) -> Optional[UploadedVideo]:
+        return self._loop.run(self._uploader.upload_url(url, name))
+
+    def get_by_content_hash(self, content_hash: str) -> Optional[Tuple[UploadedVideo, List[str]]]:
+        return self._loop.run(self._uploader.get_by_content_hash(content_hash))
+
+    def link_content(self, content_hash: str, video_id: str, path: str):
+        self._loop.run(self._uploader.link_content(content_hash, video_id, path))
+
+    def set_uploaded_videos(self, files: List[UploadedVideo]):
+        self._uploader.set_uploaded_videos(files)
+
+    def wait_all(self):
+        return self._loop.iterate(self._uploader.wait_all())
+
+    def reload_many(self, videos: List[UploadedVideo]) -> Dict[str, Optional[UploadedVideo]]:
+        return self._loop.run(self._uploader.reload_many(videos))
+
+    def close(self):
+        self._loop.run(self._uploader.close())
@@ -1,17 +1,27 @@
 import logging
 import os
+import queue
 import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional, Tuple, Union
 
 from facebook_business import FacebookAdsApi
 from facebook_business.adobjects.abstractcrudobject import AbstractCrudObject
 from facebook_business.exceptions import FacebookBadObjectError, FacebookRequestError
 
-from .pattern import is_file_match
+from .bookkeeping import FileTask, RunBook, account_label, route_file, record_uploaded, record_duplicate, \
+    record_failed
+from .duplicator import DuplicatorBase
+from .pattern import match_file
+from .pipeline import Pipeline, Stage
+from .progress import Progress, ProgressPublisherBase, ProgressTracker
+from .retry import RetryPolicy, RetryScheduler, classify_error, ERROR_PERMANENT
+from .routing import AccountRouter, DEFAULT_ACCOUNT
 from .source import SourceBase, FileInfoBase
 from .storage import StorageBase
-from .uploader import UploaderBase, TooManyCallsError
-
-from multiprocessing.dummy import Pool as ThreadPool
+from .tempspace import TempSpace
+from .uploader import UploaderBase, UploadedVideo, TooManyCallsError, VIDEO_STATUS_DELETED, VIDEO_STATUS_READY, \
+    VIDEO_STATUS_ERROR, VIDEO_TERMINAL_STATUSES
 
 def get_parent_id(self):
     """
@@ -47,81 +57,450 @@ AbstractCrudObject.get_parent_id_assured = get_parent_id_assured
 # start_folder = '/Jobs_Dev'
 # start_folder = '/Jobs_Dev/J343_Survivor_RoofMoneyCount/Exports/T7/V2'
 
+def upload_key(file: FileInfoBase) -> str:
+    """
+    Identifies file content between runs, so an interrupted upload of the same file can be resumed
+    """
+    content_hash = getattr(file, 'content_hash', None)
+    return f"{file.path}@{content_hash}" if content_hash is not None else file.path
+
+
 class Uploader:
     def __init__(self,
                  storage: StorageBase,
                  source: SourceBase,
-                 uploader: UploaderBase,
-                 tmp_dir: str
+                 uploader: Union[UploaderBase, AccountRouter],
+                 tmp_dir: str,
+                 retry_policy: RetryPolicy = None,
+                 progress_publisher: ProgressPublisherBase = None,
+                 duplicator: DuplicatorBase = None
                  ):
+        """
+        :param uploader: uploader of a single account or router of files to uploaders of several accounts,
+            every file is downloaded once and uploaded to its accounts concurrently
+        :param progress_publisher: receives progress of running session every PROGRESS_PUBLISH_INTERVAL seconds
+        :param duplicator: creates ads of videos which encoding is finished while waiting for encoding
+        """
         self._storage = storage
         self._source = source
-        self._uploader = uploader
-        self._tmp_dir = tmp_dir
+        self._router = uploader if isinstance(uploader, AccountRouter) else AccountRouter({DEFAULT_ACCOUNT: uploader})
+        self._temp = TempSpace(tmp_dir)
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._scheduler = None
+        self._account_pool = None  # type: Optional[ThreadPoolExecutor]
+        self._book = RunBook()
+        self._progress_publisher = progress_publisher
+        self._progress = Progress()
+        self._duplicator = duplicator
+        self._link_mode = False
+
+    def _filter_file(self, session_id: int, file: FileInfoBase) -> Optional[FileTask]:
+        self._progress.add('listed')
+        if not match_file(file):
+            # most of listed entries, not formatted unless debug logging is on
+            logging.debug("Skip not matching: %s", file.name)
+            self._source.file_done(file, False)
+            return None
+        content_hash = getattr(file, 'content_hash', None)
+        self._book.hold(file)
+        try:
+            targets = [a for a in route_file(self._router, file)
+                       if content_hash is None or not self._link_duplicate(session_id, a, file, content_hash)]
+        except Exception:
+            self._fail_file(file)
+            raise
+        if len(targets) == 0:
+            self._file_done(file)
+            return None
+        task = FileTask(file, targets)
+        self._book.add_task(task)
+        self._scheduler.track()
+        self._progress.add('queued')
+        return task
+
+    def _link_duplicate(self, session_id: int, account: str, file: FileInfoBase, content_hash: str) -> bool:
+        """
+        Links file to a video of the account with the same content uploaded by this or previous runs
+        :return: True if file does not have to be uploaded to the account
+        """
+        original = self._book.find_original(account, file, content_hash)
+        if original is not None:
+            video_id, path = original
+            if video_id is not None:
+                self._save_duplicate(session_id, account, file, content_hash, video_id, path)
+            return True
+        found = self._router.get(account).get_by_content_hash(content_hash)
+        if found is None:
+            return False
+        video, paths = found
+        if file.path in paths:
+            logging.info(f"Skip: {file.name} is already linked to video {video.id}")
+            return True
+        self._save_duplicate(session_id, account, file, content_hash, video.id, paths[0])
+        return True
+
+    def _save_duplicate(self, session_id: int, account: str, file: FileInfoBase, content_hash: str, video_id: str,
+                        duplicate_of: str):
+        self._router.get(account).link_content(content_hash, video_id, file.path)
+        record_duplicate(self._storage, session_id, account, file, video_id, duplicate_of)
+        self._book.add_duplicate()
+        self._progress.add('linked')
 
-    def _handle_file(self, session_id: id, file: FileInfoBase):
-        logging.debug(f"_handle_file session_id:{session_id} file.name={file.name} file.path={file.path}")
-        is_matched = is_file_match(file.name)
-        if is_matched and self._uploader.should_be_uploaded(file.name):
-            new_file = os.path.join(self._tmp_dir, file.name)
+    def _file_done(self, file: FileInfoBase, failed: bool = False):
+        """
+        Releases a hold of the file, the source is told the file is done once its last hold is released
+        """
+        any_failed = self._book.release(file, failed)
+        if any_failed is not None:
+            self._source.file_done(file, any_failed)
+
+    def _fail_file(self, file: FileInfoBase):
+        """
+        Releases a hold of the file failed by an unexpected error, the error is logged by its stage
+        """
+        self._book.add_failed(file)
+        self._progress.add('failed')
+        self._file_done(file, True)
+
+    def _handle_error(self, session_id: int, task: FileTask, stage: Stage, e: Exception):
+        """
+        Schedules the task back to the failed stage or gives up on permanent errors and exhausted attempts
+        """
+        file = task.file
+        task.attempts += 1
+        error_class = classify_error(e)
+        if self._retry_policy.should_retry(task.attempts, error_class):
+            delay = self._retry_policy.delay(task.attempts, error_class)
+            logging.warning(f"{stage.name} failed: {file.name} ({error_class}: {e}). "
+                            f"Attempt {task.attempts} of {self._retry_policy.max_attempts}, retry in {delay:.1f}s")
+            self._scheduler.retry(task, stage, delay)
+            return
+        logging.error(f"{stage.name} failed: {file.name} ({error_class}: {e}). Giving up after {task.attempts} attempts")
+        try:
+            if task.local_path is not None:
+                self._temp.release(task.local_path)
+                task.local_path = None
+            failed = self._book.give_up(task)
+            self._progress.add('failed', len(failed))
+            for account, f in failed:
+                record_failed(self._storage, session_id, account, f)
+                if f is not file:
+                    self._file_done(f, True)
+        finally:
+            self._file_done(file, True)
+            self._scheduler.done()
+
+    def _upload_url(self, session_id: int, task: FileTask, account: str, url: str) -> Optional[Exception]:
+        """
+        :return: rate limit or transient error to retry, None if the video is uploaded or the link is rejected
+        """
+        file = task.file
+        try:
+            logging.info(f"Uploading by link: {file.name}{account_label(account)}")
+            video = self._router.get(account).upload_url(url, file.name)
+        except Exception as e:
+            if classify_error(e) != ERROR_PERMANENT:
+                return e
+            logging.warning(f"Upload by link failed: {file.name}{account_label(account)} ({e}), downloading it instead")
+            return None
+        if video is None:
+            return None
+        self._progress.add('uploaded_by_link')
+        self._save_uploaded(session_id, task, account, video)
+        return None
+
+    def _transfer_by_link(self, session_id: int, task: FileTask, stage: Stage) -> bool:
+        """
+        Hands source temporary link to the uploaders, so the file content does not pass through this host.
+        Rate limit and transient errors are retried by link, the file is only downloaded if its link is rejected
+        :return: False if the file has to be downloaded and uploaded to some accounts instead
+        """
+        try:
+            url = self._source.get_link(task.file)
+        except Exception as e:
+            if classify_error(e) != ERROR_PERMANENT:
+                self._handle_error(session_id, task, stage, e)
+                return True
+            logging.warning(f"Upload by link failed: {task.file.name} ({e}), downloading it instead")
+            return False
+        if url is None:
+            return False
+        try:
+            errors = self._for_targets(lambda account: self._upload_url(session_id, task, account, url), task.targets)
+        except Exception:
+            self._fail_file(task.file)
+            self._scheduler.done()
+            raise
+        task.targets = [a for a in task.targets if a not in task.videos]
+        if len(task.targets) == 0:
+            self._file_done(task.file)
+            self._scheduler.done()
+            return True
+        if any(errors[a] is None for a in task.targets):
+            return False
+        self._handle_error(session_id, task, stage, errors[task.targets[0]])
+        return True
+
+    def _for_targets(self, fn, targets: List[str]) -> dict:
+        """
+        Calls fn for every account concurrently
+        :return: results by account
+        """
+        if len(targets) == 1:
+            return {targets[0]: fn(targets[0])}
+        futures = {account: self._account_pool.submit(fn, account) for account in targets}
+        return {account: f.result() for account, f in futures.items()}
+
+    def _download_file(self, session_id: int, task: FileTask, stage: Stage) -> Optional[FileTask]:
+        file = task.file
+        if self._link_mode and not task.link_failed:
+            if self._transfer_by_link(session_id, task, stage):
+                return None
+            task.link_failed = True
+        try:
+            task.local_path = self._temp.reserve(file.name, getattr(file, 'size', None))
             logging.info(f"Downloading: {file.name}")
-            self._source.download_file(file, new_file)
-            logging.info(f"Successful download, uploading: {file.name}")
-            uploaded = self._uploader.upload(new_file)
-            if uploaded is not None:
-                self._storage.create_video(session_id, uploaded.id, file.name, file.path)
-                logging.info(f"Successful upload: {file.name}")
-                return uploaded, None
-            else:
-                self._storage.create_video(session_id, uploaded.id, file.name, file.path, "error")
-                logging.warning(f"Upload failed: {file.name}")
-                return None, file
-        else:
-            logging.info(f"Skip: {file.name}")
-            return None, None
-
-    def _do_index(self):
-        self._uploader.index()
+            self._source.download_file(file, task.local_path)
+            logging.info(f"Successful download: {file.name}")
+            self._progress.add('downloaded')
+            self._progress.add('bytes_downloaded', os.path.getsize(task.local_path))
+            return task
+        except Exception as e:
+            # partial download is deleted, the space is reserved again by the next attempt
+            if task.local_path is not None:
+                self._temp.release(task.local_path)
+                task.local_path = None
+            self._handle_error(session_id, task, stage, e)
+            return None
+
+    def _upload_to(self, session_id: int, task: FileTask, account: str) -> Optional[Exception]:
+        """
+        :return: error of a failed upload
+        """
+        file = task.file
+        try:
+            logging.info(f"Uploading: {file.name}{account_label(account)}")
+            video = self._router.get(account).upload(task.local_path, upload_key(file))
+        except Exception as e:
+            return e
+        self._progress.add('bytes_uploaded', os.path.getsize(task.local_path))
+        self._save_uploaded(session_id, task, account, video)
+        return None
+
+    def _upload_file(self, session_id: int, task: FileTask, stage: Stage):
+        """
+        Uploads the file to its accounts concurrently, only failed accounts are retried
+        """
+        try:
+            errors = self._for_targets(lambda account: self._upload_to(session_id, task, account), task.targets)
+        except Exception:
+            # the upload is not recorded, the file is listed again and accounts which got it skip it by name
+            self._temp.release(task.local_path)
+            task.local_path = None
+            self._fail_file(task.file)
+            self._scheduler.done()
+            raise
+        task.targets = [a for a in task.targets if errors[a] is not None]
+        if len(task.targets) > 0:
+            self._handle_error(session_id, task, stage, errors[task.targets[0]])
+            return
+        try:
+            self._temp.release(task.local_path)
+            task.local_path = None
+        finally:
+            self._file_done(task.file)
+            self._scheduler.done()
+
+    def _save_uploaded(self, session_id: int, task: FileTask, account: str, video: UploadedVideo):
+        file = task.file
+        duplicates = self._book.add_uploaded(task, account, video)
+        record_uploaded(self._storage, session_id, account, file, video)
+        self._progress.add('uploaded')
+        content_hash = getattr(file, 'content_hash', None)
+        if content_hash is not None:
+            self._router.get(account).link_content(content_hash, video.id, file.path)
+            for d in duplicates:
+                self._save_duplicate(session_id, account, d, content_hash, video.id, file.path)
+                self._file_done(d)
+
+    def _run_pipeline(self, session_id: int, files: Iterable[FileInfoBase]) \
+            -> Tuple[List[Tuple[str, UploadedVideo]], List[FileInfoBase]]:
+        """
+        Runs listing -> filtering -> downloading -> uploading stages connected by bounded queues.
+        Download queue is bounded to limit the number of files waiting on disk for upload.
+        Failed downloads and uploads are put back to their stage by the retry scheduler
+        """
+        parallelism = int(os.getenv('PARALLELISM', '5'))
+        download_parallelism = int(os.getenv('DOWNLOAD_PARALLELISM', str(parallelism)))
+        upload_parallelism = int(os.getenv('UPLOAD_PARALLELISM', str(parallelism)))
+        queue_size = int(os.getenv('PIPELINE_QUEUE_SIZE', '100'))
+        upload_queue_size = int(os.getenv('UPLOAD_QUEUE_SIZE', str(upload_parallelism)))
+        # in link mode download threads hand temporary links to the uploader, only failed files are downloaded
+        self._link_mode = os.getenv('TRANSFER_MODE', 'download') == 'link'
+        accounts = len(self._router.accounts)
+        logging.info(f'Using {download_parallelism} download and {upload_parallelism} upload threads, '
+                     f'transfer mode {"link" if self._link_mode else "download"}, {accounts} accounts')
+
+        self._book = RunBook()
+        self._scheduler = RetryScheduler()
+        filter_stage = Stage('filter', lambda file: self._filter_file(session_id, file), 1, queue_size)
+        download_stage = Stage('download', lambda task: self._download_file(session_id, task, download_stage),
+                               download_parallelism, queue_size)
+        upload_stage = Stage('upload', lambda task: self._upload_file(session_id, task, upload_stage),
+                             upload_parallelism, upload_queue_size)
+        pipeline = Pipeline(filter_stage, download_stage, upload_stage)
+        self._scheduler.attach(download_stage)
+        self._scheduler.attach(upload_stage)
+        filter_stage.on_finished(self._scheduler.close)
+        self._scheduler.start()
+        # upload threads wait for uploads of their file to every account
+        self._account_pool = ThreadPoolExecutor(max(download_parallelism, upload_parallelism) * accounts,
+                                                thread_name_prefix='account')
+        try:
+            listed = pipeline.run(files)
+        finally:
+            self._scheduler.close()
+            self._scheduler.join()
+            self._account_pool.shutdown()
+        book = self._book
+        logging.info(f'Processed {listed} files, uploaded {len(book.uploaded)}, failed {len(book.failed)}, '
+                     f'linked {book.duplicates} duplicates')
+        return book.uploaded, book.failed
+
+    def _wait_all(self, uploaded: List[Tuple[str, UploadedVideo]]) -> Iterable[Tuple[str, str]]:
+        """
+        Polls encoding of videos of every account concurrently
+        :return: video id and final status, in the order statuses of all accounts arrive
+        """
+        accounts = self._router.accounts
+        results = queue.Queue()
+
+        def poll(account: str):
+            try:
+                uploader = self._router.get(account)
+                uploader.set_uploaded_videos([v for a, v in uploaded if a == account])
+                for result in uploader.wait_all():
+                    results.put(result)
+            finally:
+                results.put(None)
+
+        with ThreadPoolExecutor(len(accounts), thread_name_prefix='encoding') as pool:
+            polls = [pool.submit(poll, account) for account in accounts]
+            left = len(polls)
+            while left > 0:
+                result = results.get()
+                if result is None:
+                    left -= 1
+                    continue
+                yield result
+        for p in polls:
+            p.result()
+
+    def _do_index(self, full: bool):
+        accounts = self._router.accounts
+        with ThreadPoolExecutor(len(accounts), thread_name_prefix='index') as pool:
+            list(pool.map(lambda account: self._router.get(account).index(full), accounts))
         return True
 
-    def run(self):
+    def run(self, full_index: bool = False, wait_for_encoding: bool = False):
+        """
+        :param wait_for_encoding: poll uploaded videos until encoding is finished before completing the session.
+            Otherwise statuses are left to StatusPoller
+        """
         logging.info("Indexing uploader...")
-        if not self._do_index():
+        if not self._do_index(full_index):
             logging.warning("index unsuccessful")
             return
         logging.info("Indexing done. Started scanning source")
+        self._temp.clean()
         session_id = self._storage.create_session_id()
+        self._progress = Progress()
+        tracker = None
+        if self._progress_publisher is not None:
+            tracker = ProgressTracker(session_id, self._progress, self._progress_publisher)
+            tracker.start()
 
-        parallelism = int(os.getenv('PARALLELISM', '5'))
-        logging.info(f'Using {parallelism} threads to upload files')
-        pool = ThreadPool(parallelism)
         try:
-            total_uploaded = []
             logging.info(f'Enumerating files in {self._source._start_folder}')
-            all_files = list(self._source.get_files())
-            logging.info(f'Found {len(all_files)} total files in {self._source._start_folder}')
-            files = [f for f in all_files if is_file_match(f.filename)]
-            logging.info(f'Found {len(files)} matching files in {self._source._start_folder}')
-
-            while True:
-                results = pool.map(lambda file: self._handle_file(session_id, file), files)
-                pool.close()
-                pool.join()
-                not_uploaded_files = list(filter(lambda x: x is not None, map(lambda x: x[1], results)))
-                uploaded_videos = list(filter(lambda x: x is not None, map(lambda x: x[0], results)))
-                total_uploaded += uploaded_videos
-                if len(not_uploaded_files) > 0:
-                    files = not_uploaded_files
-                    logging.info(f"Not uploaded files: {len(not_uploaded_files)}. Retry")
-                else:
-                    break
-
-            self._uploader.set_uploaded_videos(total_uploaded)
-            logging.info(f"{total_uploaded} files uploaded. Waiting for processing completion")
-            for id, status in self._uploader.wait_all():
-                self._storage.update_video_status(id, status)
+            total_uploaded, not_uploaded_files = self._run_pipeline(session_id, self._source.get_files())
+            if len(not_uploaded_files) > 0:
+                logging.warning(f"Not uploaded files: {len(not_uploaded_files)}")
+
+            logging.info(f"{len(total_uploaded)} files uploaded")
+            self._source.commit(not_uploaded_files)
+            if wait_for_encoding:
+                logging.info("Waiting for processing completion")
+                names = {v.id: v.name for _, v in total_uploaded}
+                for id, status in self._wait_all(total_uploaded):
+                    self._storage.update_video_status(id, status)
+                    if status == VIDEO_STATUS_READY:
+                        self._progress.add('ready')
+                        if self._duplicator is not None:
+                            self._duplicator.on_ready(id, names.get(id))
+                    elif status == VIDEO_STATUS_ERROR:
+                        self._progress.add('encoding_failed')
+                if self._duplicator is not None:
+                    self._duplicator.retry_failed()
             logging.info(f"Done")
             self._storage.session_completed(session_id)
         except Exception as e:
             logging.exception(str(e))
             self._storage.session_completed_error(session_id, str(e))
+        finally:
+            if tracker is not None:
+                tracker.stop()
+
+
+class StatusPoller:
+    """
+    Refreshes encoding status of every stored video until it is ready or failed,
+    so upload runs do not have to wait for encoding
+    """
+    def __init__(self, storage: StorageBase, uploader: UploaderBase, duplicator: DuplicatorBase = None):
+        """
+        :param duplicator: creates ads of videos which encoding is finished
+        """
+        self._storage = storage
+        self._uploader = uploader
+        self._duplicator = duplicator
+
+    def poll(self) -> int:
+        """
+        Reloads all pending videos once
+        :return: number of videos still pending
+        """
+        if self._duplicator is not None:
+            self._duplicator.retry_failed()
+        pending = self._storage.get_pending_videos()
+        if len(pending) == 0:
+            return 0
+        ids = list(dict.fromkeys(id for id, _ in pending))
+        reloaded = self._uploader.reload_many([UploadedVideo(id) for id in ids])
+        left = 0
+        duplicated = set()  # linked files share the video, its ad is created once
+        for id, status in pending:
+            if id not in reloaded:
+                left += 1
+                continue
+            video = reloaded[id]
+            new_status = video.status if video is not None else VIDEO_STATUS_DELETED
+            if new_status != status:
+                logging.info(f"Video {id} status changed: {status} -> {new_status}")
+                self._storage.update_video_status(id, new_status)
+                if new_status == VIDEO_STATUS_READY and self._duplicator is not None and id not in duplicated:
+                    duplicated.add(id)
+                    self._duplicator.on_ready(id, video.name)
+            if new_status not in VIDEO_TERMINAL_STATUSES:
+                left += 1
+        logging.info(f"Polled {len(pending)} videos, {left} are still pending")
+        return left
+
+    def run(self, interval: float, once: bool = False):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                logging.exception(f"Status polling failed: {e}")
+            if once:
+                return
+            time.sleep(interval)
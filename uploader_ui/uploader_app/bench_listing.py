@@ -0,0 +1,124 @@
+"""
+Benchmark of DropBoxSource.get_files against a local fake Dropbox api server.
+
+The server serves files/list_folder and files/list_folder/continue for a synthetic tree of job folders
+with a fixed latency per request, the client is the real dropbox sdk with urls redirected to the server.
+
+    python -m uploader_ui.uploader_app.bench_listing --folders 200 --files 300 --latency 0.05 --fan-out 1 8 32
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from dropbox import dropbox
+
+from .source import DropBoxSource
+
+
+class FakeDropboxTree:
+    def __init__(self, folders: int, files_per_folder: int, page_size: int):
+        self.folders = [f'J{i}_Job' for i in range(1, folders + 1)]
+        self.files_per_folder = files_per_folder
+        self.page_size = page_size
+
+    def folder_entry(self, name: str) -> dict:
+        return {'.tag': 'folder', 'name': name, 'id': f'id:{name}',
+                'path_lower': f'/{name.lower()}', 'path_display': f'/{name}'}
+
+    def file_entry(self, folder: str, i: int) -> dict:
+        name = f'Channel=1_Platform=1_Job={folder[1:folder.index("_")]}_video{i}.mp4'
+        path = f'/{folder}/{name}'
+        return {'.tag': 'file', 'name': name, 'id': f'id:{folder}:{i}',
+                'client_modified': '2020-01-01T00:00:00Z', 'server_modified': '2020-01-01T00:00:00Z',
+                'rev': '0123456789abcdef', 'size': 1024 * 1024,
+                'path_lower': path.lower(), 'path_display': path, 'content_hash': '0' * 64}
+
+    def list_folder(self, path: str, recursive: bool) -> dict:
+        if path in ('', '/'):
+            return {'entries': [self.folder_entry(f) for f in self.folders], 'cursor': 'root:0', 'has_more': False}
+        return self.page(path.strip('/'), 0)
+
+    def page(self, folder: str, offset: int) -> dict:
+        entries = [self.folder_entry(folder)] if offset == 0 else []
+        end = min(offset + self.page_size, self.files_per_folder)
+        entries += [self.file_entry(folder, i) for i in range(offset, end)]
+        return {'entries': entries, 'cursor': f'{folder}:{end}', 'has_more': end < self.files_per_folder}
+
+
+def make_handler(tree: FakeDropboxTree, latency: float):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            arg = json.loads(self.rfile.read(int(self.headers['Content-Length'])) or b'{}')
+            time.sleep(latency)
+            if self.path == '/2/files/list_folder':
+                result = tree.list_folder(arg['path'], arg.get('recursive', False))
+            elif self.path == '/2/files/list_folder/continue':
+                folder, offset = arg['cursor'].split(':')
+                result = tree.page(folder, int(offset))
+            else:
+                self.send_error(404)
+                return
+            body = json.dumps(result).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class RedirectAdapter(requests.adapters.HTTPAdapter):
+    """
+    Sends requests made to https dropbox hosts to the local http server
+    """
+    def __init__(self, base_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self._base_url = base_url
+
+    def send(self, request, **kwargs):
+        request.url = self._base_url + request.url.split('/', 3)[3]
+        return super().send(request, **kwargs)
+
+
+def run(folders: int, files_per_folder: int, page_size: int, latency: float, fan_outs):
+    tree = FakeDropboxTree(folders, files_per_folder, page_size)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(tree, latency))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        for fan_out in fan_outs:
+            session = requests.Session()
+            session.mount('https://', RedirectAdapter(f'http://127.0.0.1:{server.server_port}/',
+                                                      pool_maxsize=max(fan_out, 1)))
+            dbx = dropbox.Dropbox('fake-token', session=session)
+            source = DropBoxSource(None, '/', list_parallelism=fan_out, dbx=dbx)
+            started = time.monotonic()
+            first = None
+            count = 0
+            for _ in source.get_files():
+                if first is None:
+                    first = time.monotonic() - started
+                count += 1
+            elapsed = time.monotonic() - started
+            print(f'fan-out {fan_out:3}: {count} entries in {elapsed:.2f}s, '
+                  f'first entry after {first or 0:.2f}s, {count / elapsed:.0f} entries/s')
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks job folders listing against a local fake Dropbox')
+    parser.add_argument('--folders', type=int, default=100)
+    parser.add_argument('--files', type=int, default=250, help='files per job folder')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per api request')
+    parser.add_argument('--fan-out', type=int, nargs='+', default=[1, 4, 8, 16])
+    args = parser.parse_args()
+    run(args.folders, args.files, args.page_size, args.latency, args.fan_out)
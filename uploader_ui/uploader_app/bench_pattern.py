@@ -0,0 +1,74 @@
+"""
+Micro benchmark of file filtering over a synthetic listing of job folders: folders, project files, previews,
+exports with and without attributes in their names.
+
+    python -m uploader_ui.uploader_app.bench_pattern --entries 500000
+"""
+import argparse
+import logging
+import random
+import time
+
+from .pattern import PATTERN, match_file
+from .source import DropBoxFile
+
+ATTRIBUTES = ('Channel', 'Platform', 'Creative-Theme', 'Template', 'Job', 'Version-Opener', 'Length', 'Copy', 'Creator',
+              'Gender-Targeting', 'Geo-Targeting', 'Language-Targeting', 'Age-Targeting', 'Interest-Targeting',
+              'Actor-Gender', 'Actor-Age', 'Actor-Demo')
+OTHER_EXTENSIONS = ('.prproj', '.aep', '.mov', '.jpg', '.png', '.wav', '.psd', '.srt')
+
+
+def make_entry(rnd: random.Random, i: int) -> DropBoxFile:
+    job = rnd.randrange(1, 1000)
+    kind = rnd.random()
+    if kind < 0.25:
+        name = rnd.choice((f'J{job}_Project', 'Exports', 'Assets', f'T{rnd.randrange(20)}', f'V{rnd.randrange(5)}'))
+        return DropBoxFile(name, f'/Jobs/J{job}_Project/{name}', is_folder=True)
+    if kind < 0.55:
+        name = f'asset_{i}{rnd.choice(OTHER_EXTENSIONS)}'
+    elif kind < 0.65:
+        name = f'J{job}_final_v{rnd.randrange(9)}.mp4'
+    else:
+        name = '_'.join(f'{a}={rnd.randrange(1, 40)}' for a in ATTRIBUTES[:rnd.randrange(3, len(ATTRIBUTES) + 1)]) + '.mp4'
+    return DropBoxFile(name, f'/Jobs/J{job}_Project/Exports/{name}', size=rnd.randrange(10 ** 6, 10 ** 9))
+
+
+def legacy_is_file_match(filename):
+    logging.debug(f"filename: {filename}")
+    r = PATTERN.match(filename) is not None
+    logging.debug(f"done: {r} {filename}")
+    return r
+
+
+def legacy_filter(entries):
+    # pattern was checked when files were enumerated and once again when every file was handled
+    return sum(1 for f in entries if legacy_is_file_match(f.filename) and legacy_is_file_match(f.name))
+
+
+def current_filter(entries):
+    for f in entries:
+        f.pattern_match = None
+    return sum(1 for f in entries if match_file(f) and match_file(f))
+
+
+def run(count: int, repeat: int):
+    rnd = random.Random(42)
+    entries = [make_entry(rnd, i) for i in range(count)]
+    for name, check in (('legacy', legacy_filter), ('current', current_filter)):
+        best = None
+        matched = 0
+        for _ in range(repeat):
+            started = time.perf_counter()
+            matched = check(entries)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        print(f'{name:8}: {matched} of {count} entries matched, best of {repeat} {best:.3f}s, '
+              f'{count / best / 1000:.0f}k entries/s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks filename filter over a synthetic dropbox listing')
+    parser.add_argument('--entries', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    run(args.entries, args.repeat)
@@ -0,0 +1,174 @@
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from .pattern import get_attributes
+from .routing import AccountRouter, DEFAULT_ACCOUNT
+from .source import FileInfoBase
+from .storage import StorageBase
+from .uploader import UploadedVideo
+
+
+class FileTask:
+    """
+    File travelling through the pipeline stages
+    """
+    def __init__(self, file: FileInfoBase, targets: List[str] = None):
+        self.file = file
+        self.local_path = None
+        self.attempts = 0
+        self.targets = list(targets or [DEFAULT_ACCOUNT])  # accounts the file is not uploaded to yet
+        self.videos = {}  # type: Dict[str, UploadedVideo]  uploaded videos by account
+        # files with the same content by account, linked once the upload to the account is done
+        self.duplicates = {}  # type: Dict[str, List[FileInfoBase]]
+        self.link_failed = False  # transfer by url failed, the file is downloaded and uploaded instead
+
+
+def account_label(account: str) -> str:
+    """
+    Account appended to log messages of a file, nothing for a single account uploader
+    """
+    return f" ({account})" if account != DEFAULT_ACCOUNT else ""
+
+
+def route_file(router: AccountRouter, file: FileInfoBase) -> List[str]:
+    """
+    :return: accounts the file is routed to which do not have a video with its name
+    """
+    targets = []
+    for account in router.route(file):
+        if not router.get(account).should_be_uploaded(file.name):
+            logging.info(f"Skip: {file.name}{account_label(account)}")
+            continue
+        targets.append(account)
+    return targets
+
+
+def record_uploaded(storage: StorageBase, session_id: int, account: str, file: FileInfoBase, video: UploadedVideo):
+    storage.create_video(session_id, video.id, file.name, file.path, attributes=get_attributes(file),
+                         account_id=account)
+    logging.info(f"Successful upload: {file.name}{account_label(account)}")
+
+
+def record_duplicate(storage: StorageBase, session_id: int, account: str, file: FileInfoBase, video_id: str,
+                     duplicate_of: str):
+    logging.info(f"Duplicate: {file.name} has the same content as {duplicate_of}, linked to video {video_id}")
+    storage.create_video(session_id, video_id, file.name, file.path, duplicate_of=duplicate_of,
+                         attributes=get_attributes(file), account_id=account)
+
+
+def record_failed(storage: StorageBase, session_id: int, account: str, file: FileInfoBase):
+    storage.create_video(session_id, "", file.name, file.path, "error", attributes=get_attributes(file),
+                         account_id=account)
+
+
+class RunBook:
+    """
+    State of one upload run shared by Uploader and AsyncUploader: files being uploaded by content hash,
+    duplicates waiting for them, holds of files which are not done yet, uploaded and failed files.
+    Methods are thread safe and do not call the source, uploaders or storage, drivers do it with returned values
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.uploaded = []  # type: List[Tuple[str, UploadedVideo]]  account and video
+        self.failed = []  # type: List[FileInfoBase]
+        self.duplicates = 0
+        self._contents = {}  # type: Dict[Tuple[str, str], FileTask]  by account and content hash
+        # files not done yet by path: number of their tasks and links waiting for uploads, and whether any failed
+        self._holds = {}  # type: Dict[str, Tuple[int, bool]]
+
+    def _hold(self, file: FileInfoBase):
+        count, failed = self._holds.get(file.path, (0, False))
+        self._holds[file.path] = (count + 1, failed)
+
+    def hold(self, file: FileInfoBase):
+        """
+        Held while filtering, so links waiting for uploads of other files do not finish the file early.
+        The hold passes to the task of the file
+        """
+        with self._lock:
+            self._hold(file)
+
+    def release(self, file: FileInfoBase, failed: bool = False) -> Optional[bool]:
+        """
+        Releases a hold of the file
+        :return: None while the file is still held, otherwise whether any of its holds failed,
+            the source is told the file is done
+        """
+        with self._lock:
+            count, any_failed = self._holds.pop(file.path, (1, False))
+            any_failed = any_failed or failed
+            if count > 1:
+                self._holds[file.path] = (count - 1, any_failed)
+                return None
+        return any_failed
+
+    def find_original(self, account: str, file: FileInfoBase, content_hash: str) -> Optional[Tuple[Optional[str], str]]:
+        """
+        Finds a file with the same content uploaded to the account by this run.
+        If its upload is not done, the file is held and linked once the original is uploaded
+        :return: video id of the original, None while it is uploading, and its path; None if there is no original
+        """
+        with self._lock:
+            original = self._contents.get((account, content_hash))
+            if original is None:
+                return None
+            video = original.videos.get(account)
+            if video is None:
+                logging.info(f"Duplicate: {file.name} has the same content as {original.file.path} being uploaded"
+                             f"{account_label(account)}")
+                original.duplicates.setdefault(account, []).append(file)
+                self._hold(file)
+                return None, original.file.path
+        return video.id, original.file.path
+
+    def add_task(self, task: FileTask):
+        """
+        Files with the same content found while the task is uploading wait for it
+        """
+        content_hash = getattr(task.file, 'content_hash', None)
+        if content_hash is None:
+            return
+        with self._lock:
+            for account in task.targets:
+                self._contents[(account, content_hash)] = task
+
+    def add_failed(self, file: FileInfoBase):
+        """
+        Files failed by unexpected errors are listed again by the next run
+        """
+        with self._lock:
+            if file not in self.failed:
+                self.failed.append(file)
+
+    def add_duplicate(self):
+        with self._lock:
+            self.duplicates += 1
+
+    def add_uploaded(self, task: FileTask, account: str, video: UploadedVideo) -> List[FileInfoBase]:
+        """
+        :return: duplicates waiting for the upload, they are linked to the video and released by the driver
+        """
+        video.name = video.name or task.file.name
+        with self._lock:
+            self.uploaded.append((account, video))
+            task.videos[account] = video
+            return task.duplicates.pop(account, [])
+
+    def give_up(self, task: FileTask) -> List[Tuple[str, FileInfoBase]]:
+        """
+        Forgets the task, its file and duplicates waiting for it are listed again by the next run,
+        even if some accounts got the file
+        :return: account and file of every failed upload, held duplicates are released by the driver
+        """
+        file = task.file
+        content_hash = getattr(file, 'content_hash', None)
+        failed = []  # type: List[Tuple[str, FileInfoBase]]
+        with self._lock:
+            for account in task.targets:
+                if self._contents.get((account, content_hash)) is task:
+                    del self._contents[(account, content_hash)]
+                failed.extend((account, f) for f in [file] + task.duplicates.pop(account, []))
+            task.targets = []
+            self.failed.extend(dict.fromkeys(f for _, f in failed))
+        return failed
@@ -0,0 +1,80 @@
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """
+    Thread safe cache of graph api objects shared by all workers, entries expire ttl seconds after they were loaded.
+    Concurrent misses of the same key load it once, hits and misses are counted to see how many calls are saved
+    """
+    def __init__(self, ttl: float = None, clock=time.monotonic):
+        self._ttl = ttl or float(os.getenv('AD_TEMPLATE_CACHE_TTL', '3600'))
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = {}  # type: Dict[Hashable, Tuple[float, Any]]  expiry time and value
+        self._loading = {}  # type: Dict[Hashable, threading.Lock]
+        self._hits = 0
+        self._misses = 0
+        self._next_purge = clock() + self._ttl
+
+    def _lookup(self, key: Hashable) -> Tuple[bool, Any]:
+        """
+        Called with the lock held
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > self._clock():
+            self._hits += 1
+            return True, entry[1]
+        return False, None
+
+    def _purge(self):
+        """
+        Drops expired entries once per ttl, called with the lock held
+        """
+        now = self._clock()
+        if now < self._next_purge:
+            return
+        self._entries = {k: e for k, e in self._entries.items() if e[0] > now}
+        self._next_purge = now + self._ttl
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        :return: cached value, None if it is missing or expired
+        """
+        with self._lock:
+            found, value = self._lookup(key)
+            if not found:
+                self._misses += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._purge()
+            self._entries[key] = (self._clock() + self._ttl, value)
+
+    def get_or_load(self, key: Hashable, load: Callable[[], Any]) -> Any:
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                return value
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                found, value = self._lookup(key)
+                if found:
+                    return value
+                self._misses += 1
+            try:
+                value = load()
+                self.put(key, value)
+                return value
+            finally:
+                with self._lock:
+                    if self._loading.get(key) is key_lock:
+                        del self._loading[key]
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses, 'size': len(self._entries)}
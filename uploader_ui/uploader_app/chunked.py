@@ -0,0 +1,104 @@
+import logging
+import os
+
+from facebook_business import FacebookAdsApi
+from facebook_business.exceptions import FacebookRequestError
+
+from .ratelimit import THROTTLING_ERROR_CODES
+
+VIDEO_GRAPH_URL = 'https://graph-video.facebook.com'
+ERROR_SUBCODE_WRONG_OFFSET = 1363037
+
+
+class UploadSession:
+    def __init__(self, key, account_id, upload_session_id, video_id, file_size, start_offset, end_offset):
+        self.key = key
+        self.account_id = account_id
+        self.upload_session_id = upload_session_id
+        self.video_id = video_id
+        self.file_size = file_size
+        self.start_offset = start_offset
+        self.end_offset = end_offset
+
+
+class ChunkedUploader:
+    """
+    Uploads videos with upload_phase=start/transfer/finish protocol.
+    Session and acknowledged offset are saved after every chunk, so an upload interrupted by a crash
+    or network error continues from the last acknowledged chunk.
+    Chunks are sent one by one: every transfer response defines the offsets of the next chunk
+    """
+    def __init__(self, api: FacebookAdsApi, act_id: str, session_storage):
+        """
+        :param session_storage: UploadSessionStorageBase
+        """
+        self._api = api
+        self._act_id = act_id
+        self._session_storage = session_storage
+
+    def _call(self, params: dict, files: dict = None) -> dict:
+        return self._api.call('POST', (self._act_id, 'advideos'), params=params, files=files,
+                              url_override=VIDEO_GRAPH_URL).json()
+
+    def _start(self, key: str, file_size: int) -> UploadSession:
+        r = self._call({'upload_phase': 'start', 'file_size': file_size})
+        session = UploadSession(key, self._act_id, r['upload_session_id'], r['video_id'], file_size,
+                                int(r['start_offset']), int(r['end_offset']))
+        self._session_storage.save_upload_session(session)
+        return session
+
+    def _transfer(self, path: str, session: UploadSession):
+        name = os.path.basename(path)
+        with open(path, 'rb') as f:
+            while session.start_offset < session.end_offset:
+                f.seek(session.start_offset)
+                chunk = f.read(session.end_offset - session.start_offset)
+                try:
+                    r = self._call({
+                        'upload_phase': 'transfer',
+                        'upload_session_id': session.upload_session_id,
+                        'start_offset': session.start_offset,
+                    }, {'video_file_chunk': (name, chunk, 'multipart/form-data')})
+                except FacebookRequestError as e:
+                    error_data = (e.body() or {}).get('error', {}).get('error_data', {})
+                    if e.api_error_subcode() != ERROR_SUBCODE_WRONG_OFFSET or 'start_offset' not in error_data:
+                        raise
+                    # facebook expects other offsets, e.g. chunk was received but response was lost
+                    r = error_data
+                session.start_offset = int(r['start_offset'])
+                session.end_offset = int(r['end_offset'])
+                self._session_storage.save_upload_session(session)
+
+    def _finish(self, session: UploadSession, title: str):
+        self._call({
+            'upload_phase': 'finish',
+            'upload_session_id': session.upload_session_id,
+            'title': title,
+        })
+
+    def upload(self, path: str, key: str) -> str:
+        """
+        :param key: identifies file content between runs, e.g. source path and content hash
+        :return: video id
+        """
+        file_size = os.path.getsize(path)
+        key = f"{self._act_id}/{key}"
+        session = self._session_storage.get_upload_session(key)
+        if session is not None and session.file_size != file_size:
+            self._session_storage.delete_upload_session(key)
+            session = None
+        resumed = session is not None
+        if resumed:
+            logging.info(f'Resuming upload of {path} from offset {session.start_offset} of {file_size}')
+        else:
+            session = self._start(key, file_size)
+        try:
+            self._transfer(path, session)
+            self._finish(session, os.path.basename(path))
+        except FacebookRequestError as e:
+            if resumed and not e.api_transient_error() and e.api_error_code() not in THROTTLING_ERROR_CODES:
+                # session has probably expired, next attempt starts over
+                self._session_storage.delete_upload_session(key)
+            raise
+        self._session_storage.delete_upload_session(key)
+        return session.video_id
@@ -0,0 +1,243 @@
+import logging
+import os
+import threading
+from abc import ABCMeta
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from facebook_business import FacebookAdsApi
+from facebook_business.api import FacebookResponse
+
+from .cache import TTLCache
+from .pattern import parse_attributes
+from .storage import AdDuplicationStorageBase
+
+# template creative fields used to build creatives of copied ads
+CREATIVE_FIELDS = ('name', 'object_story_spec', 'url_tags')
+THUMBNAIL_FIELDS = ('uri', 'is_preferred')
+
+
+class DuplicatorBase(metaclass=ABCMeta):
+    def on_ready(self, video_id: str, name: Optional[str]):
+        """
+        Called when encoding of an uploaded video is finished
+        :param name: video title, which is the name of the uploaded file
+        """
+        raise NotImplementedError
+
+    def retry_failed(self) -> int:
+        """
+        Duplicates again videos which ads were not created by earlier attempts, called periodically
+        :return: number of retried videos
+        """
+        return 0
+
+    def close(self):
+        """
+        Waits for started duplications, called on shutdown
+        """
+        pass
+
+
+class AdDuplicator(DuplicatorBase):
+    """
+    Creates ads of ready videos from a template campaign.
+    Template campaign is deep copied once per Job attribute, then for every video the first ad set of the copy
+    is deep copied and its ad gets a new creative with the video.
+    Videos are duplicated concurrently, every graph call goes through the api, so GovernedFacebookAdsApi limits them
+    """
+    def __init__(self, api: FacebookAdsApi, act_id: str, template_campaign_id: str, parallelism: int = None,
+                 cache: TTLCache = None, duplication_storage: AdDuplicationStorageBase = None,
+                 max_attempts: int = None):
+        """
+        :param cache: template objects and video thumbnails shared by all workers, keyed by object path and fields
+        :param duplication_storage: keeps job campaign copies and created ads between runs, so a video gets one ad
+            and failed duplications are retried. Campaigns are copied again by every run if None
+        :param max_attempts: failed duplication attempts of a video before it is not retried anymore
+        """
+        self._api = api
+        self._act_id = act_id
+        self._template_id = template_campaign_id
+        self._executor = ThreadPoolExecutor(parallelism or int(os.getenv('AD_DUPLICATION_PARALLELISM', '4')),
+                                            thread_name_prefix='duplicate')
+        self._lock = threading.Lock()
+        self._cache = cache or TTLCache()
+        self._jobs = {}  # type: Dict[str, Tuple[threading.Lock, Optional[str]]]  lock and template ad set of copy
+        self._storage = duplication_storage
+        self._max_attempts = max_attempts or int(os.getenv('AD_DUPLICATION_ATTEMPTS', '3'))
+        self._running = set()  # ids of videos submitted and not finished yet
+
+    def _call(self, method: str, path: tuple, params: dict = None) -> dict:
+        return self._api.call(method, path, params).json()
+
+    def _batch(self, calls: List[Tuple[str, tuple, Optional[dict]]]) -> List[dict]:
+        """
+        Sends independent calls in one graph api batch
+        :raise Exception if any call failed
+        """
+        results = [None] * len(calls)
+        errors = []
+
+        def on_success(i: int, r: FacebookResponse):
+            results[i] = r.json()
+
+        def on_failure(i: int, r: FacebookResponse):
+            errors.append(f'{calls[i][0]} {"/".join(calls[i][1])}: {r.json()}')
+
+        batch = self._api.new_batch()
+        for i, (method, path, params) in enumerate(calls):
+            batch.add(method, path, params,
+                      success=lambda r, i=i: on_success(i, r),
+                      failure=lambda r, i=i: on_failure(i, r))
+        retries = 3
+        while batch is not None and retries > 0:
+            batch = batch.execute()
+            retries -= 1
+        if len(errors) > 0 or batch is not None:
+            raise Exception(f'graph api batch failed: {"; ".join(errors) or "no response"}')
+        return results
+
+    def _get_cached(self, path: tuple, fields: Tuple[str, ...]) -> dict:
+        params = {'fields': ','.join(fields)}
+        return self._cache.get_or_load((path, fields), lambda: self._call('GET', path, params))
+
+    def _get_template_name(self) -> str:
+        return self._get_cached((self._template_id,), ('name',))['name']
+
+    def _get_job_adset(self, job: str) -> str:
+        """
+        Copies template campaign for the job once
+        :return: id of the ad set copied with the campaign, it is the template of the job video ad sets
+        """
+        with self._lock:
+            if job not in self._jobs:
+                self._jobs[job] = (threading.Lock(), None)
+            job_lock, adset_id = self._jobs[job]
+        if adset_id is not None:
+            return adset_id
+        with job_lock:
+            adset_id = self._jobs[job][1]
+            if adset_id is None and self._storage is not None:
+                adset_id = self._storage.get_job_adset(self._template_id, job)
+            if adset_id is not None:
+                with self._lock:
+                    self._jobs[job] = (job_lock, adset_id)
+                return adset_id
+            name = self._get_template_name() + job
+            copied = self._call('POST', (self._template_id, 'copies'), {'deep_copy': True})
+            campaign_id = copied['copied_campaign_id']
+            _, adsets = self._batch([
+                ('POST', (campaign_id,), {'name': name}),
+                ('GET', (campaign_id, 'adsets'), {'fields': 'id', 'limit': 1}),
+            ])
+            if len(adsets['data']) == 0:
+                raise Exception(f'copied campaign {campaign_id} has no ad sets')
+            adset_id = adsets['data'][0]['id']
+            logging.info(f'Campaign {campaign_id} "{name}" copied for job {job}')
+            if self._storage is not None:
+                self._storage.save_job_adset(self._template_id, job, campaign_id, adset_id)
+            with self._lock:
+                self._jobs[job] = (job_lock, adset_id)
+            return adset_id
+
+    def _get_creative(self, creative_id: str) -> dict:
+        """
+        Copied ads share the creative of the template ad, so it is read by id once per cache ttl
+        """
+        return self._get_cached((creative_id,), CREATIVE_FIELDS)
+
+    def _creative_params(self, template: dict, video_id: str, name: str, thumbnails: List[dict]) -> dict:
+        spec = dict(template['object_story_spec'])
+        video_data = dict(spec.get('video_data', {}))
+        video_data.pop('image_hash', None)
+        video_data['video_id'] = video_id
+        if len(thumbnails) > 0:
+            preferred = [t for t in thumbnails if t.get('is_preferred')]
+            video_data['image_url'] = (preferred or thumbnails)[0]['uri']
+        spec['video_data'] = video_data
+        params = {'name': name, 'object_story_spec': spec}
+        if template.get('url_tags'):
+            params['url_tags'] = template['url_tags']
+        return params
+
+    def duplicate(self, video_id: str, name: str) -> Optional[str]:
+        """
+        Ad set copied by a failed attempt is reused, a video which ad is stored is not duplicated again
+        :return: id of the created ad, None if the video name has no Job attribute
+        """
+        job = parse_attributes(name).get('Job')
+        if job is None:
+            logging.info(f'Not duplicating ad for video {video_id}: no Job in "{name}"')
+            return None
+        adset_id, ad_id = None, None
+        if self._storage is not None:
+            adset_id, ad_id = self._storage.get_video_ad(self._template_id, video_id)
+        if ad_id is not None:
+            logging.info(f'Ad {ad_id} of video {video_id} is already created')
+            return ad_id
+        if adset_id is None:
+            template_adset = self._get_job_adset(str(job))
+            adset_id = self._call('POST', (template_adset, 'copies'), {'deep_copy': True})['copied_adset_id']
+            if self._storage is not None:
+                self._storage.save_video_ad(self._template_id, video_id, name, adset_id)
+        thumbnails_key = ((video_id, 'thumbnails'), THUMBNAIL_FIELDS)
+        thumbnails = self._cache.get(thumbnails_key)
+        calls = [
+            ('POST', (adset_id,), {'name': name}),
+            ('GET', (adset_id, 'ads'), {'fields': 'id,creative{id}', 'limit': 1}),
+        ]
+        if thumbnails is None:
+            calls.append(('GET', (video_id, 'thumbnails'), {'fields': ','.join(THUMBNAIL_FIELDS)}))
+        results = self._batch(calls)
+        ads = results[1]
+        if thumbnails is None:
+            thumbnails = results[2]
+            self._cache.put(thumbnails_key, thumbnails)
+        if len(ads['data']) == 0:
+            raise Exception(f'copied ad set {adset_id} has no ads')
+        ad = ads['data'][0]
+        template = self._get_creative(ad['creative']['id'])
+        creative = self._call('POST', (self._act_id, 'adcreatives'),
+                              self._creative_params(template, video_id, name, thumbnails['data']))
+        self._call('POST', (ad['id'],), {'name': name, 'creative': {'creative_id': creative['id']}})
+        if self._storage is not None:
+            self._storage.save_video_ad(self._template_id, video_id, name, adset_id, ad['id'])
+        logging.info(f'Ad {ad["id"]} in ad set {adset_id} created for video {video_id} "{name}"')
+        return ad['id']
+
+    def _duplicate_logged(self, video_id: str, name: str) -> Optional[str]:
+        try:
+            return self.duplicate(video_id, name)
+        except Exception as e:
+            logging.exception(f'Ad duplication failed for video {video_id} "{name}": {e}')
+            if self._storage is not None:
+                self._storage.video_failed(self._template_id, video_id, name, str(e))
+            raise
+        finally:
+            with self._lock:
+                self._running.discard(video_id)
+
+    def on_ready(self, video_id: str, name: Optional[str]) -> Future:
+        with self._lock:
+            self._running.add(video_id)
+        return self._executor.submit(self._duplicate_logged, video_id, name or '')
+
+    def retry_failed(self) -> int:
+        if self._storage is None:
+            return 0
+        with self._lock:
+            running = set(self._running)
+        failed = [(id, name) for id, name in self._storage.get_failed(self._template_id, self._max_attempts)
+                  if id not in running]
+        if len(failed) > 0:
+            logging.info(f'Retrying ad duplication of {len(failed)} videos')
+        for id, name in failed:
+            self.on_ready(id, name)
+        return len(failed)
+
+    def metrics(self) -> dict:
+        return {'cache': self._cache.metrics()}
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        logging.info(f'Ad duplication: {self.metrics()}')
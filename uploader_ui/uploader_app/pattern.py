@@ -1,11 +1,59 @@
 import re
-import logging
+from typing import Dict, Union
 
 PATTERN = re.compile(r"^([^=]+?=[^=]+?_){3,}.*\.mp4$", re.IGNORECASE)
+EXTENSION = '.mp4'
+NUMBER = re.compile(r"[0-9]+")
+MAX_NUMBER = 2 ** 63 - 1  # attribute numbers are stored in a signed 64-bit column
 
 
-def is_file_match(filename):
-    logging.debug(f"filename: {filename}")
-    r = PATTERN.match(filename) is not None
-    logging.debug(f"done: {r} {filename}")
-    return r
+def is_file_match(filename: str) -> bool:
+    """
+    Most of listed entries are folders, project files and previews, so extension and '=' are checked before the regex
+    """
+    return filename[-4:].lower() == EXTENSION and '=' in filename and PATTERN.match(filename) is not None
+
+
+def match_file(file) -> bool:
+    """
+    Checks FileInfoBase against PATTERN once, the result is kept on the file
+    """
+    if file.pattern_match is None:
+        file.pattern_match = not file.is_folder and is_file_match(file.name)
+    return file.pattern_match
+
+
+def parse_value(value: str) -> Union[int, str]:
+    """
+    :return: int for ASCII decimal values fitting a signed 64-bit integer, otherwise the value itself
+    """
+    if NUMBER.fullmatch(value) is not None and int(value) <= MAX_NUMBER:
+        return int(value)
+    return value
+
+
+def parse_attributes(filename: str) -> Dict[str, Union[int, str]]:
+    """
+    Splits Key=Value_Key=Value.mp4 name to attributes, numeric values are converted to int by parse_value.
+    Parts without '=' belong to the value of the previous attribute, e.g. Template=T14_final
+    """
+    if filename[-4:].lower() == EXTENSION:
+        filename = filename[:-4]
+    attributes = {}
+    key = None
+    for part in filename.split('_'):
+        if '=' in part:
+            key, value = part.split('=', 1)
+            attributes[key] = value
+        elif key is not None:
+            attributes[key] += '_' + part
+    return {k: parse_value(v) for k, v in attributes.items() if k != ''}
+
+
+def get_attributes(file) -> Dict[str, Union[int, str]]:
+    """
+    Attributes of FileInfoBase name, parsed once and kept on the file
+    """
+    if file.attributes is None:
+        file.attributes = parse_attributes(file.name) if match_file(file) else {}
+    return file.attributes
@@ -0,0 +1,113 @@
+import logging
+import threading
+from queue import Queue
+from typing import Callable, Iterable, Any, Optional
+
+_STOP = object()
+
+
+class Stage:
+    """
+    Pool of worker threads consuming items from a bounded queue.
+    put() blocks while the queue is full, so a slow stage holds back its producers.
+    Every not None handler result is passed to the downstream stage.
+    """
+    def __init__(self, name: str, handler: Callable[[Any], Optional[Any]], parallelism: int, capacity: int):
+        self.name = name
+        self._handler = handler
+        self._parallelism = max(parallelism, 1)
+        self._queue = Queue(max(capacity, 1))
+        self._downstream = None
+        self._finish_callbacks = []
+        self._threads = []
+        self._lock = threading.Lock()
+        self._producers = 0
+        self._running = 0
+
+    def connect(self, downstream: 'Stage') -> 'Stage':
+        self._downstream = downstream
+        downstream.add_producer()
+        return downstream
+
+    def on_finished(self, callback: Callable[[], None]):
+        """
+        Registers callback called once all workers of the stage have stopped
+        """
+        self._finish_callbacks.append(callback)
+
+    def add_producer(self):
+        with self._lock:
+            self._producers += 1
+
+    def producer_done(self):
+        """
+        Called by every producer once it will not put items anymore.
+        Workers are stopped after the last producer is done and the queue is drained
+        """
+        with self._lock:
+            self._producers -= 1
+            last = self._producers == 0
+        if last:
+            for _ in range(self._parallelism):
+                self._queue.put(_STOP)
+
+    def put(self, item):
+        self._queue.put(item)
+
+    def start(self):
+        self._running = self._parallelism
+        for i in range(self._parallelism):
+            t = threading.Thread(target=self._work, name=f'{self.name}-{i}', daemon=True)
+            self._threads.append(t)
+            t.start()
+
+    def join(self):
+        for t in self._threads:
+            t.join()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            try:
+                result = self._handler(item)
+            except Exception as e:
+                logging.exception(f'{self.name} stage failed: {e}')
+                continue
+            if result is not None and self._downstream is not None:
+                self._downstream.put(result)
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        if last:
+            if self._downstream is not None:
+                self._downstream.producer_done()
+            for callback in self._finish_callbacks:
+                callback()
+
+
+class Pipeline:
+    """
+    Chain of stages fed from an iterable in the calling thread
+    """
+    def __init__(self, *stages: Stage):
+        self._stages = stages
+        for upstream, downstream in zip(stages, stages[1:]):
+            upstream.connect(downstream)
+
+    def run(self, items: Iterable[Any]) -> int:
+        first = self._stages[0]
+        first.add_producer()
+        for s in self._stages:
+            s.start()
+        count = 0
+        try:
+            for item in items:
+                first.put(item)
+                count += 1
+        finally:
+            first.producer_done()
+            for s in self._stages:
+                s.join()
+        return count
@@ -0,0 +1,90 @@
+import logging
+import os
+import threading
+import time
+from abc import ABCMeta
+
+PROGRESS_COUNTERS = ('listed', 'queued', 'downloaded', 'uploaded', 'uploaded_by_link', 'linked', 'failed', 'ready',
+                     'encoding_failed', 'bytes_downloaded', 'bytes_uploaded')
+
+
+class Progress:
+    """
+    Counters of a running session, updated by pipeline threads
+    """
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(PROGRESS_COUNTERS, 0)
+        self._started = clock()
+        self._last_time = self._started
+        self._last_bytes = (0, 0)
+
+    def add(self, name: str, n: int = 1):
+        with self._lock:
+            self._counters[name] += n
+
+    def snapshot(self) -> dict:
+        """
+        Transfer rates are measured since the previous snapshot
+        """
+        with self._lock:
+            now = self._clock()
+            result = dict(self._counters)
+            elapsed = now - self._last_time
+            downloaded, uploaded = self._last_bytes
+            if elapsed > 0:
+                result['download_bytes_per_second'] = round((result['bytes_downloaded'] - downloaded) / elapsed)
+                result['upload_bytes_per_second'] = round((result['bytes_uploaded'] - uploaded) / elapsed)
+                self._last_time = now
+                self._last_bytes = (result['bytes_downloaded'], result['bytes_uploaded'])
+            else:
+                result['download_bytes_per_second'] = 0
+                result['upload_bytes_per_second'] = 0
+        # uploaded videos are being encoded until encoding is reported finished
+        result['encoding'] = max(0, result['uploaded'] - result['ready'] - result['encoding_failed'])
+        result['elapsed'] = round(now - self._started, 1)
+        return result
+
+
+class ProgressPublisherBase(metaclass=ABCMeta):
+    def publish(self, session_id: int, progress: dict):
+        """
+        :param progress: Progress snapshot, 'done' is True in the last snapshot of the session
+        """
+        raise NotImplementedError
+
+
+class ProgressTracker:
+    """
+    Publishes progress snapshots every interval seconds from a background thread
+    """
+    def __init__(self, session_id: int, progress: Progress, publisher: ProgressPublisherBase, interval: float = None):
+        self._session_id = session_id
+        self._progress = progress
+        self._publisher = publisher
+        self._interval = interval or float(os.getenv('PROGRESS_PUBLISH_INTERVAL', '1'))
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _publish(self, done: bool):
+        try:
+            self._publisher.publish(self._session_id, {**self._progress.snapshot(), 'done': done,
+                                                       'updated_at': time.time()})
+        except Exception as e:
+            logging.warning(f'Unable to publish progress of session {self._session_id}: {e}')
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self._publish(False)
+
+    def start(self):
+        self._publish(False)
+        self._thread = threading.Thread(target=self._run, name='progress', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._publish(True)
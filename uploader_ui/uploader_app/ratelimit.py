@@ -0,0 +1,185 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from facebook_business import FacebookAdsApi
+from facebook_business.exceptions import FacebookRequestError
+
+# https://developers.facebook.com/docs/graph-api/overview/rate-limiting
+THROTTLING_ERROR_CODES = (4, 17, 32, 613, 80000, 80003, 80004, 80005, 80009)
+
+
+def _parse_header(headers, name) -> Optional[dict]:
+    value = headers.get(name)
+    if not value:
+        return None
+    try:
+        return json.loads(value) if isinstance(value, str) else value
+    except ValueError:
+        logging.warning(f'Unable to parse {name} header: {value}')
+        return None
+
+
+class RateGovernor:
+    """
+    Token bucket shared by all threads calling graph api.
+    Refill rate goes down from max_rate to min_rate as reported usage grows from slowdown_threshold to 100%,
+    calls are paused after throttling until facebook reported estimated_time_to_regain_access
+    """
+    def __init__(self,
+                 max_rate: float = None,
+                 min_rate: float = None,
+                 slowdown_threshold: float = None,
+                 throttle_pause: float = None,
+                 clock=time.monotonic,
+                 sleep=time.sleep):
+        self._max_rate = max_rate or float(os.getenv('FB_MAX_CALLS_PER_SECOND', '10'))
+        self._min_rate = min_rate or float(os.getenv('FB_MIN_CALLS_PER_SECOND', '0.1'))
+        self._threshold = slowdown_threshold or float(os.getenv('FB_USAGE_SLOWDOWN_PCT', '75'))
+        self._throttle_pause = throttle_pause or float(os.getenv('FB_THROTTLE_PAUSE', '60'))
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._rate = self._max_rate
+        self._tokens = self._max_rate
+        self._last_refill = clock()
+        self._paused_until = 0
+        self._usage = {}
+        self._calls = 0
+        self._throttled = 0
+        self._wait_time = 0
+        self._log_interval = float(os.getenv('FB_USAGE_LOG_INTERVAL', '60'))
+        self._last_log = clock()
+
+    def _take(self) -> float:
+        """
+        Takes a token if one is available
+        :return: seconds to wait before the next try, 0 if the token was taken
+        """
+        with self._lock:
+            now = self._clock()
+            wait = self._paused_until - now
+            if wait <= 0:
+                self._tokens = min(self._max_rate, self._tokens + (now - self._last_refill) * self._rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self._calls += 1
+                    return 0
+                wait = (1 - self._tokens) / self._rate
+            self._wait_time += wait
+            return wait
+
+    def acquire(self):
+        """
+        Blocks until the caller is allowed to make one api call
+        """
+        while True:
+            wait = self._take()
+            if wait <= 0:
+                return
+            self._sleep(wait)
+
+    async def acquire_async(self):
+        """
+        acquire for coroutines, waits without blocking the event loop
+        """
+        while True:
+            wait = self._take()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+            self._tokens = 0
+            self._last_refill = self._paused_until
+        logging.warning(f'Graph api calls paused for {seconds:.0f} seconds')
+
+    def observe_headers(self, headers):
+        """
+        Updates usage from x-app-usage, x-ad-account-usage and x-business-use-case-usage headers
+        :return: seconds of pause if access is blocked, otherwise 0
+        """
+        if not headers:
+            return 0
+        headers = {k.lower(): v for k, v in headers.items()}
+        usage = {}
+        regain = 0
+        app = _parse_header(headers, 'x-app-usage')
+        if app:
+            usage['app'] = max(app.get('call_count', 0), app.get('total_cputime', 0), app.get('total_time', 0))
+        account = _parse_header(headers, 'x-ad-account-usage')
+        if account:
+            usage['ad_account'] = account.get('acc_id_util_pct', 0)
+            if usage['ad_account'] >= 100:
+                regain = max(regain, account.get('reset_time_duration', 0))
+        business = _parse_header(headers, 'x-business-use-case-usage')
+        if business:
+            for business_id, cases in business.items():
+                for case in cases:
+                    key = f"{business_id}:{case.get('type')}"
+                    usage[key] = max(case.get('call_count', 0), case.get('total_cputime', 0), case.get('total_time', 0))
+                    regain = max(regain, case.get('estimated_time_to_regain_access', 0) * 60)
+        if not usage:
+            return 0
+        with self._lock:
+            self._usage.update(usage)
+            top = max(self._usage.values())
+            if top <= self._threshold:
+                self._rate = self._max_rate
+            else:
+                left = max(0.0, (100 - top) / (100 - self._threshold))
+                self._rate = max(self._min_rate, self._max_rate * left)
+            log = self._clock() - self._last_log >= self._log_interval
+            if log:
+                self._last_log = self._clock()
+        if log:
+            logging.info(f'Graph api usage: {self.metrics()}')
+        pause = regain if regain > 0 else (self._throttle_pause if top >= 100 else 0)
+        if pause > 0:
+            self.pause(pause)
+        return pause
+
+    def observe_error(self, e: FacebookRequestError):
+        regain = self.observe_headers(e.http_headers())
+        if e.api_error_code() in THROTTLING_ERROR_CODES or '#80004' in (e.api_error_message() or ''):
+            with self._lock:
+                self._throttled += 1
+            if regain == 0:
+                self.pause(self._throttle_pause)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                'usage_pct': dict(self._usage),
+                'rate': round(self._rate, 3),
+                'paused_for': round(max(0, self._paused_until - self._clock()), 1),
+                'calls': self._calls,
+                'throttled': self._throttled,
+                'wait_time': round(self._wait_time, 1),
+            }
+
+
+class GovernedFacebookAdsApi(FacebookAdsApi):
+    """
+    FacebookAdsApi passing every call, including sdk video uploads and batches, through RateGovernor
+    """
+    def __init__(self, session, governor: RateGovernor = None, api_version=None, enable_debug_logger=False):
+        super().__init__(session, api_version, enable_debug_logger)
+        self.governor = governor or RateGovernor()
+
+    def call(self, method, path, params=None, headers=None, files=None, url_override=None, api_version=None):
+        self.governor.acquire()
+        try:
+            response = super().call(method, path, params, headers, files, url_override, api_version)
+        except FacebookRequestError as e:
+            self.governor.observe_error(e)
+            raise
+        self.governor.observe_headers(response.headers())
+        return response
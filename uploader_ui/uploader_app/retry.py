@@ -0,0 +1,145 @@
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+from typing import Any, List
+
+from dropbox import exceptions as dropbox_exceptions
+from facebook_business.exceptions import FacebookRequestError
+
+from .pipeline import Stage
+from .uploader import TooManyCallsError
+
+ERROR_RATE_LIMIT = 'rate_limit'
+ERROR_TRANSIENT = 'transient'
+ERROR_PERMANENT = 'permanent'
+
+# https://developers.facebook.com/docs/graph-api/using-graph-api/error-handling
+FB_RATE_LIMIT_CODES = (4, 17, 32, 613, 80000, 80003, 80004, 80005, 80009)
+FB_TRANSIENT_CODES = (1, 2)
+
+
+def classify_error(e: Exception) -> str:
+    """
+    Splits errors to rate limit, transient (network, 5xx, corrupted download) and permanent ones.
+    Errors decoded by uploaders and sources are classified by the api error they were raised from.
+    Unknown errors are considered transient, they are retried while attempts budget allows
+    """
+    if isinstance(e, TooManyCallsError):
+        return ERROR_RATE_LIMIT
+    if isinstance(e, FacebookRequestError):
+        if e.api_error_code() in FB_RATE_LIMIT_CODES:
+            return ERROR_RATE_LIMIT
+        if e.api_transient_error() or e.api_error_code() in FB_TRANSIENT_CODES or (e.http_status() or 0) >= 500:
+            return ERROR_TRANSIENT
+        return ERROR_PERMANENT
+    if isinstance(e, dropbox_exceptions.RateLimitError):
+        return ERROR_RATE_LIMIT
+    if isinstance(e, (dropbox_exceptions.AuthError, dropbox_exceptions.ApiError)):
+        return ERROR_PERMANENT
+    if e.__cause__ is not None:
+        return classify_error(e.__cause__)
+    return ERROR_TRANSIENT
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts: int = None, base_delay: float = None, max_delay: float = None,
+                 rate_limit_delay: float = None):
+        self.max_attempts = max_attempts or int(os.getenv('RETRY_MAX_ATTEMPTS', '5'))
+        self.base_delay = base_delay if base_delay is not None else float(os.getenv('RETRY_BASE_DELAY', '2'))
+        self.max_delay = max_delay if max_delay is not None else float(os.getenv('RETRY_MAX_DELAY', '300'))
+        self.rate_limit_delay = rate_limit_delay if rate_limit_delay is not None \
+            else float(os.getenv('RETRY_RATE_LIMIT_DELAY', '60'))
+
+    def should_retry(self, attempts: int, error_class: str) -> bool:
+        return error_class != ERROR_PERMANENT and attempts < self.max_attempts
+
+    def delay(self, attempts: int, error_class: str) -> float:
+        """
+        Exponential backoff with full jitter around the computed delay
+        :param attempts: number of failed attempts so far, starts with 1
+        """
+        base = self.rate_limit_delay if error_class == ERROR_RATE_LIMIT else self.base_delay
+        delay = min(self.max_delay, base * (2 ** (attempts - 1)))
+        return delay * random.uniform(0.5, 1.5)
+
+
+class RetryScheduler:
+    """
+    Puts failed items back to pipeline stages once their delay has passed,
+    so retries are mixed with the rest of the work instead of waiting for the whole pass.
+
+    Every item accepted into the pipeline should be tracked with track() and finished with done().
+    The scheduler is a producer of attached stages and releases them when upstream is closed
+    and no tracked items remain.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = 0
+        self._tracked = 0
+        self._closed = False
+        self._stages = []  # type: List[Stage]
+        self._thread = None
+
+    def attach(self, stage: Stage):
+        stage.add_producer()
+        self._stages.append(stage)
+
+    def track(self):
+        with self._cond:
+            self._tracked += 1
+
+    def done(self):
+        with self._cond:
+            self._tracked -= 1
+            self._cond.notify()
+
+    def retry(self, item: Any, stage: Stage, delay: float):
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._heap, (time.monotonic() + delay, self._seq, item, stage))
+            self._cond.notify()
+
+    def close(self):
+        """
+        Called when no new items will be tracked
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._heap)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='retry', daemon=True)
+        self._thread.start()
+
+    def join(self):
+        self._thread.join()
+
+    def _next(self):
+        with self._cond:
+            while True:
+                if self._closed and self._tracked == 0:
+                    return None
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    _, _, item, stage = heapq.heappop(self._heap)
+                    return item, stage
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+
+    def _run(self):
+        while True:
+            n = self._next()
+            if n is None:
+                break
+            item, stage = n
+            stage.put(item)
+        logging.debug('retry scheduler finished')
+        for stage in self._stages:
+            stage.producer_done()
@@ -0,0 +1,63 @@
+import os
+from typing import Dict, List, Set
+
+from .pattern import get_attributes
+from .source import FileInfoBase
+
+DEFAULT_ACCOUNT = ''  # account of a single uploader given without routing
+
+
+def parse_routes(value: str) -> Dict[str, Dict[str, Set[str]]]:
+    """
+    Parses FB_ACCOUNT_ROUTES, e.g. act_1:Channel=1|2,Platform=1;act_2:*
+    :return: required file name attribute values of every account, empty for accounts getting every file
+    """
+    routes = {}
+    for rule in filter(None, (r.strip() for r in value.split(';'))):
+        account, _, conditions = rule.partition(':')
+        required = {}
+        for condition in filter(None, (c.strip() for c in conditions.split(','))):
+            if condition == '*':
+                continue
+            name, sep, values = condition.partition('=')
+            if sep == '':
+                raise ValueError(f'Invalid condition {condition} of account {account}, expected Name=Value')
+            required[name.strip()] = {v.strip() for v in values.split('|')}
+        routes[account.strip()] = required
+    return routes
+
+
+def get_routes() -> Dict[str, Dict[str, Set[str]]]:
+    """
+    Routes of FB_ACCOUNT_ROUTES, FB_ACT_ID gets every file if it is not set
+    """
+    return parse_routes(os.getenv('FB_ACCOUNT_ROUTES', '')) or {os.environ['FB_ACT_ID']: {}}
+
+
+class AccountRouter:
+    """
+    Ad accounts files are uploaded to. A file goes to every account which conditions match its name attributes,
+    so one listing and one download serve all accounts
+    """
+    def __init__(self, uploaders: dict, routes: Dict[str, Dict[str, Set[str]]] = None):
+        """
+        :param uploaders: uploader of every account
+        :param routes: required attribute values by account, accounts without conditions get every file
+        """
+        unknown = set(routes or {}) - set(uploaders)
+        if len(unknown) > 0:
+            raise ValueError(f'Routes of accounts without uploader: {", ".join(sorted(unknown))}')
+        self._uploaders = uploaders
+        self._routes = routes or {}
+
+    @property
+    def accounts(self) -> List[str]:
+        return list(self._uploaders)
+
+    def get(self, account: str):
+        return self._uploaders[account]
+
+    def route(self, file: FileInfoBase) -> List[str]:
+        attributes = {k: str(v) for k, v in get_attributes(file).items()}
+        return [a for a in self._uploaders
+                if all(attributes.get(name) in values for name, values in self._routes.get(a, {}).items())]
@@ -1,14 +1,26 @@
 import os
+import hashlib
 import logging
 import re
+import threading
+import time
 from abc import ABCMeta
-from typing import Generator
+from contextlib import closing
+from queue import Queue, Empty, Full
+from typing import Dict, Generator, List, Optional
 
 from dropbox import dropbox
 from dropbox import common
+from dropbox import files
+
+from .storage import ListingCursorStorageBase
 
 
 class FileInfoBase():
+    is_folder = False
+    pattern_match = None  # type: Optional[bool]  set by pattern.match_file
+    attributes = None  # type: Optional[dict]  set by pattern.get_attributes
+
     @property
     def path(self) -> str:
         raise NotImplementedError
@@ -25,11 +37,68 @@ class SourceBase(metaclass=ABCMeta):
     def download_file(self, file: FileInfoBase, destination_folder: str):
         raise NotImplementedError
 
+    def get_link(self, file: FileInfoBase) -> Optional[str]:
+        """
+        :return: temporary url of the file content, None if the source can not share files by url
+        """
+        return None
+
+    def file_done(self, file: FileInfoBase, failed: bool):
+        """
+        Called once the file is uploaded to all its accounts, linked, skipped or given up
+        """
+        pass
+
+    def commit(self, failed_files: List[FileInfoBase]):
+        """
+        Called after a successful run, so the next run can skip files seen by this one
+        :param failed_files: files which were not uploaded and have to be listed again
+        """
+        pass
+
+
+class ContentHashMismatchError(Exception):
+    pass
+
+
+class DropboxContentHasher:
+    """
+    Computes dropbox content_hash: sha256 over concatenated sha256 digests of every 4MB block
+    https://www.dropbox.com/developers/reference/content-hash
+    """
+    BLOCK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self):
+        self._overall = hashlib.sha256()
+        self._block = hashlib.sha256()
+        self._block_pos = 0
+
+    def update(self, data: bytes):
+        pos = 0
+        while pos < len(data):
+            if self._block_pos == self.BLOCK_SIZE:
+                self._overall.update(self._block.digest())
+                self._block = hashlib.sha256()
+                self._block_pos = 0
+            part = data[pos:pos + self.BLOCK_SIZE - self._block_pos]
+            self._block.update(part)
+            self._block_pos += len(part)
+            pos += len(part)
+
+    def hexdigest(self) -> str:
+        overall = self._overall.copy()
+        if self._block_pos > 0:
+            overall.update(self._block.digest())
+        return overall.hexdigest()
+
 
 class DropBoxFile(FileInfoBase):
-    def __init__(self, filename, path_display):
+    def __init__(self, filename, path_display, size=None, content_hash=None, is_folder=False):
         self.filename = filename
         self.path_display = path_display
+        self.size = size
+        self.content_hash = content_hash
+        self.is_folder = is_folder
 
     @property
     def path(self) -> str:
@@ -46,21 +115,80 @@ def get_job_id(name):
         return None
     return int(m['job'])
 
+def filter_job_folders(entries: list) -> list:
+    """
+    :return: entries of start folder named as jobs between JOB_MIN and JOB_MAX
+    """
+    job_min = int(os.getenv('JOB_MIN','1'))
+    job_max = int(os.getenv('JOB_MAX','1000'))
+    logging.info(f'Identified {len(entries)} level 1 files and folders')
+    folders = []
+    for f in entries:
+        job = get_job_id(f.name)
+        if job is not None and (job>=job_min) and (job<job_max):
+            folders.append(f)
+    logging.info(f'Identified {len(folders)} between {job_min} and {job_max}')
+    return folders
+
+
+def save_cursors(cursor_storage: ListingCursorStorageBase, root: str, cursors: Dict[str, str],
+                 failed_files: List[FileInfoBase]):
+    """
+    Folders with failed files keep their previous cursor, so failed files are listed again by the next run
+    """
+    failed = [f.path.lower() for f in failed_files]
+    saved = 0
+    for path, cursor in cursors.items():
+        if any(f.startswith(path + '/') for f in failed):
+            logging.info(f'Cursor of {path} is not saved because of failed files')
+            continue
+        cursor_storage.save_cursor(root, path, cursor)
+        saved += 1
+    logging.info(f'Saved cursors of {saved} job folders')
+
+
+def to_file(entry) -> DropBoxFile:
+    return DropBoxFile(entry.name, entry.path_display,
+                       getattr(entry, 'size', None),
+                       getattr(entry, 'content_hash', None),
+                       isinstance(entry, files.FolderMetadata))
+
+_LISTING_DONE = object()
+
+
 class DropBoxSource(SourceBase):
-    def __init__(self, access_token: str, start_folder: str):
-        db = dropbox.Dropbox(access_token)
-        act = db.users_get_current_account()
-        self._dbx = db.with_path_root(common.PathRoot.namespace_id(act.root_info.root_namespace_id))        
+    def __init__(self, access_token: str, start_folder: str, chunk_size: int = None, list_parallelism: int = None,
+                 dbx: dropbox.Dropbox = None, cursor_storage: ListingCursorStorageBase = None):
+        """
+        :param list_parallelism: number of job folders listed concurrently
+        :param dbx: already configured client, access_token is not used then
+        :param cursor_storage: if set, job folders listed by a previous run only return changes since that run
+        """
+        if dbx is None:
+            db = dropbox.Dropbox(access_token)
+            act = db.users_get_current_account()
+            dbx = db.with_path_root(common.PathRoot.namespace_id(act.root_info.root_namespace_id))
+        self._dbx = dbx
         self._start_folder = start_folder
+        self._chunk_size = chunk_size or int(os.getenv('DROPBOX_CHUNK_SIZE', str(1024 * 1024)))
+        self._list_parallelism = list_parallelism or int(os.getenv('DROPBOX_LIST_PARALLELISM', '8'))
+        self._cursor_storage = cursor_storage
+        self._saved_cursors = {}  # type: Dict[str, str]
+        self._cursors = {}  # type: Dict[str, str]
+        self._cursors_lock = threading.Lock()
+        self._watch_cursor = None  # type: Optional[str]
 
     def _decode_exception(self, e: Exception):
+        """
+        The dropbox error is kept as the cause, so retries can tell rejected requests from failed ones
+        """
         if isinstance(e, dropbox.ApiError):
             if e.user_message_text is not None:
-                raise Exception(f"Dropbox error: {e.user_message_text}")
+                raise Exception(f"Dropbox error: {e.user_message_text}") from e
             if isinstance(e.error, dropbox.files.ListFolderError):
                 if e.error.is_path():
-                    raise Exception(f"Dropbox folder error: {str(e.error.get_path())}")
-        raise Exception(f"Dropbox error. No description provided: {str(e)}")
+                    raise Exception(f"Dropbox folder error: {str(e.error.get_path())}") from e
+        raise Exception(f"Dropbox error. No description provided: {str(e)}") from e
 
     def list_folders(self, path, recursive):
         entries = []
@@ -72,37 +200,160 @@ class DropBoxSource(SourceBase):
         return entries
 
     def get_job_folders(self):
-        job_min = int(os.getenv('JOB_MIN','1'))
-        job_max = int(os.getenv('JOB_MAX','1000'))
-        logging.info(f'Listing job folders between {job_min} and {job_max}')
-        all_files = self.list_folders(self._start_folder, False)
-        logging.info(f'Identified {len(all_files)} level 1 files and folders')
-        folders = []
-        for f in all_files:
-            job = get_job_id(f.name)
-            if job is not None and (job>=job_min) and (job<job_max):
-                folders.append(f)
-        logging.info(f'Identified {len(folders)} between {job_min} and {job_max}')
-        return folders
+        return filter_job_folders(self.list_folders(self._start_folder, False))
+
+    def _continue_listing(self, path: str, cursor: str):
+        try:
+            return self._dbx.files_list_folder_continue(cursor)
+        except dropbox.ApiError as e:
+            if isinstance(e.error, files.ListFolderContinueError) and e.error.is_reset():
+                logging.info(f'Saved cursor of {path} was reset, listing it from scratch')
+                return None
+            raise
+
+    def _list_job_folder(self, path: str, put):
+        cursor = self._saved_cursors.get(path.lower())
+        r = self._continue_listing(path, cursor) if cursor is not None else None
+        if r is None:
+            logging.debug(f'Enumerating files in {path}')
+            r = self._dbx.files_list_folder(path, recursive=True)
+        else:
+            logging.debug(f'Enumerating changes in {path}')
+        put([to_file(e) for e in r.entries if not isinstance(e, files.DeletedMetadata)])
+        while r.has_more:
+            r = self._dbx.files_list_folder_continue(r.cursor)
+            put([to_file(e) for e in r.entries if not isinstance(e, files.DeletedMetadata)])
+        with self._cursors_lock:
+            self._cursors[path.lower()] = r.cursor
 
     def get_files(self) -> Generator[FileInfoBase, None, None]:
+        """
+        Job folders are listed by list_parallelism threads, pages are yielded as soon as any folder returns them,
+        so files of different folders are interleaved.
+        The first listing error stops remaining folders and is raised to the consumer
+        """
         try:
-            for f in self.get_job_folders():
-                logging.debug(f'Enumerating files in {f.path_display}')
-                r = self._dbx.files_list_folder(f.path_display, recursive=True)
-                for e in r.entries:
-                    yield DropBoxFile(e.name, e.path_display)
-                while r.has_more:
-                    r = self._dbx.files_list_folder_continue(r.cursor)
-                    for e in r.entries:
-                        yield DropBoxFile(e.name, e.path_display)
+            folders = self.get_job_folders()
         except dropbox.ApiError as e:
             raise self._decode_exception(e)
+        self._cursors = {}
+        if self._cursor_storage is not None:
+            self._saved_cursors = {k.lower(): v for k, v in self._cursor_storage.get_cursors(self._start_folder).items()}
+            logging.info(f'{len(self._saved_cursors)} job folders have saved cursors, only their changes are listed')
+        pending = Queue()
+        for f in folders:
+            pending.put(f.path_display)
+        results = Queue(max(self._list_parallelism, 1) * 4)
+        stopped = threading.Event()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return
+                except Full:
+                    pass
+
+        def work():
+            try:
+                while not stopped.is_set():
+                    try:
+                        path = pending.get_nowait()
+                    except Empty:
+                        break
+                    self._list_job_folder(path, put)
+            except Exception as e:
+                put(e)
+            finally:
+                put(_LISTING_DONE)
+
+        workers = min(max(self._list_parallelism, 1), len(folders))
+        threads = [threading.Thread(target=work, name=f'list-{i}', daemon=True) for i in range(workers)]
+        for t in threads:
+            t.start()
+        try:
+            running = workers
+            while running > 0:
+                item = results.get()
+                if item is _LISTING_DONE:
+                    running -= 1
+                elif isinstance(item, dropbox.ApiError):
+                    raise self._decode_exception(item)
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield from item
+        finally:
+            # also reached when the consumer closes the generator early
+            stopped.set()
+            for t in threads:
+                t.join()
+
+    def commit(self, failed_files: List[FileInfoBase]):
+        """
+        Saves cursors of job folders listed by the last get_files
+        """
+        if self._cursor_storage is None:
+            return
+        with self._cursors_lock:
+            cursors = dict(self._cursors)
+        save_cursors(self._cursor_storage, self._start_folder, cursors, failed_files)
+
+    def start_watching(self):
+        """
+        Remembers current state of start folder, wait_for_changes reports changes made after this call
+        """
+        r = self._dbx.files_list_folder_get_latest_cursor(self._start_folder, recursive=True)
+        self._watch_cursor = r.cursor
+
+    def wait_for_changes(self, timeout: int = None) -> bool:
+        """
+        Long polls dropbox until something changes in start folder or timeout passes
+        :param timeout: seconds, 30..480
+        :return: True if mp4 files were added or modified
+        """
+        if self._watch_cursor is None:
+            self.start_watching()
+        timeout = timeout or int(os.getenv('DROPBOX_LONGPOLL_TIMEOUT', '480'))
+        r = self._dbx.files_list_folder_longpoll(self._watch_cursor, timeout)
+        if r.backoff:
+            time.sleep(r.backoff)
+        if not r.changes:
+            return False
+        changed = False
+        has_more = True
+        while has_more:
+            res = self._dbx.files_list_folder_continue(self._watch_cursor)
+            self._watch_cursor = res.cursor
+            has_more = res.has_more
+            changed = changed or any(isinstance(e, files.FileMetadata) and e.name.lower().endswith('.mp4')
+                                     for e in res.entries)
+        return changed
+
+    def get_link(self, file: DropBoxFile) -> Optional[str]:
+        """
+        Dropbox temporary links expire in four hours
+        """
+        try:
+            return self._dbx.files_get_temporary_link(file.path).link
+        except Exception as e:
+            self._decode_exception(e)
 
     def download_file(self, file_to_download: DropBoxFile, destination_name: str):
+        """
+        Streams file to destination_name by chunk_size pieces, so memory usage does not depend on file size
+        :raise ContentHashMismatchError if downloaded bytes do not match dropbox content_hash
+        """
         try:
-            with open(destination_name, "wb") as file:
-                metadata, res = self._dbx.files_download(path=file_to_download.path)
-                file.write(res.content)
+            metadata, res = self._dbx.files_download(path=file_to_download.path)
+            hasher = DropboxContentHasher()
+            with closing(res), open(destination_name, "wb") as file:
+                for chunk in res.iter_content(chunk_size=self._chunk_size):
+                    file.write(chunk)
+                    hasher.update(chunk)
         except dropbox.ApiError as e:
-            raise self._decode_exception(e)
\ No newline at end of file
+            raise self._decode_exception(e)
+        expected = metadata.content_hash or file_to_download.content_hash
+        if expected is not None and hasher.hexdigest() != expected:
+            os.remove(destination_name)
+            raise ContentHashMismatchError(f"Downloaded {file_to_download.path} does not match content_hash {expected}")
@@ -1,4 +1,9 @@
 from abc import ABCMeta
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from .chunked import UploadSession
+from .uploader import UploadedVideo
 
 class StorageBase(metaclass=ABCMeta):
     def create_session_id(self) -> int:
@@ -10,8 +15,126 @@ class StorageBase(metaclass=ABCMeta):
     def session_completed_error(self, id: int, err: str):
         raise NotImplementedError
 
-    def create_video(self, session_id: int, video_id: str, name: str, original_path: str, status=None):
+    def create_video(self, session_id: int, video_id: str, name: str, original_path: str, status=None,
+                     duplicate_of: str = None, attributes: dict = None, account_id: str = None):
+        """
+        :param duplicate_of: path of the file with the same content, if the video was linked instead of uploaded
+        :param attributes: attributes parsed from the file name
+        :param account_id: ad account of the video, a file routed to several accounts is recorded once per account
+        """
         raise NotImplementedError
 
     def update_video_status(self, id: str, new_status: str):
         raise NotImplementedError
+
+    def get_pending_videos(self) -> List[Tuple[str, Optional[str]]]:
+        """
+        :return: ids and statuses of uploaded videos which encoding is not finished yet
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Writes buffered records, called on shutdown
+        """
+        pass
+
+
+class VideoIndexStorageBase(metaclass=ABCMeta):
+    """
+    Persistent copy of uploader index, so it can be refreshed incrementally between runs
+    """
+    def load_videos(self, account_id: str) -> List[UploadedVideo]:
+        raise NotImplementedError
+
+    def save_videos(self, account_id: str, videos: List[UploadedVideo]):
+        raise NotImplementedError
+
+    def delete_video(self, account_id: str, video_id: str):
+        raise NotImplementedError
+
+    def clear(self, account_id: str):
+        raise NotImplementedError
+
+    def get_last_created_time(self, account_id: str) -> Optional[datetime]:
+        raise NotImplementedError
+
+    def set_last_created_time(self, account_id: str, created_time: datetime):
+        raise NotImplementedError
+
+
+class UploadSessionStorageBase(metaclass=ABCMeta):
+    def get_upload_session(self, key: str) -> Optional[UploadSession]:
+        raise NotImplementedError
+
+    def save_upload_session(self, session: UploadSession):
+        raise NotImplementedError
+
+    def delete_upload_session(self, key: str):
+        raise NotImplementedError
+
+
+class ListingCursorStorageBase(metaclass=ABCMeta):
+    """
+    Dropbox list_folder cursors of job folders, saved between runs
+    """
+    def get_cursors(self, root: str) -> Dict[str, str]:
+        raise NotImplementedError
+
+    def save_cursor(self, root: str, path: str, cursor: str):
+        raise NotImplementedError
+
+    def clear_cursors(self, root: str):
+        raise NotImplementedError
+
+
+class ContentHashStorageBase(metaclass=ABCMeta):
+    """
+    Dropbox content hashes of uploaded files and paths of files linked to their videos
+    """
+    def get_links(self, account_id: str, content_hash: str) -> List[Tuple[str, str]]:
+        """
+        :return: video id and source path of every file with given content, the first uploaded one goes first
+        """
+        raise NotImplementedError
+
+    def add_link(self, account_id: str, content_hash: str, video_id: str, path: str):
+        raise NotImplementedError
+
+    def delete_links(self, account_id: str, content_hash: str):
+        raise NotImplementedError
+
+
+class AdDuplicationStorageBase(metaclass=ABCMeta):
+    """
+    Campaigns copied from the template campaign per Job and ads created for videos, saved between runs
+    """
+    def get_job_adset(self, template_id: str, job: str) -> Optional[str]:
+        """
+        :return: id of the ad set copied with the job campaign, None if the campaign is not copied yet
+        """
+        raise NotImplementedError
+
+    def save_job_adset(self, template_id: str, job: str, campaign_id: str, adset_id: str):
+        raise NotImplementedError
+
+    def get_video_ad(self, template_id: str, video_id: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        :return: ids of the ad set copied for the video and of its ad, the ad id is only set once the ad is created
+        """
+        raise NotImplementedError
+
+    def save_video_ad(self, template_id: str, video_id: str, name: str, adset_id: str, ad_id: str = None):
+        raise NotImplementedError
+
+    def video_failed(self, template_id: str, video_id: str, name: str, error: str):
+        """
+        Counts a failed duplication attempt of the video
+        """
+        raise NotImplementedError
+
+    def get_failed(self, template_id: str, max_attempts: int) -> List[Tuple[str, str]]:
+        """
+        :return: id and name of every video which ad is not created and has less than max_attempts failed attempts
+        """
+        raise NotImplementedError
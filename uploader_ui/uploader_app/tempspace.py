@@ -0,0 +1,88 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from typing import Dict, Optional
+
+DIR_PREFIX = 'file-'
+
+
+class TempSpace:
+    """
+    Temporary files of downloads waiting for upload.
+    Every file gets its own directory, so files with the same name from different job folders do not collide
+    and uploaded video title is still the file name.
+    Reservations are limited by budget bytes, a reservation is blocked until enough space is released.
+    A file larger than the budget is only let in when nothing else is reserved
+    """
+    def __init__(self, root: str, budget: int = None):
+        """
+        :param budget: max bytes reserved at once, 0 for no limit
+        """
+        self._root = root
+        self._budget = budget if budget is not None else int(os.getenv('GA_TEMP_BUDGET', str(10 * 1024 ** 3)))
+        self._lock = threading.Condition()
+        self._reserved = {}  # type: Dict[str, int]  bytes reserved by every path
+        self._used = 0
+
+    def clean(self):
+        """
+        Deletes files left by a crashed run, called before a run starts
+        """
+        os.makedirs(self._root, exist_ok=True)
+        removed = 0
+        with self._lock:
+            for entry in os.scandir(self._root):
+                if entry.name.startswith(DIR_PREFIX) and entry.is_dir() and entry.path not in self._reserved_dirs():
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed += 1
+        if removed > 0:
+            logging.info(f'Removed {removed} temporary files left in {self._root}')
+
+    def _reserved_dirs(self):
+        return {os.path.dirname(p) for p in self._reserved}
+
+    def _fits(self, size: int) -> bool:
+        return self._budget <= 0 or self._used == 0 or self._used + size <= self._budget
+
+    def _add(self, name: str, size: int) -> str:
+        path = os.path.join(tempfile.mkdtemp(prefix=DIR_PREFIX, dir=self._root), name)
+        self._reserved[path] = size
+        self._used += size
+        return path
+
+    def reserve(self, name: str, size: int) -> str:
+        """
+        Blocks until size bytes fit into the budget
+        :return: unique path of a file with given name
+        """
+        size = size or 0
+        with self._lock:
+            if not self._fits(size):
+                logging.info(f'Waiting for {size} bytes of temporary space for {name}, {self._used} bytes in use')
+                self._lock.wait_for(lambda: self._fits(size))
+            return self._add(name, size)
+
+    def try_reserve(self, name: str, size: int) -> Optional[str]:
+        """
+        :return: unique path of a file with given name, None if size bytes do not fit into the budget now
+        """
+        size = size or 0
+        with self._lock:
+            return self._add(name, size) if self._fits(size) else None
+
+    def release(self, path: str):
+        """
+        Deletes the file and gives its space to blocked reservations
+        """
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+        with self._lock:
+            size = self._reserved.pop(path, None)
+            if size is not None:
+                self._used -= size
+                self._lock.notify_all()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {'files': len(self._reserved), 'reserved_bytes': self._used, 'budget': self._budget}
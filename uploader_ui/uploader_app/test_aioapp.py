@@ -0,0 +1,222 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from uploader_ui.uploader_app.aioapp import AsyncUploader
+from uploader_ui.uploader_app.aioloop import EventLoopThread
+from uploader_ui.uploader_app.aiosource import AsyncSourceBase, SyncSource
+from uploader_ui.uploader_app.aiouploader import AsyncUploaderBase, SyncUploader
+from uploader_ui.uploader_app.app import Uploader
+from uploader_ui.uploader_app.retry import RetryPolicy
+from uploader_ui.uploader_app.routing import AccountRouter, parse_routes
+from uploader_ui.uploader_app.test_app import FakeSource, FakeUploader, FakeStorage, FakePublisher, \
+    FakeDuplicator, MATCHING
+
+
+class AsyncFakeSource(AsyncSourceBase):
+    def __init__(self, source: FakeSource):
+        self.source = source
+        self.active = 0
+        self.max_active = 0
+        self.done = []
+
+    async def get_files(self):
+        for f in self.source.get_files():
+            yield f
+
+    async def download_file(self, file, destination_name):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+        self.source.download_file(file, destination_name)
+
+    async def get_link(self, file):
+        return self.source.get_link(file)
+
+    async def file_done(self, file, failed):
+        self.done.append((file.name, failed))
+
+    async def commit(self, failed_files):
+        self.source.commit(failed_files)
+
+
+class AsyncFakeUploader(AsyncUploaderBase):
+    def __init__(self, uploader: FakeUploader):
+        self.uploader = uploader
+
+    async def index(self, full=False):
+        self.uploader.index(full)
+
+    def should_be_uploaded(self, video_name):
+        return self.uploader.should_be_uploaded(video_name)
+
+    async def upload(self, path, key=None):
+        await asyncio.sleep(0)
+        return self.uploader.upload(path, key)
+
+    async def upload_url(self, url, name):
+        return self.uploader.upload_url(url, name)
+
+    async def get_by_content_hash(self, content_hash):
+        return self.uploader.get_by_content_hash(content_hash)
+
+    async def link_content(self, content_hash, video_id, path):
+        self.uploader.link_content(content_hash, video_id, path)
+
+    def set_uploaded_videos(self, files):
+        self.uploader.set_uploaded_videos(files)
+
+    async def wait_all(self):
+        for id, status in self.uploader.wait_all():
+            yield id, status
+
+
+class WaitingAsyncUploader(AsyncFakeUploader):
+    """
+    Waits for the encoding of every account to be polled at once
+    """
+    def __init__(self, uploader: FakeUploader, polling: list, accounts: int):
+        super().__init__(uploader)
+        self.polling = polling
+        self.accounts = accounts
+
+    async def wait_all(self):
+        self.polling.append(self)
+        for _ in range(100):
+            if len(self.polling) == self.accounts:
+                break
+            await asyncio.sleep(0.01)
+        else:
+            raise Exception("accounts are polled one by one")
+        async for id, status in super().wait_all():
+            yield id, status
+
+
+class TestAsyncUploader(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_run(self):
+        names = [MATCHING.format(i) for i in range(6)] + ["Folder", "not-matching.mp4"]
+        source = AsyncFakeSource(FakeSource(names))
+        uploader = FakeUploader(existing=[names[0]], fail_once=[names[1]])
+        storage = FakeStorage()
+        publisher = FakePublisher()
+        duplicator = FakeDuplicator()
+        with mock.patch.dict(os.environ, {"DOWNLOAD_PARALLELISM": "2"}):
+            asyncio.run(AsyncUploader(storage, source, AsyncFakeUploader(uploader), self.tmp.name,
+                                      RetryPolicy(3, 0.01), publisher, duplicator).run(wait_for_encoding=True))
+
+        self.assertEqual(sorted(uploader.uploaded), sorted(names[1:6]))
+        self.assertEqual(uploader.attempts[names[1]], 2)
+        self.assertEqual(source.max_active, 2)
+        self.assertEqual(storage.completed, True)
+        self.assertEqual(set(storage.statuses.values()), {"ready"})
+        progress = publisher.published[-1][1]
+        counters = ("listed", "queued", "downloaded", "uploaded", "ready", "failed")
+        self.assertEqual({k: progress[k] for k in counters},
+                         {"listed": 8, "queued": 5, "downloaded": 5, "uploaded": 5, "ready": 5, "failed": 0})
+        self.assertEqual(sorted(n for _, n in duplicator.ready), sorted(names[1:6]))
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_retry_budget_and_link_transfer(self):
+        names = [MATCHING.format(i) for i in range(4)]
+        source = AsyncFakeSource(FakeSource(names))
+        uploader = FakeUploader(fail_url=names[:2], fail_always=[names[0]], throttle_url=[names[2]])
+        storage = FakeStorage()
+        with mock.patch.dict(os.environ, {"TRANSFER_MODE": "link"}):
+            asyncio.run(AsyncUploader(storage, source, AsyncFakeUploader(uploader), self.tmp.name,
+                                      RetryPolicy(3, 0.01, rate_limit_delay=0.01)).run())
+
+        # only files which links are rejected are downloaded, failed uploads are retried from the same download,
+        # a throttled upload by link is retried by link
+        self.assertEqual(sorted(source.source.downloaded), names[:2])
+        self.assertEqual(len(uploader.urls), 2)
+        self.assertEqual(uploader.attempts[names[0]], 3)
+        self.assertEqual(sorted(uploader.uploaded), sorted(names[1:]))
+        self.assertEqual([v for v in storage.videos if v[2] == "error"], [("", names[0], "error")])
+        self.assertEqual(source.source.committed, [names[0]])
+
+    def test_files_are_done_after_their_originals(self):
+        names = [MATCHING.format(i) for i in range(4)]
+        source = AsyncFakeSource(FakeSource(names, {n: "h1" for n in names[:3]}))
+        uploader = FakeUploader(fail_always=[names[3]])
+        asyncio.run(AsyncUploader(FakeStorage(), source, AsyncFakeUploader(uploader), self.tmp.name,
+                                  RetryPolicy(2, 0.01)).run())
+
+        self.assertEqual(uploader.uploaded, [names[0]])
+        self.assertEqual(sorted(source.done), sorted([(n, False) for n in names[:3]] + [(names[3], True)]))
+        # duplicates are done once the original is uploaded
+        done = [n for n, _ in source.done]
+        self.assertGreater(done.index(names[0]), max(done.index(names[1]), done.index(names[2])))
+
+    def test_temporary_space_budget(self):
+        names = [MATCHING.format(i) for i in range(4)]
+        source = AsyncFakeSource(FakeSource(names, folders=("J320_", "J321_")))
+        uploader = FakeUploader()
+        with mock.patch.dict(os.environ, {"GA_TEMP_BUDGET": str(len(names[0]))}):
+            asyncio.run(AsyncUploader(FakeStorage(), source, AsyncFakeUploader(uploader), self.tmp.name,
+                                      RetryPolicy(3, 0.01)).run())
+
+        # only one file fits into the budget at a time
+        self.assertEqual(source.max_active, 1)
+        self.assertEqual(sorted(uploader.uploaded), sorted(names * 2))
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_accounts(self):
+        names = [f"Channel={c}_Platform=1_Job=320_{i}.mp4" for c in (1, 2) for i in range(2)]
+        act_1 = FakeUploader(fail_once=[names[0]], id_prefix="a")
+        act_2 = FakeUploader(id_prefix="b")
+        source = AsyncFakeSource(FakeSource(names))
+        storage = FakeStorage()
+        router = AccountRouter({"act_1": AsyncFakeUploader(act_1), "act_2": AsyncFakeUploader(act_2)},
+                               parse_routes("act_1:Channel=1;act_2:*"))
+        asyncio.run(AsyncUploader(storage, source, router, self.tmp.name, RetryPolicy(3, 0.01))
+                    .run(wait_for_encoding=True))
+
+        self.assertEqual(sorted(source.source.downloaded), sorted(names))
+        self.assertEqual(sorted(act_1.uploaded), sorted(names[:2]))
+        self.assertEqual((act_1.attempts[names[0]], act_2.attempts[names[0]]), (2, 1))
+        self.assertEqual(sorted(act_2.uploaded), sorted(names))
+        self.assertEqual(sorted(storage.accounts), ["act_1", "act_2"])
+        self.assertEqual(len(storage.statuses), 6)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_accounts_are_polled_concurrently(self):
+        names = [f"Channel={c}_Platform=1_Job=320_0.mp4" for c in (1, 2)]
+        polling = []
+        router = AccountRouter({"act_1": WaitingAsyncUploader(FakeUploader(id_prefix="a"), polling, 2),
+                                "act_2": WaitingAsyncUploader(FakeUploader(id_prefix="b"), polling, 2)},
+                               parse_routes("act_1:Channel=1;act_2:Channel=2"))
+        storage = FakeStorage()
+        asyncio.run(AsyncUploader(storage, AsyncFakeSource(FakeSource(names)), router, self.tmp.name,
+                                  RetryPolicy(3, 0.01)).run(wait_for_encoding=True))
+
+        self.assertEqual(storage.completed, True)
+        self.assertEqual(storage.statuses, {"a1": "ready", "b1": "ready"})
+
+    def test_sync_wrappers(self):
+        names = [MATCHING.format(i) for i in range(3)]
+        hashes = {names[0]: "h1", names[1]: "h1"}
+        source = AsyncFakeSource(FakeSource(names, hashes))
+        uploader = FakeUploader()
+        storage = FakeStorage()
+        loop = EventLoopThread()
+        try:
+            Uploader(storage, SyncSource(source, loop), SyncUploader(AsyncFakeUploader(uploader), loop),
+                     self.tmp.name, RetryPolicy(3, 0.01)).run(wait_for_encoding=True)
+        finally:
+            loop.close()
+
+        self.assertEqual(sorted(uploader.uploaded), [names[0], names[2]])
+        # uploads run concurrently, video ids follow their order
+        video_id = str(uploader.uploaded.index(names[0]) + 1)
+        self.assertEqual(storage.duplicates, {names[1]: (video_id, f"/J320_/{names[0]}")})
+        self.assertEqual(set(storage.statuses.values()), {"ready"})
+        self.assertEqual(storage.completed, True)
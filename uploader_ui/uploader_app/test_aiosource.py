@@ -0,0 +1,140 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from uploader_ui.uploader_app.aiosource import AsyncDropBoxSource
+from uploader_ui.uploader_app.source import ContentHashMismatchError
+from uploader_ui.uploader_app.test_source import MemoryCursorStorage, content_hash
+
+
+class FakeDropboxServer:
+    """
+    Dropbox http api with job folders J1_..Jn_ of files_per_folder files each, listed by pages of page_size entries
+    """
+    def __init__(self, folders, files_per_folder, page_size):
+        self.folders = [f"/J{i}_" for i in range(1, folders + 1)]
+        self.files = {f: [f"{f}/video{j}.mp4" for j in range(files_per_folder)] for f in self.folders}
+        self.page_size = page_size
+        self.content = b"video content"
+        self.content_hash = content_hash(self.content)
+        self.path_roots = set()
+        self.app = web.Application()
+        self.app.router.add_post("/2/users/get_current_account", self.get_current_account)
+        self.app.router.add_post("/2/files/list_folder", self.list_folder)
+        self.app.router.add_post("/2/files/list_folder/continue", self.list_folder_continue)
+        self.app.router.add_post("/2/files/get_temporary_link", self.get_temporary_link)
+        self.app.router.add_post("/2/files/download", self.download)
+
+    async def get_current_account(self, request):
+        return web.json_response({"root_info": {"root_namespace_id": "42"}})
+
+    def _page(self, path, offset):
+        entries = self.files[path][offset:offset + self.page_size]
+        end = offset + len(entries)
+        return web.json_response({
+            "entries": [{".tag": "file", "name": p.rsplit("/", 1)[-1], "path_display": p, "size": 1} for p in entries],
+            "cursor": f"{path}:{end}",
+            "has_more": end < len(self.files[path]),
+        })
+
+    async def list_folder(self, request):
+        self.path_roots.add(request.headers.get("Dropbox-API-Path-Root"))
+        arg = await request.json()
+        if not arg["recursive"]:
+            return web.json_response({
+                "entries": [{".tag": "folder", "name": f[1:], "path_display": f} for f in self.folders + ["/Other"]],
+                "cursor": "", "has_more": False,
+            })
+        return self._page(arg["path"], 0)
+
+    async def list_folder_continue(self, request):
+        cursor = (await request.json())["cursor"]
+        if cursor == "expired":
+            return web.json_response({"error_summary": "reset/..", "error": {".tag": "reset"}}, status=409)
+        path, offset = cursor.split(":")
+        return self._page(path, int(offset))
+
+    async def get_temporary_link(self, request):
+        path = (await request.json())["path"]
+        return web.json_response({"link": f"https://dl{path}"})
+
+    async def download(self, request):
+        arg = json.loads(request.headers["Dropbox-API-Arg"])
+        if arg["path"] not in self.files.get(arg["path"].rsplit("/", 1)[0], []):
+            return web.json_response({"error_summary": "path/not_found/.."}, status=409)
+        return web.Response(body=self.content,
+                            headers={"Dropbox-API-Result": json.dumps({"content_hash": self.content_hash})})
+
+
+def run_with_server(dropbox: FakeDropboxServer, test, **kwargs):
+    async def run():
+        async with TestServer(dropbox.app) as server:
+            url = str(server.make_url("/2"))
+            source = AsyncDropBoxSource("token", "/", api_url=url, content_url=url, **kwargs)
+            try:
+                return await test(source)
+            finally:
+                await source.close()
+
+    return asyncio.run(run())
+
+
+async def list_paths(source):
+    return [f.path async for f in source.get_files()]
+
+
+class TestAsyncDropBoxSource(unittest.TestCase):
+    def test_all_files_listed(self):
+        dropbox = FakeDropboxServer(folders=4, files_per_folder=5, page_size=2)
+        paths = run_with_server(dropbox, list_paths, list_parallelism=3)
+
+        self.assertEqual(sorted(paths), sorted(p for f in dropbox.files.values() for p in f))
+        self.assertEqual(dropbox.path_roots, {json.dumps({".tag": "namespace_id", "namespace_id": "42"})})
+
+    def test_only_changes_are_listed(self):
+        dropbox = FakeDropboxServer(folders=3, files_per_folder=3, page_size=2)
+        storage = MemoryCursorStorage()
+        storage.save_cursor("/", "/j1_", "expired")
+
+        async def test(source):
+            first = await list_paths(source)
+            await source.commit([])
+            dropbox.files["/J2_"].append("/J2_/new.mp4")
+            return first, await list_paths(source)
+
+        first, second = run_with_server(dropbox, test, cursor_storage=storage)
+
+        # reset cursor lists the folder from scratch
+        self.assertEqual(len(first), 9)
+        self.assertEqual(sorted(storage.cursors["/"]), ["/j1_", "/j2_", "/j3_"])
+        self.assertEqual(second, ["/J2_/new.mp4"])
+
+    def test_download(self):
+        dropbox = FakeDropboxServer(folders=1, files_per_folder=1, page_size=1)
+        with tempfile.TemporaryDirectory() as tmp:
+            destination = os.path.join(tmp, "video0.mp4")
+
+            async def test(source):
+                file = [f async for f in source.get_files()][0]
+                await source.download_file(file, destination)
+                with open(destination, "rb") as f:
+                    content = f.read()
+                dropbox.content_hash = "other"
+                with self.assertRaises(ContentHashMismatchError):
+                    await source.download_file(file, destination)
+                return content, await source.get_link(file)
+
+            content, link = run_with_server(dropbox, test, chunk_size=4)
+
+            self.assertEqual(content, dropbox.content)
+            self.assertEqual(link, "https://dl/J1_/video0.mp4")
+            self.assertFalse(os.path.exists(destination))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from facebook_business import FacebookSession
+
+from uploader_ui.uploader_app.aiouploader import AsyncGraphApi, AsyncFacebookUploader
+from uploader_ui.uploader_app.ratelimit import RateGovernor
+from uploader_ui.uploader_app.test_chunked import MemorySessionStorage
+from uploader_ui.uploader_app.uploader import UploadedVideo
+
+
+class FakeGraphServer:
+    """
+    Accepts uploads by chunks of chunk_size bytes, videos are ready after polls_to_ready status polls
+    """
+    def __init__(self, chunk_size, polls_to_ready=2):
+        self.chunk_size = chunk_size
+        self.polls_to_ready = polls_to_ready
+        self.received = b""
+        self.size = 0
+        self.title = None
+        self.polls = {}
+        self.batches = 0
+        self.app = web.Application()
+        self.app.router.add_post("/v5.0/act_1/advideos", self.advideos)
+        self.app.router.add_post("/v5.0", self.batch)
+
+    def _offsets(self, start):
+        return {"start_offset": str(start), "end_offset": str(min(start + self.chunk_size, self.size))}
+
+    async def advideos(self, request):
+        form = await request.post()
+        assert form["access_token"] == "token"
+        phase = form["upload_phase"]
+        if phase == "start":
+            self.size = int(form["file_size"])
+            return web.json_response({"upload_session_id": "s1", "video_id": "v1", **self._offsets(0)})
+        if phase == "transfer":
+            with form["video_file_chunk"].file as f:
+                self.received += f.read()
+            return web.json_response(self._offsets(len(self.received)))
+        self.title = form["title"]
+        return web.json_response({"success": True})
+
+    async def batch(self, request):
+        self.batches += 1
+        responses = []
+        for call in json.loads((await request.post())["batch"]):
+            url = urlparse(call["relative_url"])
+            id = url.path
+            assert parse_qs(url.query)["fields"] == ["status,title"]
+            if id == "deleted":
+                responses.append({"code": 404, "body": json.dumps({"error": {"code": 100}})})
+                continue
+            self.polls[id] = self.polls.get(id, 0) + 1
+            status = "ready" if self.polls[id] >= self.polls_to_ready else "processing"
+            responses.append({"code": 200, "body": json.dumps(
+                {"id": id, "title": f"{id}.mp4", "status": {"video_status": status}})})
+        return web.json_response(responses)
+
+
+def run_with_server(graph: FakeGraphServer, test):
+    async def run():
+        async with TestServer(graph.app) as server:
+            url = str(server.make_url("")).rstrip("/")
+            session = FacebookSession(access_token="token")
+            api = AsyncGraphApi(session, RateGovernor(1000, 1000), "v5.0", graph_url=url, video_graph_url=url)
+            uploader = AsyncFacebookUploader(api, "act_1", session_storage=MemorySessionStorage())
+            try:
+                return await test(uploader)
+            finally:
+                await uploader.close()
+
+    return asyncio.run(run())
+
+
+class TestAsyncFacebookUploader(unittest.TestCase):
+    def test_upload(self):
+        graph = FakeGraphServer(chunk_size=4)
+        data = os.urandom(10)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "video.mp4")
+            with open(path, "wb") as f:
+                f.write(data)
+            video = run_with_server(graph, lambda uploader: uploader.upload(path, "/J1_/video.mp4"))
+
+        self.assertEqual((video.id, video.name), ("v1", "video.mp4"))
+        self.assertEqual(graph.received, data)
+        self.assertEqual(graph.title, "video.mp4")
+
+    def test_wait_all(self):
+        graph = FakeGraphServer(chunk_size=4)
+
+        async def test(uploader):
+            uploader.set_uploaded_videos([UploadedVideo(str(i)) for i in range(60)] + [UploadedVideo("deleted")])
+            return [s async for s in uploader.wait_all()]
+
+        with mock.patch.dict(os.environ, {"FB_POLL_INTERVAL_MIN": "0.01"}):
+            statuses = run_with_server(graph, test)
+
+        self.assertEqual(sorted(s for _, s in statuses), ["processing"] * 60 + ["ready"] * 60)
+        # 61 videos are polled by two batches twice
+        self.assertEqual(graph.batches, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,390 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from facebook_business.exceptions import FacebookRequestError
+
+from uploader_ui.uploader_app.app import Uploader, StatusPoller
+from uploader_ui.uploader_app.duplicator import DuplicatorBase
+from uploader_ui.uploader_app.progress import ProgressPublisherBase
+from uploader_ui.uploader_app.retry import RetryPolicy
+from uploader_ui.uploader_app.routing import AccountRouter, parse_routes
+from uploader_ui.uploader_app.source import SourceBase, DropBoxFile, save_cursors
+from uploader_ui.uploader_app.storage import StorageBase
+from uploader_ui.uploader_app.test_source import MemoryCursorStorage
+from uploader_ui.uploader_app.uploader import UploaderBase, UploadedVideo, TooManyCallsError, FacebookUploaderNoWait
+
+MATCHING = "Channel=1_Platform=1_Job=320_{}.mp4"
+
+
+class FakeSource(SourceBase):
+    def __init__(self, names, hashes=None, folders=("J320_",)):
+        self._start_folder = "/"
+        hashes = hashes or {}
+        self.files = [DropBoxFile(n, f"/{d}/{n}", size=len(n), content_hash=hashes.get(n)) for d in folders for n in names]
+        self.committed = None
+        self.downloaded = []
+
+    def get_files(self):
+        yield from self.files
+
+    def download_file(self, file, destination_name):
+        if os.path.exists(destination_name):
+            raise Exception("temporary file is already used")
+        self.downloaded.append(file.name)
+        with open(destination_name, "w") as f:
+            f.write(file.name)
+
+    def get_link(self, file):
+        return f"https://dl{file.path}"
+
+    def commit(self, failed_files):
+        self.committed = [f.name for f in failed_files]
+
+
+class FakeUploader(UploaderBase):
+    def __init__(self, existing=(), fail_once=(), fail_always=(), fail_url=(), throttle_url=(), id_prefix=""):
+        self.existing = set(existing)
+        self.fail_once = set(fail_once)
+        self.fail_always = set(fail_always)
+        self.fail_url = set(fail_url)
+        self.throttle_url = set(throttle_url)
+        self.id_prefix = id_prefix
+        self.urls = []
+        self.attempts = {}
+        self.uploaded = []
+        self.links = {}
+        self._lock = threading.Lock()
+
+    def index(self, full=False):
+        pass
+
+    def should_be_uploaded(self, video_name):
+        return video_name not in self.existing
+
+    def upload(self, path, key=None):
+        name = os.path.basename(path)
+        with self._lock:
+            self.attempts[name] = self.attempts.get(name, 0) + 1
+            if name in self.fail_always:
+                raise Exception("upload failed")
+            if name in self.fail_once:
+                self.fail_once.remove(name)
+                raise Exception("upload failed")
+            self.uploaded.append(name)
+            return UploadedVideo(f"{self.id_prefix}{len(self.uploaded)}", name)
+
+    def upload_url(self, url, name):
+        with self._lock:
+            if name in self.fail_url:
+                raise FacebookRequestError("url upload failed", {}, 400, {},
+                                           json.dumps({"error": {"code": 389, "message": "Unable to fetch video"}}))
+            if name in self.throttle_url:
+                self.throttle_url.remove(name)
+                raise TooManyCallsError("url upload throttled")
+            self.urls.append(url)
+            self.uploaded.append(name)
+            return UploadedVideo(f"{self.id_prefix}{len(self.uploaded)}")
+
+    def get_by_content_hash(self, content_hash):
+        with self._lock:
+            links = self.links.get(content_hash)
+            return (UploadedVideo(links[0][0]), [p for _, p in links]) if links else None
+
+    def link_content(self, content_hash, video_id, path):
+        with self._lock:
+            self.links.setdefault(content_hash, []).append((video_id, path))
+
+    def set_uploaded_videos(self, files):
+        self.videos = files
+
+    def wait_all(self):
+        for v in self.videos:
+            yield v.id, "ready"
+
+
+class BarrierUploader(FakeUploader):
+    """
+    Waits for the encoding of every account to be polled at once
+    """
+    def __init__(self, barrier, **kwargs):
+        super().__init__(**kwargs)
+        self.barrier = barrier
+
+    def wait_all(self):
+        self.barrier.wait()
+        yield from super().wait_all()
+
+
+class FakeStorage(StorageBase):
+    def __init__(self):
+        self.videos = []
+        self.statuses = {}
+        self.completed = None
+        self.duplicates = {}
+        self.attributes = {}
+        self.accounts = {}
+
+    def create_session_id(self):
+        return 1
+
+    def session_completed(self, id):
+        self.completed = True
+
+    def session_completed_error(self, id, err):
+        self.completed = err
+
+    def create_video(self, session_id, video_id, name, original_path, status=None, duplicate_of=None,
+                     attributes=None, account_id=None):
+        self.videos.append((video_id, name, status))
+        self.accounts.setdefault(account_id, []).append(original_path)
+        self.attributes[name] = attributes
+        if duplicate_of is not None:
+            self.duplicates[name] = (video_id, duplicate_of)
+
+    def update_video_status(self, id, new_status):
+        self.statuses[id] = new_status
+
+    def get_pending_videos(self):
+        return [(id, s) for id, s in self.statuses.items() if s not in ("ready", "error", "deleted")]
+
+
+class FakePublisher(ProgressPublisherBase):
+    def __init__(self):
+        self.published = []
+
+    def publish(self, session_id, progress):
+        self.published.append((session_id, progress))
+
+
+class FakeDuplicator(DuplicatorBase):
+    def __init__(self):
+        self.ready = []
+
+    def on_ready(self, video_id, name):
+        self.ready.append((video_id, name))
+
+
+class TestUploader(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_run(self):
+        names = [MATCHING.format(i) for i in range(6)] + ["Folder", "not-matching.mp4"]
+        source = FakeSource(names)
+        uploader = FakeUploader(existing=[names[0]], fail_once=[names[1]])
+        storage = FakeStorage()
+        publisher = FakePublisher()
+        duplicator = FakeDuplicator()
+        Uploader(storage, source, uploader, self.tmp.name, RetryPolicy(3, 0.01), publisher,
+                 duplicator).run(wait_for_encoding=True)
+
+        self.assertEqual(sorted(uploader.uploaded), sorted(names[1:6]))
+        self.assertEqual(uploader.attempts[names[1]], 2)
+        self.assertEqual(storage.completed, True)
+        self.assertEqual(len([v for v in storage.videos if v[2] is None]), 5)
+        self.assertEqual(set(storage.statuses.values()), {"ready"})
+        session_id, progress = publisher.published[-1]
+        self.assertEqual(session_id, 1)
+        self.assertTrue(progress["done"])
+        counters = ("listed", "queued", "downloaded", "uploaded", "ready", "encoding", "failed")
+        self.assertEqual({k: progress[k] for k in counters},
+                         {"listed": 8, "queued": 5, "downloaded": 5, "uploaded": 5, "ready": 5, "encoding": 0, "failed": 0})
+        self.assertEqual(progress["bytes_uploaded"], sum(len(n) for n in names[1:6]))
+        self.assertEqual(storage.attributes[names[1]], {"Channel": 1, "Platform": 1, "Job": "320_1"})
+        self.assertEqual(sorted(n for _, n in duplicator.ready), sorted(names[1:6]))
+
+    def test_retry_budget(self):
+        names = [MATCHING.format(i) for i in range(3)]
+        uploader = FakeUploader(fail_always=[names[0]])
+        storage = FakeStorage()
+        source = FakeSource(names)
+        Uploader(storage, source, uploader, self.tmp.name, RetryPolicy(3, 0.01)).run()
+
+        self.assertEqual(uploader.attempts[names[0]], 3)
+        self.assertEqual(sorted(uploader.uploaded), sorted(names[1:]))
+        self.assertEqual([v for v in storage.videos if v[2] == "error"], [("", names[0], "error")])
+        self.assertEqual(source.committed, [names[0]])
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_link_transfer(self):
+        names = [MATCHING.format(i) for i in range(4)]
+        uploader = FakeUploader(fail_url=[names[0]], throttle_url=[names[1]])
+        source = FakeSource(names)
+        storage = FakeStorage()
+        publisher = FakePublisher()
+        with mock.patch.dict(os.environ, {"TRANSFER_MODE": "link"}):
+            Uploader(storage, source, uploader, self.tmp.name, RetryPolicy(3, 0.01, rate_limit_delay=0.01),
+                     publisher).run()
+
+        # only the file which link is rejected is downloaded, a throttled upload by link is retried by link
+        self.assertEqual(source.downloaded, [names[0]])
+        self.assertEqual(sorted(uploader.urls), sorted(f"https://dl/J320_/{n}" for n in names[1:]))
+        self.assertEqual(sorted(uploader.uploaded), sorted(names))
+        self.assertEqual(sorted(v[1] for v in storage.videos), sorted(names))
+        progress = publisher.published[-1][1]
+        self.assertEqual((progress["uploaded"], progress["uploaded_by_link"], progress["downloaded"]), (4, 3, 1))
+
+    def test_link_transfer_rejected_by_facebook(self):
+        class LocalFacebookUploader(FacebookUploaderNoWait):
+            """
+            Uploads by url through the facebook api, downloaded files are kept locally
+            """
+            def __init__(self, api):
+                super().__init__(api, "act_1")
+                self.uploaded = []
+
+            def index(self, full=False):
+                pass
+
+            def upload(self, path, key=None):
+                self.uploaded.append(os.path.basename(path))
+                return UploadedVideo(str(len(self.uploaded)))
+
+        names = [MATCHING.format(i) for i in range(2)]
+        api = mock.Mock()
+        api.call.side_effect = FacebookRequestError("url upload failed", {}, 400, {}, json.dumps(
+            {"error": {"code": 389, "message": "Unable to fetch video file from URL"}}))
+        uploader = LocalFacebookUploader(api)
+        source = FakeSource(names)
+        with mock.patch.dict(os.environ, {"TRANSFER_MODE": "link"}):
+            Uploader(FakeStorage(), source, uploader, self.tmp.name, RetryPolicy(3, 0.01)).run()
+
+        # rejected links are not retried, the files are downloaded and uploaded instead
+        self.assertEqual(api.call.call_count, 2)
+        self.assertEqual(sorted(source.downloaded), sorted(names))
+        self.assertEqual(sorted(uploader.uploaded), sorted(names))
+        self.assertEqual(source.committed, [])
+
+    def test_filter_error(self):
+        names = [MATCHING.format(i) for i in range(3)]
+
+        class FailingUploader(FakeUploader):
+            def should_be_uploaded(self, video_name):
+                if video_name == names[0]:
+                    raise Exception("index failed")
+                return super().should_be_uploaded(video_name)
+
+        class CursorSource(FakeSource):
+            def __init__(self):
+                super().__init__(names[1:])
+                self.files.insert(0, DropBoxFile(names[0], f"/J321_/{names[0]}", size=1))
+                self.cursors = MemoryCursorStorage()
+
+            def commit(self, failed_files):
+                super().commit(failed_files)
+                save_cursors(self.cursors, "/", {"/j320_": "c320", "/j321_": "c321"}, failed_files)
+
+        uploader = FailingUploader()
+        source = CursorSource()
+        Uploader(FakeStorage(), source, uploader, self.tmp.name, RetryPolicy(3, 0.01)).run()
+
+        # the file is listed again by the next run, other files are uploaded
+        self.assertEqual(sorted(uploader.uploaded), sorted(names[1:]))
+        self.assertEqual(source.committed, [names[0]])
+        self.assertEqual(source.cursors.get_cursors("/"), {"/j320_": "c320"})
+
+    def test_temporary_files(self):
+        names = [MATCHING.format(i) for i in range(3)]
+        orphan = os.path.join(self.tmp.name, "file-crashed")
+        os.mkdir(orphan)
+        open(os.path.join(orphan, names[0]), "w").close()
+        uploader = FakeUploader()
+        source = FakeSource(names, folders=("J320_", "J321_"))
+        Uploader(FakeStorage(), source, uploader, self.tmp.name, RetryPolicy(3, 0.01)).run()
+
+        # same names from different job folders are downloaded to different paths and deleted after upload
+        self.assertEqual(sorted(uploader.uploaded), sorted(names * 2))
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_duplicates_are_linked(self):
+        names = [MATCHING.format(i) for i in range(5)]
+        hashes = {names[0]: "h1", names[1]: "h1", names[2]: "h1", names[3]: "h2", names[4]: "h3"}
+        uploader = FakeUploader()
+        uploader.links["h2"] = [("100", "/J1_/old.mp4")]
+        uploader.links["h3"] = [("200", f"/J320_/{names[4]}")]
+        storage = FakeStorage()
+        Uploader(storage, FakeSource(names, hashes), uploader, self.tmp.name, RetryPolicy(3, 0.01)).run()
+
+        self.assertEqual(uploader.uploaded, [names[0]])
+        self.assertEqual(storage.duplicates, {
+            names[1]: ("1", f"/J320_/{names[0]}"),
+            names[2]: ("1", f"/J320_/{names[0]}"),
+            names[3]: ("100", "/J1_/old.mp4"),
+        })
+        self.assertEqual(len(uploader.links["h1"]), 3)
+
+    def test_accounts(self):
+        names = [f"Channel={c}_Platform=1_Job=320_{i}.mp4" for c in (1, 2) for i in range(3)]
+        hashes = {n: n for n in names}
+        act_1 = FakeUploader(fail_once=[names[0]], id_prefix="a")
+        act_2 = FakeUploader(existing=[names[1]], id_prefix="b")
+        act_2.links[names[2]] = [("100", "/J1_/old.mp4")]
+        source = FakeSource(names, hashes)
+        storage = FakeStorage()
+        router = AccountRouter({"act_1": act_1, "act_2": act_2}, parse_routes("act_1:Channel=1;act_2:*"))
+        Uploader(storage, source, router, self.tmp.name, RetryPolicy(3, 0.01)).run(wait_for_encoding=True)
+
+        # every file is downloaded once, the failed upload is only retried to its account
+        self.assertEqual(sorted(source.downloaded), sorted(names))
+        self.assertEqual(sorted(act_1.uploaded), sorted(names[:3]))
+        self.assertEqual(act_1.attempts[names[0]], 2)
+        self.assertEqual(sorted(act_2.uploaded), sorted([names[0]] + names[3:]))
+        self.assertEqual(act_2.attempts[names[0]], 1)
+        self.assertEqual(sorted(storage.accounts["act_1"]), sorted(f"/J320_/{n}" for n in names[:3]))
+        self.assertEqual(sorted(storage.accounts["act_2"]), sorted(f"/J320_/{n}" for n in [names[0], names[2]] + names[3:]))
+        self.assertEqual(storage.duplicates, {names[2]: ("100", "/J1_/old.mp4")})
+        self.assertEqual(len(storage.statuses), 7)
+        self.assertEqual(set(storage.statuses.values()), {"ready"})
+
+    def test_accounts_are_polled_concurrently(self):
+        names = [f"Channel={c}_Platform=1_Job=320_0.mp4" for c in (1, 2)]
+        barrier = threading.Barrier(2, timeout=5)
+        router = AccountRouter({"act_1": BarrierUploader(barrier, id_prefix="a"),
+                                "act_2": BarrierUploader(barrier, id_prefix="b")},
+                               parse_routes("act_1:Channel=1;act_2:Channel=2"))
+        storage = FakeStorage()
+        Uploader(storage, FakeSource(names), router, self.tmp.name, RetryPolicy(3, 0.01)).run(wait_for_encoding=True)
+
+        self.assertEqual(storage.completed, True)
+        self.assertEqual(storage.statuses, {"a1": "ready", "b1": "ready"})
+
+
+class FakePollUploader(UploaderBase):
+    def __init__(self, statuses):
+        self.statuses = statuses
+
+    def reload_many(self, videos):
+        result = {}
+        for v in videos:
+            if v.id in self.statuses:
+                status = self.statuses[v.id]
+                result[v.id] = UploadedVideo(v.id, status=status) if status != "deleted" else None
+        return result
+
+
+class TestStatusPoller(unittest.TestCase):
+    def test_poll(self):
+        storage = FakeStorage()
+        storage.statuses = {"1": None, "2": "processing", "3": "processing", "4": "ready", "5": None}
+        uploader = FakePollUploader({"1": "processing", "2": "ready", "3": "deleted", "4": "ready"})
+        duplicator = FakeDuplicator()
+        poller = StatusPoller(storage, uploader, duplicator)
+
+        self.assertEqual(poller.poll(), 2)
+        self.assertEqual(storage.statuses, {"1": "processing", "2": "ready", "3": "deleted", "4": "ready", "5": None})
+        uploader.statuses["1"] = "error"
+        uploader.statuses["5"] = "ready"
+        self.assertEqual(poller.poll(), 0)
+        self.assertEqual(storage.get_pending_videos(), [])
+        self.assertEqual([id for id, _ in duplicator.ready], ["2", "5"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+from uploader_ui.uploader_app.bookkeeping import FileTask, RunBook
+from uploader_ui.uploader_app.source import DropBoxFile
+from uploader_ui.uploader_app.uploader import UploadedVideo
+
+
+def file(name, content_hash="h1"):
+    return DropBoxFile(name, f"/J1_/{name}", 10, content_hash)
+
+
+class TestRunBook(unittest.TestCase):
+    def test_holds(self):
+        book = RunBook()
+        f = file("a.mp4")
+        book.hold(f)
+        book.hold(f)
+        self.assertIsNone(book.release(f, True))
+        self.assertTrue(book.release(f))
+        # a file which is not held is done at once
+        self.assertFalse(book.release(f))
+
+    def test_duplicates_wait_for_original(self):
+        book = RunBook()
+        original, duplicate = file("a.mp4"), file("b.mp4")
+        self.assertIsNone(book.find_original("act_1", original, "h1"))
+        task = FileTask(original, ["act_1", "act_2"])
+        book.add_task(task)
+        book.hold(duplicate)
+
+        self.assertEqual(book.find_original("act_1", duplicate, "h1"), (None, original.path))
+        self.assertEqual(book.add_uploaded(task, "act_1", UploadedVideo("1")), [duplicate])
+        self.assertEqual(book.find_original("act_1", duplicate, "h1"), ("1", original.path))
+        self.assertEqual(book.uploaded[0][1].name, "a.mp4")
+        # held by filtering and by the link waiting for the upload
+        self.assertIsNone(book.release(duplicate))
+        self.assertFalse(book.release(duplicate))
+
+    def test_give_up(self):
+        book = RunBook()
+        original, duplicate = file("a.mp4"), file("b.mp4")
+        task = FileTask(original, ["act_1", "act_2"])
+        book.add_task(task)
+        book.find_original("act_2", duplicate, "h1")
+        book.add_uploaded(task, "act_1", UploadedVideo("1"))
+        task.targets = ["act_2"]
+
+        self.assertEqual(book.give_up(task), [("act_2", original), ("act_2", duplicate)])
+        self.assertEqual(book.failed, [original, duplicate])
+        self.assertEqual(task.targets, [])
+        self.assertIsNone(book.find_original("act_2", duplicate, "h1"))
+        self.assertEqual(book.find_original("act_1", duplicate, "h1"), ("1", original.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import threading
+import time
+import unittest
+
+from uploader_ui.uploader_app.cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(unittest.TestCase):
+    def test_expiry(self):
+        clock = FakeClock()
+        cache = TTLCache(10, clock)
+        loads = []
+        load = lambda: loads.append(1) or len(loads)
+        self.assertEqual(cache.get_or_load("a", load), 1)
+        clock.now = 9
+        self.assertEqual(cache.get_or_load("a", load), 1)
+        self.assertIsNone(cache.get("b"))
+        clock.now = 10
+        self.assertEqual(cache.get_or_load("a", load), 2)
+        self.assertEqual(cache.metrics(), {"hits": 1, "misses": 3, "size": 1})
+
+        cache.put("b", "x")
+        clock.now = 25
+        cache.put("c", "y")
+        self.assertEqual(cache.metrics()["size"], 1)
+
+    def test_concurrent_misses_load_once(self):
+        cache = TTLCache(10)
+        loads = []
+
+        def load():
+            time.sleep(0.05)
+            loads.append(1)
+            return "value"
+
+        threads = [threading.Thread(target=lambda: cache.get_or_load("a", load)) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(cache.metrics(), {"hits": 4, "misses": 1, "size": 1})
+
+    def test_failed_load_is_not_cached(self):
+        cache = TTLCache(10)
+
+        def fail():
+            raise Exception("failed")
+
+        with self.assertRaises(Exception):
+            cache.get_or_load("a", fail)
+        self.assertEqual(cache.get_or_load("a", lambda: "value"), "value")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import json
+import os
+import tempfile
+import unittest
+
+from facebook_business.api import FacebookResponse
+from facebook_business.exceptions import FacebookRequestError
+
+from uploader_ui.uploader_app.chunked import ChunkedUploader
+from uploader_ui.uploader_app.storage import UploadSessionStorageBase
+
+
+class MemorySessionStorage(UploadSessionStorageBase):
+    def __init__(self):
+        self.sessions = {}
+
+    def get_upload_session(self, key):
+        return self.sessions.get(key)
+
+    def save_upload_session(self, session):
+        self.sessions[session.key] = session
+
+    def delete_upload_session(self, key):
+        self.sessions.pop(key, None)
+
+
+class FakeVideoApi:
+    """
+    Accepts chunks of chunk_size bytes, fails transfer call number fail_on
+    """
+    def __init__(self, chunk_size, fail_on=None):
+        self.chunk_size = chunk_size
+        self.fail_on = fail_on
+        self.received = b""
+        self.transfers = 0
+        self.starts = 0
+        self.title = None
+
+    def _offsets(self, start):
+        return {"start_offset": str(start), "end_offset": str(min(start + self.chunk_size, self.size))}
+
+    def call(self, method, path, params=None, files=None, url_override=None):
+        phase = params["upload_phase"]
+        if phase == "start":
+            self.starts += 1
+            self.size = params["file_size"]
+            body = dict(self._offsets(0), upload_session_id="s1", video_id="v1")
+        elif phase == "transfer":
+            self.transfers += 1
+            if self.transfers == self.fail_on:
+                raise FacebookRequestError("network", {}, 500, {}, json.dumps({"error": {"is_transient": True}}))
+            self.assertOffset(params["start_offset"])
+            self.received += files["video_file_chunk"][1]
+            body = self._offsets(len(self.received))
+        else:
+            self.title = params["title"]
+            body = {"success": True}
+        return FacebookResponse(json.dumps(body), 200)
+
+    def assertOffset(self, offset):
+        if offset != len(self.received):
+            raise AssertionError(f"wrong offset {offset}")
+
+
+class TestChunkedUploader(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "video.mp4")
+        self.data = os.urandom(1000)
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_upload(self):
+        api = FakeVideoApi(300)
+        storage = MemorySessionStorage()
+        self.assertEqual(ChunkedUploader(api, "act_1", storage).upload(self.path, "/J1_/video.mp4"), "v1")
+        self.assertEqual(api.received, self.data)
+        self.assertEqual(api.transfers, 4)
+        self.assertEqual(api.title, "video.mp4")
+        self.assertEqual(storage.sessions, {})
+
+    def test_resume(self):
+        api = FakeVideoApi(300, fail_on=3)
+        storage = MemorySessionStorage()
+        with self.assertRaises(FacebookRequestError):
+            ChunkedUploader(api, "act_1", storage).upload(self.path, "/J1_/video.mp4")
+        session = storage.sessions["act_1//J1_/video.mp4"]
+        self.assertEqual(session.start_offset, 600)
+
+        # new uploader instance as after restart
+        self.assertEqual(ChunkedUploader(api, "act_1", storage).upload(self.path, "/J1_/video.mp4"), "v1")
+        self.assertEqual(api.starts, 1)
+        self.assertEqual(api.received, self.data)
+        self.assertEqual(storage.sessions, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,190 @@
+import json
+import threading
+import unittest
+
+from facebook_business.api import FacebookResponse
+
+from uploader_ui.uploader_app.duplicator import AdDuplicator
+from uploader_ui.uploader_app.storage import AdDuplicationStorageBase
+
+TEMPLATE_SPEC = {"page_id": "p1", "instagram_actor_id": "i1",
+                 "video_data": {"video_id": "v0", "image_hash": "h0", "message": "Play now",
+                                "call_to_action": {"type": "INSTALL_MOBILE_APP", "value": {"link": "https://app"}}}}
+
+
+class MemoryDuplicationStorage(AdDuplicationStorageBase):
+    def __init__(self):
+        self.jobs = {}
+        self.videos = {}  # video id: [name, adset id, ad id, attempts]
+
+    def get_job_adset(self, template_id, job):
+        return self.jobs.get((template_id, job))
+
+    def save_job_adset(self, template_id, job, campaign_id, adset_id):
+        self.jobs[(template_id, job)] = adset_id
+
+    def get_video_ad(self, template_id, video_id):
+        return tuple(self.videos.get(video_id, [None, None, None])[1:3])
+
+    def save_video_ad(self, template_id, video_id, name, adset_id, ad_id=None):
+        attempts = self.videos.get(video_id, [None, None, None, 0])[3]
+        self.videos[video_id] = [name, adset_id, ad_id, attempts]
+
+    def video_failed(self, template_id, video_id, name, error):
+        self.videos.setdefault(video_id, [name, None, None, 0])[3] += 1
+
+    def get_failed(self, template_id, max_attempts):
+        return [(id, v[0]) for id, v in self.videos.items() if v[2] is None and v[3] < max_attempts]
+
+
+class FakeBatch:
+    def __init__(self, api):
+        self.api = api
+        self.calls = []
+
+    def add(self, method, relative_path, params=None, success=None, failure=None):
+        self.calls.append((method, relative_path, params, success))
+
+    def execute(self):
+        with self.api.lock:
+            self.api.batches.append([(m, "/".join(p)) for m, p, _, _ in self.calls])
+        for method, path, params, success in self.calls:
+            success(FacebookResponse(json.dumps(self.api.respond(method, path, params)), 200))
+
+
+class FakeApi:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = []
+        self.batches = []
+        self.params = {}
+        self.ids = 0
+        self.fail_creatives = 0
+
+    def _new_id(self, prefix):
+        self.ids += 1
+        return f"{prefix}{self.ids}"
+
+    def respond(self, method, path, params):
+        with self.lock:
+            self.params[(method, "/".join(path))] = params
+            if path == ("tpl",):
+                return {"id": "tpl", "name": "Template "}
+            if path == ("tpl", "copies"):
+                return {"copied_campaign_id": self._new_id("c")}
+            if path[-1] == "copies":
+                return {"copied_adset_id": self._new_id("s")}
+            if path[-1] == "adsets":
+                return {"data": [{"id": self._new_id("s")}]}
+            if path[-1] == "ads":
+                return {"data": [{"id": f"ad-{path[0]}", "creative": {"id": "cr0"}}]}
+            if path[-1] == "thumbnails":
+                return {"data": [{"uri": "https://t/1"}, {"uri": "https://t/2", "is_preferred": True}]}
+            if path == ("cr0",):
+                return {"id": "cr0", "name": "Template creative", "object_story_spec": TEMPLATE_SPEC}
+            if path[-1] == "adcreatives" and self.fail_creatives > 0:
+                self.fail_creatives -= 1
+                raise Exception("creative failed")
+            if path[-1] == "adcreatives":
+                return {"id": self._new_id("cr")}
+            return {"success": True}
+
+    def call(self, method, path, params=None):
+        with self.lock:
+            self.calls.append((method, "/".join(path)))
+        return FacebookResponse(json.dumps(self.respond(method, path, params)), 200)
+
+    def new_batch(self):
+        return FakeBatch(self)
+
+
+class TestAdDuplicator(unittest.TestCase):
+    def test_duplicate(self):
+        api = FakeApi()
+        duplicator = AdDuplicator(api, "act_1", "tpl", parallelism=4)
+        names = ["Channel=1_Platform=1_Job=320_Template=T{}.mp4".format(i) for i in range(3)]
+        futures = [duplicator.on_ready(f"v{i}", n) for i, n in enumerate(names)]
+        futures.append(duplicator.on_ready("v9", "Channel=1_Platform=1_Job=7_Template=T1.mp4"))
+        duplicator.close()
+        ads = [f.result() for f in futures]
+
+        self.assertEqual(len(set(ads)), 4)
+        # campaign copied once per job, template creative read once by id, creatives are not listed
+        self.assertEqual(api.calls.count(("POST", "tpl/copies")), 2)
+        self.assertEqual(api.calls.count(("GET", "cr0")), 1)
+        self.assertEqual(api.calls.count(("GET", "tpl")), 1)
+        self.assertNotIn(("GET", "act_1/adcreatives"), api.calls)
+        self.assertEqual(api.calls.count(("POST", "act_1/adcreatives")), 4)
+        self.assertEqual(len([b for b in api.batches if len(b) == 3]), 4)
+        campaigns = [p["name"] for (m, path), p in api.params.items() if m == "POST" and path.startswith("c")]
+        self.assertEqual(sorted(campaigns), ["Template 320", "Template 7"])
+
+        ad_id = ads[0]
+        self.assertEqual(api.params[("POST", ad_id)]["name"], names[0])
+        creative = api.params[("POST", ad_id)]["creative"]["creative_id"]
+        self.assertTrue(creative.startswith("cr"))
+        params = [p for (m, path), p in api.params.items() if path == "act_1/adcreatives"][0]
+        video_data = params["object_story_spec"]["video_data"]
+        self.assertEqual(video_data["image_url"], "https://t/2")
+        self.assertNotIn("image_hash", video_data)
+        self.assertEqual(video_data["call_to_action"], TEMPLATE_SPEC["video_data"]["call_to_action"])
+        self.assertEqual(TEMPLATE_SPEC["video_data"]["video_id"], "v0")
+        # template name, creative and thumbnails reads saved by the shared cache
+        self.assertEqual(duplicator.metrics()["cache"], {"hits": 4, "misses": 6, "size": 6})
+
+    def test_cached_thumbnails(self):
+        api = FakeApi()
+        duplicator = AdDuplicator(api, "act_1", "tpl", parallelism=1)
+        name = "Channel=1_Platform=1_Job=320_Template=T1.mp4"
+        duplicator.duplicate("v1", name)
+        duplicator.duplicate("v1", name)
+        duplicator.close()
+        self.assertEqual([len(b) for b in api.batches], [2, 3, 2])
+        self.assertEqual(api.calls.count(("GET", "cr0")), 1)
+
+    def test_stored_ads(self):
+        api = FakeApi()
+        storage = MemoryDuplicationStorage()
+        name = "Channel=1_Platform=1_Job=320_Template=T1.mp4"
+        duplicator = AdDuplicator(api, "act_1", "tpl", parallelism=1, duplication_storage=storage)
+        ad_id = duplicator.duplicate("v1", name)
+        duplicator.close()
+        # a new run reuses the job campaign and does not duplicate a video twice
+        duplicator = AdDuplicator(api, "act_1", "tpl", parallelism=1, duplication_storage=storage)
+        self.assertEqual(duplicator.duplicate("v1", name), ad_id)
+        duplicator.duplicate("v2", name)
+        duplicator.close()
+
+        self.assertEqual(api.calls.count(("POST", "tpl/copies")), 1)
+        self.assertEqual(api.calls.count(("POST", "act_1/adcreatives")), 2)
+        self.assertEqual(storage.jobs, {("tpl", "320"): "s2"})
+        self.assertEqual(storage.get_video_ad("tpl", "v1")[1], ad_id)
+
+    def test_retry_failed(self):
+        api = FakeApi()
+        api.fail_creatives = 1
+        storage = MemoryDuplicationStorage()
+        name = "Channel=1_Platform=1_Job=320_Template=T1.mp4"
+        duplicator = AdDuplicator(api, "act_1", "tpl", parallelism=1, duplication_storage=storage, max_attempts=2)
+        with self.assertRaises(Exception):
+            duplicator.on_ready("v1", name).result()
+        self.assertEqual(storage.get_failed("tpl", 2), [("v1", name)])
+        self.assertEqual(duplicator.retry_failed(), 1)
+        duplicator.close()
+
+        # the ad set copied by the failed attempt gets the ad
+        adset_id, ad_id = storage.get_video_ad("tpl", "v1")
+        self.assertEqual(ad_id, f"ad-{adset_id}")
+        self.assertEqual(api.calls.count(("POST", "s2/copies")), 1)
+        self.assertEqual(storage.get_failed("tpl", 2), [])
+
+    def test_no_job(self):
+        api = FakeApi()
+        duplicator = AdDuplicator(api, "act_1", "tpl", parallelism=1)
+        self.assertIsNone(duplicator.duplicate("v1", "video.mp4"))
+        duplicator.close()
+        self.assertEqual(api.calls, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,9 @@
 import unittest
 
-from uploader_ui.uploader_app.pattern import is_file_match
+from uploader_ui.uploader_app.pattern import is_file_match, match_file, parse_attributes, get_attributes
+from uploader_ui.uploader_app.source import DropBoxFile
+
+MATCHING = "Channel=1_Platform=1_Creative-Theme=4_Job=320.mp4"
 
 
 class TestPattern(unittest.TestCase):
@@ -21,6 +24,27 @@ class TestPattern(unittest.TestCase):
         for (res, str) in examples:
             self.assertEqual(is_file_match(str), res, str)
 
+    def test_match_file(self):
+        self.assertTrue(is_file_match(MATCHING.replace(".mp4", ".MP4")))
+        self.assertFalse(is_file_match(MATCHING.replace(".mp4", ".mov")))
+        self.assertFalse(match_file(DropBoxFile(MATCHING, "/J320_/" + MATCHING, is_folder=True)))
+
+        file = DropBoxFile(MATCHING, "/J320_/" + MATCHING)
+        self.assertTrue(match_file(file))
+        file.filename = "other.mp4"
+        self.assertTrue(match_file(file))
+
+    def test_parse_attributes(self):
+        self.assertEqual(parse_attributes("Channel=1_Platform=2_Template=T14_final_Geo-Targeting=US_Length=27.MP4"),
+                         {"Channel": 1, "Platform": 2, "Template": "T14_final", "Geo-Targeting": "US", "Length": 27})
+        self.assertEqual(parse_attributes("prefix_Job=320_=5.mp4"), {"Job": 320})
+        # only ASCII digits fitting the number column are numbers
+        self.assertEqual(parse_attributes("Job=\u00b2_Copy=\u0663_Length=9223372036854775807_Creator=9223372036854775808"),
+                         {"Job": "\u00b2", "Copy": "\u0663", "Length": 2 ** 63 - 1, "Creator": "9223372036854775808"})
+        self.assertEqual(parse_attributes("Job=00000000000000000001.mp4"), {"Job": 1})
+        self.assertEqual(get_attributes(DropBoxFile("Folder", "/Folder", is_folder=True)), {})
+        self.assertEqual(get_attributes(DropBoxFile(MATCHING, "/J320_/" + MATCHING))["Job"], 320)
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
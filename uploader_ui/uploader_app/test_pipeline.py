@@ -0,0 +1,60 @@
+import threading
+import unittest
+
+from uploader_ui.uploader_app.pipeline import Pipeline, Stage
+
+
+class TestPipeline(unittest.TestCase):
+    def test_items_pass_all_stages(self):
+        results = []
+        lock = threading.Lock()
+
+        def collect(x):
+            with lock:
+                results.append(x)
+
+        pipeline = Pipeline(
+            Stage('odd', lambda x: x if x % 2 else None, 1, 2),
+            Stage('square', lambda x: x * x, 3, 2),
+            Stage('collect', collect, 2, 2),
+        )
+        self.assertEqual(pipeline.run(range(10)), 10)
+        self.assertEqual(sorted(results), [1, 9, 25, 49, 81])
+
+    def test_handler_error_does_not_stop_stage(self):
+        results = []
+
+        def fail_on_three(x):
+            if x == 3:
+                raise Exception("boom")
+            return x
+
+        pipeline = Pipeline(
+            Stage('fail', fail_on_three, 2, 1),
+            Stage('collect', results.append, 1, 1),
+        )
+        pipeline.run(range(5))
+        self.assertEqual(sorted(results), [0, 1, 2, 4])
+
+    def test_backpressure(self):
+        release = threading.Event()
+        listed = []
+
+        def items():
+            for i in range(10):
+                listed.append(i)
+                yield i
+
+        pipeline = Pipeline(Stage('slow', lambda x: release.wait(), 1, 2))
+        t = threading.Thread(target=pipeline.run, args=(items(),))
+        t.start()
+        t.join(0.2)
+        # one item in the worker, two in the queue and one blocked on put
+        self.assertLessEqual(len(listed), 4)
+        release.set()
+        t.join()
+        self.assertEqual(len(listed), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
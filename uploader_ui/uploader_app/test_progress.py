@@ -0,0 +1,34 @@
+import unittest
+
+from uploader_ui.uploader_app.progress import Progress
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestProgress(unittest.TestCase):
+    def test_rates_since_previous_snapshot(self):
+        clock = FakeClock()
+        progress = Progress(clock)
+        progress.add("uploaded", 3)
+        progress.add("ready")
+        progress.add("bytes_downloaded", 1000)
+        clock.now = 2
+        s = progress.snapshot()
+        self.assertEqual((s["download_bytes_per_second"], s["encoding"], s["elapsed"]), (500, 2, 2))
+
+        progress.add("bytes_downloaded", 100)
+        progress.add("bytes_uploaded", 400)
+        clock.now = 4
+        s = progress.snapshot()
+        self.assertEqual((s["download_bytes_per_second"], s["upload_bytes_per_second"]), (50, 200))
+        self.assertEqual(progress.snapshot()["upload_bytes_per_second"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
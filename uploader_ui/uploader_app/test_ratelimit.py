@@ -0,0 +1,72 @@
+import json
+import unittest
+
+from facebook_business.exceptions import FacebookRequestError
+
+from uploader_ui.uploader_app.ratelimit import RateGovernor
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def make_governor(clock):
+    return RateGovernor(max_rate=10, min_rate=1, slowdown_threshold=50, throttle_pause=30,
+                        clock=clock.clock, sleep=clock.sleep)
+
+
+class TestRateGovernor(unittest.TestCase):
+    def test_token_bucket(self):
+        clock = FakeClock()
+        g = make_governor(clock)
+        for _ in range(10):
+            g.acquire()
+        self.assertEqual(clock.sleeps, [])
+        g.acquire()
+        self.assertAlmostEqual(sum(clock.sleeps), 0.1)
+        self.assertEqual(g.metrics()['calls'], 11)
+
+    def test_slow_down_on_usage(self):
+        clock = FakeClock()
+        g = make_governor(clock)
+        g.observe_headers({'X-App-Usage': json.dumps({'call_count': 75, 'total_cputime': 10, 'total_time': 5})})
+        self.assertAlmostEqual(g.metrics()['rate'], 5)
+        self.assertEqual(g.metrics()['usage_pct'], {'app': 75})
+        g.observe_headers({'x-app-usage': json.dumps({'call_count': 99})})
+        self.assertAlmostEqual(g.metrics()['rate'], 1)
+        g.observe_headers({'x-app-usage': json.dumps({'call_count': 10})})
+        self.assertAlmostEqual(g.metrics()['rate'], 10)
+
+    def test_pause_until_regain_access(self):
+        clock = FakeClock()
+        g = make_governor(clock)
+        usage = {'123': [{'type': 'ads_management', 'call_count': 100, 'total_cputime': 20, 'total_time': 20,
+                          'estimated_time_to_regain_access': 2}]}
+        body = json.dumps({'error': {'code': 80004, 'message': '(#80004) There have been too many calls'}})
+        e = FacebookRequestError('throttled', {}, 400, {'x-business-use-case-usage': json.dumps(usage)}, body)
+        g.observe_error(e)
+        self.assertEqual(g.metrics()['throttled'], 1)
+        self.assertEqual(g.metrics()['paused_for'], 120)
+        g.acquire()
+        # bucket is refilled at the lowest rate after the pause
+        self.assertAlmostEqual(sum(clock.sleeps), 121)
+
+    def test_pause_on_throttling_without_headers(self):
+        clock = FakeClock()
+        g = make_governor(clock)
+        body = json.dumps({'error': {'code': 17, 'message': 'User request limit reached'}})
+        g.observe_error(FacebookRequestError('throttled', {}, 400, {}, body))
+        self.assertEqual(g.metrics()['paused_for'], 30)
+
+
+if __name__ == "__main__":
+    unittest.main()
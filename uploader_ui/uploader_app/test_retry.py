@@ -0,0 +1,81 @@
+import threading
+import unittest
+
+from dropbox import exceptions as dropbox_exceptions
+from facebook_business.exceptions import FacebookRequestError
+
+from uploader_ui.uploader_app.pipeline import Stage
+from uploader_ui.uploader_app.retry import RetryPolicy, RetryScheduler, classify_error, \
+    ERROR_RATE_LIMIT, ERROR_TRANSIENT, ERROR_PERMANENT
+from uploader_ui.uploader_app.uploader import TooManyCallsError
+
+
+def fb_error(status, error):
+    import json
+    return FacebookRequestError("failed", {}, status, {}, json.dumps({"error": error}))
+
+
+class TestRetry(unittest.TestCase):
+    def test_classify_error(self):
+        self.assertEqual(classify_error(TooManyCallsError("#80004")), ERROR_RATE_LIMIT)
+        self.assertEqual(classify_error(fb_error(400, {"code": 80004, "message": "(#80004) too many calls"})), ERROR_RATE_LIMIT)
+        self.assertEqual(classify_error(fb_error(500, {"code": 2, "message": "unexpected"})), ERROR_TRANSIENT)
+        self.assertEqual(classify_error(fb_error(400, {"code": 390, "is_transient": True})), ERROR_TRANSIENT)
+        self.assertEqual(classify_error(fb_error(400, {"code": 100, "message": "invalid parameter"})), ERROR_PERMANENT)
+        self.assertEqual(classify_error(ConnectionError("reset")), ERROR_TRANSIENT)
+        self.assertEqual(classify_error(dropbox_exceptions.ApiError("1", "path/not_found", None, None)), ERROR_PERMANENT)
+
+    def test_classify_decoded_error(self):
+        try:
+            try:
+                raise fb_error(400, {"code": 389, "message": "Unable to fetch video"})
+            except FacebookRequestError as e:
+                raise Exception("facebook request failed") from e
+        except Exception as e:
+            self.assertEqual(classify_error(e), ERROR_PERMANENT)
+        try:
+            try:
+                raise ConnectionError("reset")
+            except ConnectionError as e:
+                raise Exception("Dropbox error") from e
+        except Exception as e:
+            self.assertEqual(classify_error(e), ERROR_TRANSIENT)
+
+    def test_policy(self):
+        policy = RetryPolicy(max_attempts=3, base_delay=1, max_delay=5, rate_limit_delay=60)
+        self.assertTrue(policy.should_retry(2, ERROR_TRANSIENT))
+        self.assertFalse(policy.should_retry(3, ERROR_TRANSIENT))
+        self.assertFalse(policy.should_retry(1, ERROR_PERMANENT))
+        for _ in range(20):
+            self.assertTrue(0.5 <= policy.delay(1, ERROR_TRANSIENT) <= 1.5)
+            self.assertTrue(2 <= policy.delay(3, ERROR_TRANSIENT) <= 6)
+            self.assertTrue(2.5 <= policy.delay(10, ERROR_TRANSIENT) <= 7.5)
+            self.assertTrue(2.5 <= policy.delay(1, ERROR_RATE_LIMIT) <= 7.5)
+
+    def test_scheduler_retries_until_done(self):
+        handled = []
+        scheduler = RetryScheduler()
+
+        def handler(x):
+            handled.append(x)
+            if handled.count(x) < 3:
+                scheduler.retry(x, stage, 0.01)
+            else:
+                scheduler.done()
+
+        stage = Stage('work', handler, 2, 2)
+        scheduler.attach(stage)
+        stage.start()
+        scheduler.start()
+        for i in range(3):
+            scheduler.track()
+            stage.put(i)
+        scheduler.close()
+        scheduler.join()
+        stage.join()
+        self.assertEqual(sorted(handled), [0, 0, 0, 1, 1, 1, 2, 2, 2])
+        self.assertEqual(scheduler.pending(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+
+from uploader_ui.uploader_app.routing import AccountRouter, parse_routes
+from uploader_ui.uploader_app.source import DropBoxFile
+
+
+def file(name):
+    return DropBoxFile(name, f"/J320_/{name}")
+
+
+class TestAccountRouter(unittest.TestCase):
+    def test_parse_routes(self):
+        self.assertEqual(parse_routes(" act_1:Channel=1|2, Platform=1 ; act_2:* ;act_3"), {
+            "act_1": {"Channel": {"1", "2"}, "Platform": {"1"}},
+            "act_2": {},
+            "act_3": {},
+        })
+        self.assertEqual(parse_routes(""), {})
+        with self.assertRaises(ValueError):
+            parse_routes("act_1:Channel")
+
+    def test_route(self):
+        router = AccountRouter({"act_1": None, "act_2": None, "act_3": None},
+                               parse_routes("act_1:Channel=1|2,Platform=1;act_2:Geo-Targeting=US"))
+        self.assertEqual(router.route(file("Channel=2_Platform=1_Geo-Targeting=US_Job=320_0.mp4")),
+                         ["act_1", "act_2", "act_3"])
+        self.assertEqual(router.route(file("Channel=3_Platform=1_Geo-Targeting=CA_Job=320_0.mp4")), ["act_3"])
+        self.assertEqual(router.route(file("Channel=1_Platform=2_Geo-Targeting=US_Job=320_0.mp4")), ["act_2", "act_3"])
+
+    def test_unknown_account(self):
+        with self.assertRaises(ValueError):
+            AccountRouter({"act_1": None}, parse_routes("act_2:*"))
+
+
+if __name__ == "__main__":
+    unittest.main()
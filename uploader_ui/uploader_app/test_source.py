@@ -0,0 +1,205 @@
+import hashlib
+import os
+import tempfile
+import threading
+import unittest
+
+from dropbox import dropbox, files
+
+from uploader_ui.uploader_app.source import DropBoxSource, DropBoxFile, DropboxContentHasher, ContentHashMismatchError
+from uploader_ui.uploader_app.storage import ListingCursorStorageBase
+
+
+class FakeMetadata:
+    def __init__(self, content_hash):
+        self.content_hash = content_hash
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+        self.chunk_sizes = []
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        self.chunk_sizes.append(chunk_size)
+        for i in range(0, len(self.data), chunk_size):
+            yield self.data[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDropbox:
+    def __init__(self, data, content_hash):
+        self.response = FakeResponse(data)
+        self.content_hash = content_hash
+
+    def files_download(self, path):
+        return FakeMetadata(self.content_hash), self.response
+
+
+class FakeEntry:
+    def __init__(self, path):
+        self.path_display = path
+        self.name = path.rsplit("/", 1)[-1]
+
+
+class FakeListResult:
+    def __init__(self, entries, cursor, has_more):
+        self.entries = entries
+        self.cursor = cursor
+        self.has_more = has_more
+
+
+class FakeListingDropbox:
+    """
+    Job folders J1_..Jn_ with files_per_folder files each, listed by pages of page_size entries
+    """
+    def __init__(self, folders, files_per_folder, page_size, fail_folder=None):
+        self.folders = [f"/J{i}_" for i in range(1, folders + 1)]
+        self.files = {f: [FakeEntry(f"{f}/video{j}.mp4") for j in range(files_per_folder)] for f in self.folders}
+        self.page_size = page_size
+        self.fail_folder = fail_folder
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _page(self, path, offset):
+        with self._lock:
+            self.calls += 1
+        if path == self.fail_folder:
+            raise Exception("listing failed")
+        entries = self.files[path][offset:offset + self.page_size]
+        end = offset + len(entries)
+        return FakeListResult(entries, f"{path}:{end}", end < len(self.files[path]))
+
+    def files_list_folder(self, path, recursive=False, **kwargs):
+        if not recursive:
+            return FakeListResult([FakeEntry(f) for f in self.folders], "", False)
+        return self._page(path, 0)
+
+    def files_list_folder_continue(self, cursor):
+        if cursor == "expired":
+            raise dropbox.ApiError("1", files.ListFolderContinueError.reset, None, None)
+        path, offset = cursor.split(":")
+        return self._page(path, int(offset))
+
+    def add_file(self, folder, name):
+        self.files[folder].append(FakeEntry(f"{folder}/{name}"))
+
+
+class MemoryCursorStorage(ListingCursorStorageBase):
+    def __init__(self):
+        self.cursors = {}
+
+    def get_cursors(self, root):
+        return dict(self.cursors.get(root, {}))
+
+    def save_cursor(self, root, path, cursor):
+        self.cursors.setdefault(root, {})[path] = cursor
+
+    def clear_cursors(self, root):
+        self.cursors.pop(root, None)
+
+
+def make_source(dbx, chunk_size=None, list_parallelism=None, cursor_storage=None):
+    return DropBoxSource(None, "/", chunk_size, list_parallelism, dbx=dbx, cursor_storage=cursor_storage)
+
+
+def content_hash(data):
+    h = DropboxContentHasher()
+    h.update(data)
+    return h.hexdigest()
+
+
+class TestDropBoxSource(unittest.TestCase):
+    def test_content_hash(self):
+        data = b"abc"
+        self.assertEqual(content_hash(data), hashlib.sha256(hashlib.sha256(data).digest()).hexdigest())
+        self.assertEqual(content_hash(b""), hashlib.sha256().hexdigest())
+
+    def test_content_hash_does_not_depend_on_chunks(self):
+        data = os.urandom(DropboxContentHasher.BLOCK_SIZE + 100)
+        blocks = hashlib.sha256(data[:DropboxContentHasher.BLOCK_SIZE]).digest() + \
+            hashlib.sha256(data[DropboxContentHasher.BLOCK_SIZE:]).digest()
+        h = DropboxContentHasher()
+        for i in range(0, len(data), 999999):
+            h.update(data[i:i + 999999])
+        self.assertEqual(h.hexdigest(), hashlib.sha256(blocks).hexdigest())
+        self.assertEqual(content_hash(data), h.hexdigest())
+
+    def test_download_streams_chunks(self):
+        data = b"0123456789" * 10
+        dbx = FakeDropbox(data, content_hash(data))
+        src = make_source(dbx, 7)
+        with tempfile.TemporaryDirectory() as d:
+            dest = os.path.join(d, "video.mp4")
+            src.download_file(DropBoxFile("video.mp4", "/J1_/video.mp4"), dest)
+            with open(dest, "rb") as f:
+                self.assertEqual(f.read(), data)
+        self.assertEqual(dbx.response.chunk_sizes, [7])
+        self.assertTrue(dbx.response.closed)
+
+    def test_download_hash_mismatch(self):
+        dbx = FakeDropbox(b"payload", content_hash(b"other"))
+        src = make_source(dbx, 3)
+        with tempfile.TemporaryDirectory() as d:
+            dest = os.path.join(d, "video.mp4")
+            with self.assertRaises(ContentHashMismatchError):
+                src.download_file(DropBoxFile("video.mp4", "/J1_/video.mp4"), dest)
+            self.assertFalse(os.path.exists(dest))
+
+
+class TestDropBoxListing(unittest.TestCase):
+    def test_all_files_listed(self):
+        dbx = FakeListingDropbox(folders=7, files_per_folder=25, page_size=10)
+        for parallelism in (1, 3, 20):
+            files = list(make_source(dbx, list_parallelism=parallelism).get_files())
+            self.assertEqual(sorted(f.path for f in files),
+                             sorted(e.path_display for entries in dbx.files.values() for e in entries))
+
+    def test_listing_error_is_raised(self):
+        dbx = FakeListingDropbox(folders=5, files_per_folder=3, page_size=2, fail_folder="/J3_")
+        with self.assertRaises(Exception):
+            list(make_source(dbx, list_parallelism=2).get_files())
+
+    def test_early_close_stops_listing(self):
+        dbx = FakeListingDropbox(folders=50, files_per_folder=100, page_size=1)
+        files = make_source(dbx, list_parallelism=4).get_files()
+        next(files)
+        files.close()
+        calls = dbx.calls
+        self.assertLess(calls, 50 * 100)
+        self.assertEqual(dbx.calls, calls)
+
+
+class TestDropBoxCursors(unittest.TestCase):
+    def test_only_changes_are_listed(self):
+        dbx = FakeListingDropbox(folders=3, files_per_folder=5, page_size=2)
+        storage = MemoryCursorStorage()
+        source = make_source(dbx, list_parallelism=2, cursor_storage=storage)
+        self.assertEqual(len(list(source.get_files())), 15)
+        source.commit([])
+        self.assertEqual(len(storage.cursors["/"]), 3)
+
+        dbx.add_file("/J2_", "new.mp4")
+        self.assertEqual([f.path for f in source.get_files()], ["/J2_/new.mp4"])
+
+    def test_failed_files_are_listed_again(self):
+        dbx = FakeListingDropbox(folders=2, files_per_folder=2, page_size=10)
+        storage = MemoryCursorStorage()
+        source = make_source(dbx, cursor_storage=storage)
+        failed = [f for f in source.get_files() if f.path == "/J1_/video1.mp4"]
+        source.commit(failed)
+        self.assertEqual(list(storage.cursors["/"]), ["/j2_"])
+        self.assertEqual(sorted(f.path for f in source.get_files()), ["/J1_/video0.mp4", "/J1_/video1.mp4"])
+
+    def test_reset_cursor_lists_folder_again(self):
+        dbx = FakeListingDropbox(folders=1, files_per_folder=3, page_size=10)
+        storage = MemoryCursorStorage()
+        storage.save_cursor("/", "/j1_", "expired")
+        self.assertEqual(len(list(make_source(dbx, cursor_storage=storage).get_files())), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
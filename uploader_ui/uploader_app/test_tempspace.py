@@ -0,0 +1,58 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from uploader_ui.uploader_app.tempspace import TempSpace
+
+
+class TestTempSpace(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_unique_paths(self):
+        space = TempSpace(self.tmp.name, 0)
+        a = space.reserve("video.mp4", 10)
+        b = space.reserve("video.mp4", 10)
+        self.assertNotEqual(a, b)
+        self.assertEqual(os.path.basename(a), "video.mp4")
+        with open(a, "w") as f:
+            f.write("a")
+        space.release(a)
+        self.assertFalse(os.path.exists(os.path.dirname(a)))
+        self.assertEqual(space.metrics(), {"files": 1, "reserved_bytes": 10, "budget": 0})
+
+    def test_budget_blocks_until_released(self):
+        space = TempSpace(self.tmp.name, 100)
+        first = space.reserve("a.mp4", 60)
+        reserved = []
+        t = threading.Thread(target=lambda: reserved.append(space.reserve("b.mp4", 60)))
+        t.start()
+        time.sleep(0.05)
+        self.assertEqual(reserved, [])
+        space.release(first)
+        t.join(1)
+        self.assertEqual(len(reserved), 1)
+        # larger than the budget, but nothing else is reserved once b is released
+        space.release(reserved[0])
+        big = space.reserve("c.mp4", 500)
+        self.assertEqual(space.metrics()["reserved_bytes"], 500)
+        space.release(big)
+
+    def test_clean_orphans(self):
+        space = TempSpace(self.tmp.name, 0)
+        orphan = space.reserve("orphan.mp4", 1)
+        with open(orphan, "w") as f:
+            f.write("x")
+        other = os.path.join(self.tmp.name, "keep.txt")
+        open(other, "w").close()
+        TempSpace(self.tmp.name, 0).clean()
+        self.assertEqual(os.listdir(self.tmp.name), ["keep.txt"])
+
+
+if __name__ == "__main__":
+    unittest.main()
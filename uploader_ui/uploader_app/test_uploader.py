@@ -1,8 +1,86 @@
+import json
+import os
 import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
 
+from facebook_business.api import FacebookResponse
+from facebook_business.exceptions import FacebookRequestError
+
+from uploader_ui.uploader_app.retry import classify_error, ERROR_PERMANENT, ERROR_RATE_LIMIT
+from uploader_ui.uploader_app.storage import VideoIndexStorageBase
 from uploader_ui.uploader_app.uploader import FacebookUploaderNoWait, UploadedVideo
 
 
+class MemoryIndexStorage(VideoIndexStorageBase):
+    def __init__(self):
+        self.videos = {}
+        self.last_created_time = None
+
+    def load_videos(self, account_id):
+        return list(self.videos.values())
+
+    def save_videos(self, account_id, videos):
+        self.videos.update({v.id: v for v in videos})
+
+    def delete_video(self, account_id, video_id):
+        self.videos.pop(video_id, None)
+
+    def clear(self, account_id):
+        self.videos = {}
+        self.last_created_time = None
+
+    def get_last_created_time(self, account_id):
+        return self.last_created_time
+
+    def set_last_created_time(self, account_id, created_time):
+        self.last_created_time = created_time
+
+
+class FakeBatch:
+    def __init__(self, api):
+        self.api = api
+        self.calls = []
+
+    def add(self, method, relative_path, params=None, success=None, failure=None):
+        self.calls.append((relative_path[0], success, failure))
+
+    def execute(self):
+        self.api.batch_sizes.append(len(self.calls))
+        for id, success, failure in self.calls:
+            statuses = self.api.statuses.get(id)
+            if statuses is None:
+                body = {"error": {"code": 100, "error_subcode": 33}}
+                failure(FacebookResponse(json.dumps(body), 400))
+            else:
+                status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+                body = {"id": id, "title": self.api.titles.get(id, f"video{id}"), "status": {"video_status": status}}
+                success(FacebookResponse(json.dumps(body), 200))
+
+
+class FakeApi:
+    def __init__(self, statuses, titles=None):
+        self.statuses = statuses
+        self.titles = titles or {}
+        self.batch_sizes = []
+
+    def new_batch(self):
+        return FakeBatch(self)
+
+
+class FakeAccountUploader(FacebookUploaderNoWait):
+    def __init__(self, videos, index_storage):
+        api = FakeApi({v.id: [v.status] for v in videos}, {v.id: v.name for v in videos})
+        super().__init__(api, None, index_storage)
+        self.videos = videos
+        self.fetched = 0
+
+    def _fetch_videos(self, since=None):
+        for v in sorted(self.videos, key=lambda x: x.created_time, reverse=True):
+            self.fetched += 1
+            yield v
+
+
 class TestFacebookSource(unittest.TestCase):
     def test_accept_ids(self):
         upl = FacebookUploaderNoWait(None, None)
@@ -21,7 +99,83 @@ class TestFacebookSource(unittest.TestCase):
         self.assertEqual(upl.get_by_name("test2"), None)
         self.assertEqual(upl.should_be_uploaded("test2"), True)
 
+    def test_incremental_index(self):
+        t = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        videos = [UploadedVideo(str(i), f"test{i}", "ready", t + timedelta(days=i)) for i in range(10)]
+        storage = MemoryIndexStorage()
+
+        upl = FakeAccountUploader(videos, storage)
+        upl.index()
+        self.assertEqual(upl.fetched, 10)
+        self.assertEqual(storage.last_created_time, t + timedelta(days=9))
+
+        videos.append(UploadedVideo("10", "test10", None, t + timedelta(days=10)))
+        upl = FakeAccountUploader(videos, storage)
+        upl.index()
+        # new video, the newest known one and the first one older than the overlap window
+        self.assertEqual(upl.fetched, 3)
+        self.assertEqual(upl.should_be_uploaded("test10"), False)
+        self.assertEqual(upl.should_be_uploaded("test0"), False)
+        self.assertEqual(storage.last_created_time, t + timedelta(days=10))
+
+        # stored videos are checked in batches, deleted ones are uploaded again
+        upl = FakeAccountUploader(videos[2:], storage)
+        upl.index()
+        self.assertEqual(upl._api.batch_sizes, [11])
+        self.assertEqual(upl.should_be_uploaded("test1"), True)
+        self.assertEqual(upl.should_be_uploaded("test2"), False)
+        self.assertNotIn("1", storage.videos)
+
+        upl = FakeAccountUploader(videos[1:], storage)
+        upl.index(full=True)
+        self.assertEqual(upl.fetched, 10)
+        self.assertEqual(upl.should_be_uploaded("test0"), True)
+
+
+
+    @mock.patch.dict(os.environ, {"FB_POLL_INTERVAL_MIN": "0.001", "FB_POLL_INTERVAL_MAX": "0.004"})
+    def test_wait_all(self):
+        statuses = {str(i): ["processing", "ready"] for i in range(60)}
+        statuses["1"] = ["processing", "processing", "processing", "error"]
+        del statuses["2"]
+        upl = FacebookUploaderNoWait(FakeApi(statuses), None)
+        upl.set_uploaded_videos([UploadedVideo(str(i)) for i in range(60)])
+
+        changes = upl.wait_all()
+        first = next(changes)
+        # the first batch is yielded before the next one is reloaded
+        self.assertEqual(upl._api.batch_sizes, [50])
+        changes = [first] + list(changes)
+        self.assertEqual(upl._api.batch_sizes[:2], [50, 10])
+        self.assertEqual([s for id, s in changes if id == "0"], ["processing", "ready"])
+        self.assertEqual([s for id, s in changes if id == "1"], ["processing", "error"])
+        self.assertEqual([s for id, s in changes if id == "2"], [])
+        self.assertEqual(len(changes), 2 * 59)
+        self.assertEqual(upl.get_by_id("0").status, "ready")
+
+    def test_upload_url(self):
+        api = mock.Mock()
+        api.call.return_value = FacebookResponse(json.dumps({"id": "7"}), 200)
+        upl = FacebookUploaderNoWait(api, "act_1")
+        video = upl.upload_url("https://dl/video.mp4", "video.mp4")
+
+        self.assertEqual((video.id, video.name), ("7", "video.mp4"))
+        api.call.assert_called_once_with("POST", ("act_1", "advideos"),
+                                         {"file_url": "https://dl/video.mp4", "title": "video.mp4"})
+        upl.set_uploaded_videos([video])
+        self.assertEqual(list(upl._uploaded_videos), ["7"])
 
+    def test_upload_url_errors(self):
+        api = mock.Mock()
+        upl = FacebookUploaderNoWait(api, "act_1")
+        for message, error_class in (("Unable to fetch video file from URL", ERROR_PERMANENT),
+                                     ("(#80004) There have been too many calls", ERROR_RATE_LIMIT)):
+            body = json.dumps({"error": {"code": 389 if error_class == ERROR_PERMANENT else 80004,
+                                         "message": message}})
+            api.call.side_effect = FacebookRequestError("failed", {}, 400, {}, body)
+            with self.assertRaises(Exception) as raised:
+                upl.upload_url("https://dl/video.mp4", "video.mp4")
+            self.assertEqual(classify_error(raised.exception), error_class)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from uploader_ui.uploader_app.app import Uploader
+from uploader_ui.uploader_app.retry import RetryPolicy
+from uploader_ui.uploader_app.test_app import FakeSource, FakeUploader, FakeStorage, MATCHING
+from uploader_ui.uploader_app.workqueue import WorkQueueBase, LeasedSource, enqueue_listed, worker_id, \
+    worker_alive, worker_temp_dir, clean_worker_dirs
+
+
+class MemoryWorkQueue(WorkQueueBase):
+    def __init__(self, max_attempts=3):
+        self.max_attempts = max_attempts
+        self.items = {}  # path: [file, status, worker, expires_at, attempts]
+        self.completed = []
+        self._lock = threading.Lock()
+
+    def enqueue(self, files):
+        with self._lock:
+            for f in files:
+                self.items.setdefault(f.path, [f, "pending", "", None, 0])
+        return len(files)
+
+    def _leasable(self, item, now):
+        return item[4] < self.max_attempts and (item[1] == "pending" or (item[1] == "leased" and item[3] < now))
+
+    def lease(self, worker, count, lease_seconds):
+        with self._lock:
+            now = time.monotonic()
+            leased = [i for i in self.items.values() if self._leasable(i, now)][:count]
+            for i in leased:
+                i[1:] = ["leased", worker, now + lease_seconds, i[4] + 1]
+            return [i[0] for i in leased]
+
+    def renew(self, worker, paths, lease_seconds):
+        with self._lock:
+            held = [self.items[p] for p in paths if self.items[p][1:3] == ["leased", worker]]
+            for i in held:
+                i[3] = time.monotonic() + lease_seconds
+            return [i[0].path for i in held]
+
+    def complete(self, worker, path, failed):
+        with self._lock:
+            item = self.items[path]
+            if item[1:3] != ["leased", worker]:
+                return
+            self.completed.append((path, failed))
+            if not failed:
+                item[1] = "done"
+            else:
+                item[1:4] = ["failed" if item[4] >= self.max_attempts else "pending", "", None]
+
+    def release(self, worker, paths):
+        with self._lock:
+            for p in paths:
+                item = self.items[p]
+                if item[1:3] == ["leased", worker]:
+                    item[1:] = ["pending", "", None, item[4] - 1]
+
+    def has_work(self):
+        with self._lock:
+            now = time.monotonic()
+            return any(self._leasable(i, now) for i in self.items.values())
+
+    def statuses(self):
+        return {f.name: status for f, status, *_ in self.items.values()}
+
+
+class TestLeasedSource(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_worker(self, queue, source, uploader, **kwargs):
+        leased = LeasedSource(queue, source, lease_seconds=60, **kwargs)
+        # workers share the root, a starting run only cleans the directory of its worker
+        tmp_dir = worker_temp_dir(self.tmp.name, leased.worker)
+        try:
+            Uploader(FakeStorage(), leased, uploader, tmp_dir, RetryPolicy(1, 0.01)).run()
+        finally:
+            leased.close()
+
+    def test_enqueue_listed(self):
+        names = [MATCHING.format(i) for i in range(3)] + ["not-matching.mp4"]
+        source = FakeSource(names)
+        queue = MemoryWorkQueue()
+        self.assertEqual(enqueue_listed(source, queue, batch_size=2), 3)
+        self.assertEqual(sorted(queue.statuses()), sorted(names[:3]))
+        self.assertEqual(source.committed, [])
+
+    def test_workers_share_queue(self):
+        names = [MATCHING.format(i) for i in range(20)]
+        source = FakeSource(names)
+        queue = MemoryWorkQueue()
+        queue.enqueue(source.files)
+        uploaders = [FakeUploader(), FakeUploader()]
+        workers = [threading.Thread(target=self.run_worker, args=(queue, source, u), kwargs={"batch_size": 2})
+                   for u in uploaders]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        # every file is uploaded by exactly one of the workers
+        self.assertEqual(sorted(uploaders[0].uploaded + uploaders[1].uploaded), sorted(names))
+        self.assertEqual(set(queue.statuses().values()), {"done"})
+        self.assertEqual(len(queue.completed), len(names))
+
+    def test_failed_file_is_queued_again(self):
+        names = [MATCHING.format(i) for i in range(2)]
+        source = FakeSource(names)
+        queue = MemoryWorkQueue(max_attempts=2)
+        queue.enqueue(source.files)
+        uploader = FakeUploader(fail_always=[names[0]])
+        self.run_worker(queue, source, uploader)
+        self.assertEqual(queue.statuses(), {names[0]: "pending", names[1]: "done"})
+        # leased again by the next run
+        self.run_worker(queue, source, uploader)
+
+        self.assertEqual(uploader.attempts[names[0]], 2)
+        self.assertEqual(queue.statuses(), {names[0]: "failed", names[1]: "done"})
+
+    def test_duplicates_are_done_after_their_original(self):
+        names = [MATCHING.format(i) for i in range(3)]
+        source = FakeSource(names, {n: "h1" for n in names})
+        queue = MemoryWorkQueue()
+        queue.enqueue(source.files)
+        uploader = FakeUploader()
+        self.run_worker(queue, source, uploader)
+
+        self.assertEqual(len(uploader.uploaded), 1)
+        self.assertEqual(sorted(queue.completed), sorted((f.path, False) for f in source.files))
+
+    def test_expired_lease(self):
+        source = FakeSource([MATCHING.format(0)])
+        queue = MemoryWorkQueue()
+        queue.enqueue(source.files)
+        first = LeasedSource(queue, source, worker="w1", lease_seconds=0.01)
+        second = LeasedSource(queue, source, worker="w2", lease_seconds=60)
+        try:
+            file = next(first.get_files())
+            first._closed.set()
+            first._thread.join()
+            time.sleep(0.02)
+            # the lease was not renewed, the file is taken over by the second worker
+            self.assertTrue(second.wait_for_changes(timeout=0))
+            self.assertEqual(next(second.get_files()), file)
+            first.heartbeat()
+            first.file_done(file, False)
+            self.assertEqual(queue.statuses(), {file.name: "leased"})
+            second.heartbeat()
+            second.file_done(file, False)
+            self.assertEqual(queue.statuses(), {file.name: "done"})
+        finally:
+            first.close()
+            second.close()
+
+    def test_clean_worker_dirs(self):
+        stopped = subprocess.Popen([sys.executable, "-c", "pass"])
+        stopped.wait()
+        workers = [worker_id(), f"{socket.gethostname()}-{stopped.pid}-0", "other-host-1-0"]
+        for w in workers:
+            os.makedirs(os.path.join(worker_temp_dir(self.tmp.name, w), "file-1"))
+        os.mkdir(os.path.join(self.tmp.name, "file-2"))
+
+        self.assertEqual([worker_alive(w) for w in workers], [True, False, None])
+        self.assertEqual(clean_worker_dirs(self.tmp.name), 1)
+        self.assertEqual(sorted(os.listdir(self.tmp.name)),
+                         sorted(["file-2", f"worker-{workers[0]}", f"worker-{workers[2]}"]))
+
+    def test_close_releases_leases(self):
+        source = FakeSource([MATCHING.format(i) for i in range(2)])
+        queue = MemoryWorkQueue()
+        queue.enqueue(source.files)
+        leased = LeasedSource(queue, source, lease_seconds=60)
+        next(leased.get_files())
+        leased.close()
+
+        self.assertEqual(set(queue.statuses().values()), {"pending"})
+        self.assertEqual({i[4] for i in queue.items.values()}, {0})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,9 @@
 import logging
 import os
 import time
+from datetime import datetime, timedelta
 from http import HTTPStatus
-from typing import List, Optional, Generator, Tuple
+from typing import List, Optional, Generator, Tuple, Iterable, Dict
 
 from facebook_business import FacebookSession, FacebookAdsApi
 from facebook_business.adobjects.advideo import AdVideo
@@ -10,7 +11,13 @@ from facebook_business.adobjects.adaccount import AdAccount
 from facebook_business.api import FacebookResponse, Cursor
 from facebook_business.exceptions import FacebookRequestError
 
+from .chunked import ChunkedUploader
+
 VIDEO_STATUS_READY = 'ready'
+VIDEO_STATUS_ERROR = 'error'
+VIDEO_STATUS_DELETED = 'deleted'  # not a facebook status, set for videos deleted from the account
+VIDEO_TERMINAL_STATUSES = (VIDEO_STATUS_READY, VIDEO_STATUS_ERROR, VIDEO_STATUS_DELETED)
+BATCH_SIZE = 50  # max number of requests in graph api batch
 
 
 class TooManyCallsError(Exception):
@@ -18,14 +25,25 @@ class TooManyCallsError(Exception):
 
 
 class UploadedVideo:
-    def __init__(self, id, name=None, status=None):
+    def __init__(self, id, name=None, status=None, created_time=None):
         self.id = id
         self.name = name
         self.status = status
+        self.created_time = created_time
+
+
+def parse_time(value: Optional[str]) -> Optional[datetime]:
+    if value is None:
+        return None
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S%z')
 
 
 class UploaderBase:
-    def index(self):
+    def index(self, full: bool = False):
+        """
+        Loads existing videos
+        :param full: rebuild persisted index from scratch instead of fetching only new videos
+        """
         raise NotImplementedError
 
     def should_be_uploaded(self, video_name: str) -> bool:
@@ -37,15 +55,37 @@ class UploaderBase:
     def get_by_name(self, video_name: str) -> Optional[UploadedVideo]:
         raise NotImplementedError
 
-    def upload(self, path: str) -> Optional[UploadedVideo]:
+    def upload(self, path: str, key: str = None) -> Optional[UploadedVideo]:
         """
         Upload file by given path and return UploadedVideo
         :param path:
+        :param key: identifies file content between runs to resume interrupted uploads
         :raise Exception if upload failed
         :return:
         """
         raise NotImplementedError
 
+    def upload_url(self, url: str, name: str) -> Optional[UploadedVideo]:
+        """
+        Creates video from file by given url, the file is fetched by the uploader service itself
+        :param name: title of the video
+        :raise Exception if upload failed
+        :return: None if uploading from url is not supported
+        """
+        return None
+
+    def get_by_content_hash(self, content_hash: str) -> Optional[Tuple[UploadedVideo, List[str]]]:
+        """
+        :return: existing video uploaded from a file with the same content and source paths already linked to it
+        """
+        return None
+
+    def link_content(self, content_hash: str, video_id: str, path: str):
+        """
+        Remembers that file by given path has the same content as the video
+        """
+        pass
+
     def set_uploaded_videos(self, files: List[UploadedVideo]):
         raise NotImplementedError
 
@@ -62,18 +102,34 @@ class UploaderBase:
     def reload(self, video: UploadedVideo):
         raise NotImplementedError
 
+    def reload_many(self, videos: List[UploadedVideo]) -> Dict[str, Optional[UploadedVideo]]:
+        """
+        Reloads videos status
+        :return: reloaded videos by id, None for deleted videos. Videos failed to reload are omitted
+        """
+        raise NotImplementedError
+
 
 class FacebookUploaderNoWait(UploaderBase):
     """
     Uploads file to facebook servers but does not waits for video.waitUntilEncodingReady()
     """
-    def __init__(self, api: FacebookAdsApi, act_id: str):
+    def __init__(self, api: FacebookAdsApi, act_id: str, index_storage=None, session_storage=None,
+                 content_storage=None):
+        """
+        :param index_storage: VideoIndexStorageBase keeping index between runs, account is paged fully on every run if None
+        :param session_storage: UploadSessionStorageBase to make uploads resumable
+        :param content_storage: ContentHashStorageBase to link files with already uploaded content instead of uploading
+        """
         self._api = api
         self._act_id = act_id
         self._act = AdAccount(act_id, None, api)
         self._index = {}  # hash map of existing videos
         self._index_ids = {}  # hash map of existing videos
         self._uploaded_videos = {}
+        self._index_storage = index_storage
+        self._chunked = ChunkedUploader(api, act_id, session_storage) if session_storage is not None else None
+        self._content_storage = content_storage
 
     def _index_videos(self, videos: List[UploadedVideo]):
         self._index.update(dict(zip(list(map(lambda x: x.name, videos)), videos)))
@@ -84,11 +140,14 @@ class FacebookUploaderNoWait(UploaderBase):
             del self._index_ids[video.id]
         if video.name in self._index:
             del self._index[video.name]
+        if self._index_storage is not None:
+            self._index_storage.delete_video(self._act_id, video.id)
 
     def _resp_to_video(self, resp: dict) -> UploadedVideo:
         return UploadedVideo(resp['id'],
                              resp['title'] if 'title' in resp else None,
-                             resp['status']['video_status'] if 'status' in resp and 'video_status' in resp['status'] else None
+                             resp['status']['video_status'] if 'status' in resp and 'video_status' in resp['status'] else None,
+                             parse_time(resp.get('created_time'))
                              )
     def _resp_to_video2(self, v: AdVideo) -> UploadedVideo:
         return self._resp_to_video(v._data)
@@ -104,16 +163,66 @@ class FacebookUploaderNoWait(UploaderBase):
     def _decode_request_error(self, e: FacebookRequestError):
         err = f"facebook request failed: {self._get_exception_description(e)}"
         if self._is_too_many_calls_exception(e):
-            raise TooManyCallsError(err)
-        raise Exception(err)
+            raise TooManyCallsError(err) from e
+        raise Exception(err) from e
 
-    def index(self):
+    def _fetch_videos(self, since: Optional[datetime] = None) -> Iterable[UploadedVideo]:
+        """
+        Pages account videos, newest first
+        :param since: only videos created after this time are requested
+        """
         limit = int(os.getenv('FB_AD_PAGE_SIZE','100'))
-        logging.info(f'starting indexing for account={self._act_id} with limit={limit}')
+        params = {"limit": limit}
+        if since is not None:
+            params["since"] = int(since.timestamp())
+        c = Cursor(self._act, AdVideo,
+                   fields=[AdVideo.Field.title, AdVideo.Field.status, AdVideo.Field.created_time], params=params)
+        return map(self._resp_to_video2, c)
+
+    def _index_full(self) -> List[UploadedVideo]:
+        videos = list(self._fetch_videos())
+        if self._index_storage is not None:
+            self._index_storage.clear(self._act_id)
+            self._index_storage.save_videos(self._act_id, videos)
+        return videos
+
+    def _index_incremental(self, last_created_time: datetime) -> List[UploadedVideo]:
+        """
+        Loads persisted index and fetches only videos created since the previous sync.
+        Paging stops at the first video older than the overlap window before last_created_time.
+        Stored videos are reloaded in batches, so videos deleted since the previous sync are dropped from the index
+        """
+        since = last_created_time - timedelta(seconds=int(os.getenv('FB_INDEX_OVERLAP', '3600')))
+        stored = self._index_storage.load_videos(self._act_id)
+        self._index_videos(stored)
+        if os.getenv('FB_INDEX_CHECK_DELETED', '1') == '1':
+            self.reload_many(stored)
+        logging.info(f'Loaded {len(self._index_ids)} videos of account {self._act_id} from storage, fetching videos created since {since}')
+        videos = []
+        for v in self._fetch_videos(since):
+            if v.created_time is not None and v.created_time < since:
+                break
+            videos.append(v)
+        self._index_storage.save_videos(self._act_id, videos)
+        return videos
+
+    def index(self, full: bool = False):
+        logging.info(f'starting indexing for account={self._act_id} full={full}')
         try:
-            c = Cursor(self._act, AdVideo, fields=[AdVideo.Field.title,AdVideo.Field.status], params={"limit":limit})
-            self._index_videos(list(map(self._resp_to_video2, c)))
-            logging.info(f'Indexed {len(self._index_ids)} videos for account {self._act_id}')
+            last_created_time = None
+            if self._index_storage is not None and not full:
+                last_created_time = self._index_storage.get_last_created_time(self._act_id)
+            if last_created_time is None:
+                videos = self._index_full()
+            else:
+                videos = self._index_incremental(last_created_time)
+            self._index_videos(videos)
+            created = [v.created_time for v in videos if v.created_time is not None]
+            if last_created_time is not None:
+                created.append(last_created_time)
+            if self._index_storage is not None and len(created) > 0:
+                self._index_storage.set_last_created_time(self._act_id, max(created))
+            logging.info(f'Indexed {len(self._index_ids)} videos for account {self._act_id}, {len(videos)} fetched')
         except FacebookRequestError as e:
             logging.warn(f'Failed indexing account {self._act_id}. Error={e}')
             self._decode_request_error(e)
@@ -131,6 +240,24 @@ class FacebookUploaderNoWait(UploaderBase):
             return self._index[video_name]
         return None
 
+    def get_by_content_hash(self, content_hash: str) -> Optional[Tuple[UploadedVideo, List[str]]]:
+        if self._content_storage is None:
+            return None
+        links = self._content_storage.get_links(self._act_id, content_hash)
+        if len(links) == 0:
+            return None
+        video_id = links[0][0]
+        video = self._index_ids.get(video_id) or self._uploaded_videos.get(video_id)
+        if video is None or video.status == VIDEO_STATUS_ERROR:
+            logging.info(f'Video {video_id} with content {content_hash} is not available anymore, forgetting it')
+            self._content_storage.delete_links(self._act_id, content_hash)
+            return None
+        return video, [path for _, path in links]
+
+    def link_content(self, content_hash: str, video_id: str, path: str):
+        if self._content_storage is not None:
+            self._content_storage.add_link(self._act_id, content_hash, video_id, path)
+
     def delete_video(self, video: UploadedVideo) -> bool:
         r = self._api.call("DELETE", (video.id,))
         if r.is_success():
@@ -153,7 +280,47 @@ class FacebookUploaderNoWait(UploaderBase):
                 return
             logging.warning(r.json())
 
-    def upload(self, path: str) -> Optional[UploadedVideo]:
+    def _is_not_found(self, r: FacebookResponse) -> bool:
+        if r.status() == HTTPStatus.NOT_FOUND:
+            return True
+        # batch responds with "Object with ID does not exist" error instead of 404
+        body = r.json()
+        error = body.get('error', {}) if isinstance(body, dict) else {}
+        return error.get('code') == 100 and error.get('error_subcode') == 33
+
+    def reload_many(self, videos: List[UploadedVideo]) -> Dict[str, Optional[UploadedVideo]]:
+        result = {}
+
+        def on_success(video: UploadedVideo, r: FacebookResponse):
+            v = self._resp_to_video(r.json())
+            self._index_videos([v])
+            result[video.id] = v
+
+        def on_failure(video: UploadedVideo, r: FacebookResponse):
+            if self._is_not_found(r):
+                self._delete_from_index(video)
+                result[video.id] = None
+            else:
+                logging.warning(f'Failed to reload video {video.id}: {r.json()}')
+
+        for i in range(0, len(videos), BATCH_SIZE):
+            batch = self._api.new_batch()
+            for video in videos[i:i + BATCH_SIZE]:
+                batch.add("GET", (video.id, ), {"fields": "status,title"},
+                          success=lambda r, v=video: on_success(v, r),
+                          failure=lambda r, v=video: on_failure(v, r))
+            retries = 3
+            while batch is not None and retries > 0:
+                batch = batch.execute()
+                retries -= 1
+        return result
+
+    def upload(self, path: str, key: str = None) -> Optional[UploadedVideo]:
+        if self._chunked is not None and key is not None:
+            upl = UploadedVideo(id=self._chunked.upload(path, key))
+            logging.info(f'Video created: id={upl.id}')
+            self._uploaded_videos[upl.id] = upl
+            return upl
         video = AdVideo(api=self._api)
         video._parent_id=self._act_id
         video[AdVideo.Field.filepath] = path
@@ -167,25 +334,63 @@ class FacebookUploaderNoWait(UploaderBase):
         else:
             raise Exception('unable to upload video')
 
+    def upload_url(self, url: str, name: str) -> Optional[UploadedVideo]:
+        try:
+            res = self._api.call("POST", (self._act_id, 'advideos'), {
+                AdVideo.Field.file_url: url,
+                AdVideo.Field.title: name,
+            }).json()
+        except FacebookRequestError as e:
+            self._decode_request_error(e)
+        if not isinstance(res, dict) or 'id' not in res:
+            raise Exception(f'unable to upload video from url: {res}')
+        logging.info(f'Video created from url: id={res["id"]}')
+        upl = UploadedVideo(id=res['id'], name=name)
+        self._uploaded_videos[upl.id] = upl
+        return upl
+
     def set_uploaded_videos(self, files: List[UploadedVideo]):
         self._uploaded_videos = dict(zip(map(lambda x: x.id, files), files))
 
     def wait_all(self) -> Generator[Tuple[str,str], None, None]:
-        sleepTime = 30
-        retries = 10
-        for i in range(0,retries):
-            to_delete = []
-            for id in self._uploaded_videos:
-                video = self._uploaded_videos[id]
-                self.reload(video)
-                g = self.get_by_id(id)
-                if g is not None:
-                    yield id, g.status
-                    if g.status == VIDEO_STATUS_READY:
-                        to_delete.append(id)
-            for id in to_delete:
-                del self._uploaded_videos[id]
-            if len(self._uploaded_videos) == 0:
-                break
-            logging.info(f'The are {len(self._uploaded_videos)} with not ready status. Going to sleep for {sleepTime} seconds. Try {i} of {retries}')
-            time.sleep(sleepTime)
\ No newline at end of file
+        """
+        Polls uploaded videos in batches until they are ready or failed, changed statuses are yielded batch by batch.
+        Every video starts with FB_POLL_INTERVAL_MIN interval which is doubled after each poll up to FB_POLL_INTERVAL_MAX
+        """
+        min_interval = float(os.getenv('FB_POLL_INTERVAL_MIN', '5'))
+        max_interval = float(os.getenv('FB_POLL_INTERVAL_MAX', '60'))
+        deadline = time.monotonic() + float(os.getenv('FB_POLL_TIMEOUT', '300'))
+        polls = {id: [time.monotonic(), min_interval, None] for id in self._uploaded_videos}  # next poll, interval, last status
+        while len(polls) > 0 and time.monotonic() < deadline:
+            now = time.monotonic()
+            due = [self._uploaded_videos[id] for id, p in polls.items() if p[0] <= now]
+            # statuses of a batch are yielded before the next batch is reloaded
+            for i in range(0, len(due), BATCH_SIZE):
+                batch = due[i:i + BATCH_SIZE]
+                reloaded = self.reload_many(batch)
+                now = time.monotonic()
+                for video in batch:
+                    p = polls[video.id]
+                    if video.id not in reloaded:
+                        p[0] = now + p[1]
+                        continue
+                    g = reloaded[video.id]
+                    if g is None:
+                        logging.warning(f'Video {video.id} was deleted')
+                        del polls[video.id]
+                        del self._uploaded_videos[video.id]
+                        continue
+                    if g.status != p[2]:
+                        p[2] = g.status
+                        yield video.id, g.status
+                    if g.status in VIDEO_TERMINAL_STATUSES:
+                        del polls[video.id]
+                        del self._uploaded_videos[video.id]
+                    else:
+                        p[1] = min(max_interval, p[1] * 2)
+                        p[0] = now + p[1]
+            if len(polls) > 0:
+                wait = min(min(p[0] for p in polls.values()), deadline) - time.monotonic()
+                logging.info(f'The are {len(polls)} videos with not ready status. Next poll in {max(wait, 0):.0f} seconds')
+                if wait > 0:
+                    time.sleep(wait)
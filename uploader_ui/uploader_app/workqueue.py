@@ -0,0 +1,254 @@
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+from abc import ABCMeta
+from typing import Generator, List, Optional
+
+from .pattern import match_file
+from .source import SourceBase, FileInfoBase
+
+WORKER_DIR_PREFIX = 'worker-'
+
+
+def worker_id() -> str:
+    """
+    Name of this process in leases, unique between hosts, containers and restarts
+    """
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def worker_alive(worker: str) -> Optional[bool]:
+    """
+    :return: whether the process of a worker of this host is running, None for workers of other hosts
+    """
+    try:
+        host, pid, _ = worker.rsplit('-', 2)
+        pid = int(pid)
+    except ValueError:
+        return None
+    if host != socket.gethostname():
+        return None
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def worker_temp_dir(root: str, worker: str) -> str:
+    """
+    Temporary directory of the worker, a starting run cleans its temporary directory,
+    so workers sharing the root do not delete downloads of each other
+    """
+    return os.path.join(root, f'{WORKER_DIR_PREFIX}{worker}')
+
+
+def clean_worker_dirs(root: str) -> int:
+    """
+    Deletes temporary directories of crashed workers of this host, directories of other hosts are left
+    :return: number of deleted directories
+    """
+    if not os.path.isdir(root):
+        return 0
+    removed = 0
+    for entry in os.scandir(root):
+        if entry.name.startswith(WORKER_DIR_PREFIX) and entry.is_dir() \
+                and worker_alive(entry.name[len(WORKER_DIR_PREFIX):]) is False:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+    if removed > 0:
+        logging.info(f'Removed temporary directories of {removed} stopped workers in {root}')
+    return removed
+
+
+class WorkQueueBase(metaclass=ABCMeta):
+    """
+    Listed files waiting for upload, shared by any number of worker processes.
+    A leased file is not given to other workers until its lease expires, so files of a crashed worker
+    go back to the queue
+    """
+    def enqueue(self, files: List[FileInfoBase]) -> int:
+        """
+        Adds new files, files changed since they were processed and failed files are queued again
+        :return: number of queued files
+        """
+        raise NotImplementedError
+
+    def lease(self, worker: str, count: int, lease_seconds: float) -> List[FileInfoBase]:
+        """
+        Atomically takes up to count queued files or files which lease has expired
+        """
+        raise NotImplementedError
+
+    def renew(self, worker: str, paths: List[str], lease_seconds: float) -> List[str]:
+        """
+        Extends leases of the worker
+        :return: paths still leased by the worker, others were taken over after their lease expired
+        """
+        raise NotImplementedError
+
+    def complete(self, worker: str, path: str, failed: bool):
+        """
+        Removes the file from the queue, a failed file is queued again until its attempts are exhausted
+        """
+        raise NotImplementedError
+
+    def release(self, worker: str, paths: List[str]):
+        """
+        Puts leased files back to the queue without counting an attempt
+        """
+        raise NotImplementedError
+
+    def has_work(self) -> bool:
+        """
+        :return: True if some files can be leased
+        """
+        raise NotImplementedError
+
+    def thread_finished(self):
+        """
+        Called by a thread which does not use the queue anymore, e.g. to close its database connection
+        """
+        pass
+
+
+def enqueue_listed(source: SourceBase, queue: WorkQueueBase, batch_size: int = 500) -> int:
+    """
+    Lists the source and queues matching files for workers. Listing is committed once every file is queued
+    :return: number of queued files
+    """
+    queued = 0
+    batch = []
+    for file in source.get_files():
+        if not match_file(file):
+            continue
+        batch.append(file)
+        if len(batch) >= batch_size:
+            queued += queue.enqueue(batch)
+            batch = []
+    if len(batch) > 0:
+        queued += queue.enqueue(batch)
+    source.commit([])
+    logging.info(f'Queued {queued} files')
+    return queued
+
+
+class LeasedSource(SourceBase):
+    """
+    Files leased from the work queue, downloaded by the source they were listed from.
+    Leases of files being processed are renewed by a heartbeat thread until the uploader is done with them,
+    close() must be called on shutdown
+    """
+    def __init__(self, queue: WorkQueueBase, source: SourceBase, worker: str = None, lease_seconds: float = None,
+                 batch_size: int = None):
+        """
+        :param batch_size: number of files leased at once, leasing goes on until the queue is empty
+        """
+        self._queue = queue
+        self._source = source
+        self._start_folder = getattr(source, '_start_folder', None)
+        self.worker = worker or worker_id()
+        self._lease_seconds = lease_seconds or float(os.getenv('GA_LEASE_SECONDS', '300'))
+        self._batch_size = batch_size or int(os.getenv('GA_LEASE_BATCH', '20'))
+        self._lock = threading.Lock()
+        self._held = set()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run_heartbeat, name='lease-heartbeat', daemon=True)
+        self._thread.start()
+
+    def _run_heartbeat(self):
+        try:
+            while not self._closed.wait(self._lease_seconds / 3):
+                try:
+                    self.heartbeat()
+                except Exception as e:
+                    logging.exception(f'Lease heartbeat failed: {e}')
+        finally:
+            self._queue.thread_finished()
+
+    def heartbeat(self):
+        with self._lock:
+            held = list(self._held)
+        if len(held) == 0:
+            return
+        renewed = set(self._queue.renew(self.worker, held, self._lease_seconds))
+        lost = [p for p in held if p not in renewed]
+        if len(lost) > 0:
+            with self._lock:
+                self._held.difference_update(lost)
+            for path in lost:
+                logging.warning(f'Lease of {path} expired, it is processed by another worker')
+
+    def _complete_left(self):
+        """
+        Files the uploader did not finish are counted as failed attempts
+        """
+        with self._lock:
+            left = list(self._held)
+            self._held.clear()
+        for path in left:
+            logging.warning(f'{path} was not processed, it is queued again')
+            self._queue.complete(self.worker, path, True)
+
+    def get_files(self) -> Generator[FileInfoBase, None, None]:
+        # left by a failed previous run
+        self._complete_left()
+        while not self._closed.is_set():
+            files = self._queue.lease(self.worker, self._batch_size, self._lease_seconds)
+            if len(files) == 0:
+                return
+            with self._lock:
+                self._held.update(f.path for f in files)
+            logging.info(f'Leased {len(files)} files by {self.worker}')
+            yield from files
+
+    def download_file(self, file: FileInfoBase, destination_name: str):
+        self._source.download_file(file, destination_name)
+
+    def get_link(self, file: FileInfoBase) -> Optional[str]:
+        return self._source.get_link(file)
+
+    def file_done(self, file: FileInfoBase, failed: bool):
+        with self._lock:
+            if file.path not in self._held:
+                return
+            self._held.discard(file.path)
+        self._queue.complete(self.worker, file.path, failed)
+
+    def commit(self, failed_files: List[FileInfoBase]):
+        """
+        Failed files are already queued again by file_done
+        """
+        self._complete_left()
+
+    def wait_for_changes(self, timeout: int = None) -> bool:
+        """
+        Polls the queue every GA_QUEUE_POLL_INTERVAL seconds until files can be leased or timeout passes
+        :return: True if there are files to lease
+        """
+        interval = float(os.getenv('GA_QUEUE_POLL_INTERVAL', '30'))
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while not self._queue.has_work():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            if self._closed.wait(interval):
+                return False
+        return True
+
+    def close(self):
+        """
+        Stops the heartbeat and puts files which are still leased back to the queue
+        """
+        self._closed.set()
+        self._thread.join()
+        with self._lock:
+            left = list(self._held)
+            self._held.clear()
+        if len(left) > 0:
+            self._queue.release(self.worker, left)